@@ -0,0 +1,83 @@
+import hashlib
+from functools import wraps
+
+from django.core.cache import cache
+from django.http import HttpResponseNotModified
+from django.utils.http import parse_etags
+from rest_framework.response import Response
+from rest_framework.status import HTTP_200_OK
+
+from .models import DataVersion
+
+
+def get_etag(request, version) -> str:
+    """
+    Returns the ETag of a GET request at a data version, a hash of the version, the path, the sorted
+    query parameters and the accepted media type.
+    """
+    params = sorted((key, sorted(values)) for key, values in request.query_params.lists())
+    key = repr((version, request.path, params, request.accepted_media_type))
+
+    return '"%s"' % hashlib.sha1(key.encode()).hexdigest()
+
+
+def cache_response(method):
+    """
+    Decorates a view method that returns a response computed from the rules, categories and budget
+    edits, so that it is only computed once per data version.
+
+    - A request with an If-None-Match header that matches the current ETag is answered with
+      304 Not Modified, before anything is computed.
+    - Successful response data is kept in Django's cache under the ETag, so any write, which bumps
+      the data version, makes every cached response unreachable. Eviction is left to the cache
+      backend, see CACHES in settings.py.
+    - Streamed responses get an ETag but are not cached.
+
+    Example usage:
+
+    class MyView(views.APIView):
+        @cache_response
+        def get(self, request, *args, **kwargs):
+            ...
+
+    """
+    @wraps(method)
+    def wrapper(view, request, *args, **kwargs):
+        etag = get_etag(request, DataVersion.get())
+
+        if_none_match = parse_etags(request.headers.get("If-None-Match", ""))
+        if etag in if_none_match or "*" in if_none_match:
+            response = HttpResponseNotModified()
+            response["ETag"] = etag
+            return response
+
+        key = f"api:response:{etag}"
+        data = cache.get(key)
+
+        if data is not None:
+            response = Response(data, HTTP_200_OK)
+        else:
+            response = method(view, request, *args, **kwargs)
+            if response.status_code == HTTP_200_OK and isinstance(response, Response):
+                cache.set(key, response.data)
+
+        if response.status_code == HTTP_200_OK:
+            response["ETag"] = etag
+
+        return response
+
+    return wrapper
+
+
+class CachedResponseMixin:
+    """
+    Caches the list and retrieve actions of a viewset with cache_response.
+    """
+
+    @cache_response
+    def list(self, request, *args, **kwargs):
+        return super().list(request, *args, **kwargs)
+
+    @cache_response
+    def retrieve(self, request, *args, **kwargs):
+        return super().retrieve(request, *args, **kwargs)
@@ -0,0 +1,144 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import HttpResponse
+
+from .models import DataVersion
+from .renderers import NDJSONRenderer
+
+
+# bounded, so long budget computations queue here instead of taking every server thread
+pool = ThreadPoolExecutor(max_workers=settings.API_POOL_WORKERS, thread_name_prefix="api")
+
+
+class InFlight:
+    """
+    This class coalesces identical computations: while a computation for a key is running in the
+    pool, submitting the same key returns its future instead of starting another one.
+    Futures are concurrent.futures futures, so they can be shared across threads and event loops.
+
+    Example usage:
+
+    # Both callers get the result of a single computation
+    future = in_flight.submit(key, compute, request)
+    same_future = in_flight.submit(key, compute, request)
+
+    """
+
+    def __init__(self):
+        self._futures = {}
+        self._lock = Lock()
+
+    def submit(self, key, fn, *args):
+        """
+        Returns the future of the running computation for key, or submits fn(*args) to the pool.
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None:
+                return future
+
+            future = pool.submit(contextvars.copy_context().run, fn, *args)
+            self._futures[key] = future
+
+        # outside the lock, the callback runs at once if the future is already done
+        future.add_done_callback(lambda _: self._discard(key, future))
+
+        return future
+
+    def _discard(self, key, future) -> None:
+        with self._lock:
+            if self._futures.get(key) is future:
+                del self._futures[key]
+
+
+in_flight = InFlight()
+
+
+def call_view(view, request, *args, **kwargs):
+    """
+    Calls a synchronous view in a pool thread, renders the response there, and closes the
+    thread's database connection as Django does at the end of a request.
+    """
+    close_old_connections()
+    try:
+        response = view(request, *args, **kwargs)
+        if hasattr(response, "render") and callable(response.render):
+            response.render()
+        return response
+    finally:
+        close_old_connections()
+
+
+def copy_response(response) -> HttpResponse:
+    """
+    Returns a copy of a rendered response, so each coalesced request gets its own response.
+    """
+    return HttpResponse(response.content, status=response.status_code, headers=dict(response.items()))
+
+
+async def iterate_in_pool(iterator):
+    """
+    Yields the items of a synchronous iterator, each computed in the pool.
+    """
+    loop = asyncio.get_running_loop()
+    iterator = iter(iterator)
+    done = object()
+
+    while (item := await loop.run_in_executor(pool, next, iterator, done)) is not done:
+        yield item
+
+
+def streamed(request) -> bool:
+    """
+    Returns whether the view responds to request with a streamed response, rendered as ndjson.
+    """
+    return (request.GET.get("format") == NDJSONRenderer.format
+            or NDJSONRenderer.media_type in request.headers.get("Accept", ""))
+
+
+def async_view(view, coalesce=False):
+    """
+    Returns an async variant of a synchronous view that runs the view in the bounded pool,
+    so the event loop, and the cheap requests it serves, never wait on it.
+
+    With coalesce, concurrent identical GET requests, same data version, path, query parameters,
+    Accept and If-None-Match headers, share one computation. The validator is part of the key since
+    cache_response answers a matching one with an empty 304. Streamed (ndjson) requests are never
+    coalesced, since a streamed response can only be consumed once, their chunks are computed in the
+    pool one at a time.
+
+    Example usage:
+
+    path("async/budget", async_view(views.BudgetView.as_view(), coalesce=True))
+
+    """
+    async def wrapper(request, *args, **kwargs):
+        if coalesce and request.method == "GET" and not streamed(request):
+            key = (
+                await DataVersion.aget(),
+                request.path,
+                tuple(sorted((key, tuple(values)) for key, values in request.GET.lists())),
+                request.headers.get("Accept", ""),
+                request.headers.get("If-None-Match", ""),
+            )
+            future = in_flight.submit(key, call_view, view, request, *args, **kwargs)
+        else:
+            future = pool.submit(contextvars.copy_context().run, call_view, view, request, *args, **kwargs)
+
+        response = await asyncio.wrap_future(future)
+
+        if response.streaming:
+            response.streaming_content = iterate_in_pool(response.streaming_content)
+            return response
+
+        return copy_response(response)
+
+    # the wrapped DRF views enforce CSRF themselves
+    wrapper.csrf_exempt = True
+
+    return wrapper
@@ -0,0 +1,436 @@
+from datetime import date as date_type, datetime
+from decimal import Decimal
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import DecimalField, Sum
+
+from .models import Category, BudgetEdit, BalanceSnapshot, DataVersion
+from .occurrences import expand, occurrence_cache
+from .profiling import span
+
+
+EMPTY_DATES = np.array([], dtype="datetime64[D]")
+
+CENT = Decimal("0.01")
+
+
+def as_date(value) -> date_type:
+    """
+    Returns a date, datetime, numpy datetime64 or YYYY-MM-DD string as a date.
+    """
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date_type):
+        return value
+    if isinstance(value, np.datetime64):
+        return value.astype("datetime64[D]").item()
+    return date_type.fromisoformat(value)
+
+
+def to_cents(amounts):
+    """
+    Returns an int64 array of the cents of amounts, Decimals with at most two decimal places,
+    exactly. Amounts are DecimalFields with decimal_places=2.
+    """
+    return (np.asarray(amounts, dtype=object) * 100).astype(np.int64)
+
+
+def to_decimals(cents) -> list:
+    """
+    Returns a list of the Decimals, with two decimal places, of an array of cents.
+    """
+    return [Decimal(cent) * CENT for cent in np.asarray(cents).tolist()]
+
+
+def to_decimal(cents) -> Decimal:
+    """
+    Returns the Decimal, with two decimal places, of a number of cents.
+    """
+    return Decimal(int(cents)) * CENT
+
+
+class Ledger:
+    """
+    This class represents the budget projection between two dates as a dense date x category matrix.
+    Categories and budget edits are loaded once, occurrences are scattered into the matrix by index,
+    and the group totals, row totals and balance are column-wise reductions over the matrix.
+
+    Amounts are int64 cents, so the reductions are exact integer arithmetic in numpy. They are
+    converted back to Decimals with to_decimals when serialized.
+
+    Attributes:
+    - dates (ndarray): Sorted unique occurrence dates, as datetime64[D].
+    - categories (list): Category instances, one per matrix column.
+    - occurs (ndarray): Boolean matrix, True where a category occurs on a date.
+    - amounts (ndarray): Int64 matrix of the cents of the adjusted amounts, with BudgetEdits applied.
+                         Cells with no occurrence and no edit hold 0.
+    - edit_ids (list): BudgetEdit ids for each date.
+    - opening_balance (int): The cents of the balance before the first date.
+
+    Example usage:
+
+    ledger = Ledger.build(start_date, end_date)
+    rows = BudgetSerializer(ledger).data["dataframe"]
+
+    # Build one year of dates at a time, carrying the balance forward
+    for ledger in Ledger.build_chunks(start_date, end_date, days=365):
+        rows = BudgetSerializer(ledger).data["dataframe"]
+
+    """
+
+    def __init__(self, dates, categories, occurs, amounts, edit_ids, opening_balance=0):
+        self.dates = dates
+        self.categories = categories
+        self.occurs = occurs
+        self.amounts = amounts
+        self.edit_ids = edit_ids
+        self.opening_balance = opening_balance
+
+    @classmethod
+    def build(cls, start_date, end_date, opening_balance=0):
+        """
+        Loads all categories and the budget edits between start_date and end_date and returns the ledger.
+        The opening_balance is an amount, a Decimal, not cents.
+        """
+        return next(cls.build_chunks(start_date, end_date, opening_balance=opening_balance))
+
+    @classmethod
+    def build_chunks(cls, start_date, end_date, days=None, opening_balance=0):
+        """
+        Yields the ledger between start_date and end_date in consecutive chunks of at most `days` days,
+        carrying the balance forward, so that only one chunk's matrix is in memory at a time.
+        Yields a single ledger when days is None.
+        """
+        opening_balance = int(opening_balance * 100)
+        start_date = np.datetime64(as_date(start_date), "D")
+        end_date = np.datetime64(as_date(end_date), "D")
+
+        categories = list(Category.objects.select_related("rule").order_by("id"))
+        column = {category.id: j for j, category in enumerate(categories)}
+
+        edits = list(
+            BudgetEdit.objects
+            .filter(date__gte=start_date.item(), date__lte=end_date.item())
+            .order_by("id")
+            .values_list("id", "category_id", "date", "adjusted_amount")
+        )
+
+        edit_ids = np.array([edit[0] for edit in edits], dtype=np.int64)
+        edit_columns = np.array([column[edit[1]] for edit in edits], dtype=np.int64)
+        edit_dates = np.array([edit[2] for edit in edits], dtype="datetime64[D]")
+        edit_amounts = to_cents([edit[3] for edit in edits])
+
+        has_rule = np.array([category.rule is not None for category in categories], dtype=bool)
+        edit_has_rule = has_rule[edit_columns]
+
+        if days is None:
+            windows = [(start_date, end_date)]
+        else:
+            starts = np.arange(start_date, end_date + 1, days, dtype="datetime64[D]")
+            windows = [(start, min(start + days - 1, end_date)) for start in starts] or [(start_date, end_date)]
+
+        # budget edits always add their date, but a category without a rule only occurs on the date
+        # of an edit that is not already taken by a rule or an edit of a category with a rule.
+        # A date is claimed by the first category (by id) with an edit on it, and each category keeps
+        # its last claimed date. Claims only depend on their own date, so they can be resolved
+        # window by window before any matrix is built.
+        one_off = {}
+
+        for window_start, window_end in windows:
+            with span("expand"):
+                occurrences = cls._rule_occurrences(categories, window_start, window_end)
+            in_window = (edit_dates >= window_start) & (edit_dates <= window_end)
+            taken = np.concatenate([EMPTY_DATES] + occurrences + [edit_dates[in_window & edit_has_rule]])
+
+            claims = np.flatnonzero(in_window & ~edit_has_rule & ~np.isin(edit_dates, taken))
+            claims = claims[np.lexsort((edit_columns[claims], edit_dates[claims]))]
+            _, first = np.unique(edit_dates[claims], return_index=True)
+
+            for i in claims[first]:
+                one_off[edit_columns[i]] = edit_dates[i]
+
+        for window_start, window_end in windows:
+            if len(windows) > 1:
+                with span("expand"):
+                    occurrences = cls._rule_occurrences(categories, window_start, window_end)
+
+            for j, date in one_off.items():
+                if window_start <= date <= window_end:
+                    occurrences[j] = np.array([date], dtype="datetime64[D]")
+
+            in_window = np.flatnonzero((edit_dates >= window_start) & (edit_dates <= window_end))
+
+            with span("build"):
+                ledger = cls._build(
+                    categories,
+                    occurrences,
+                    edit_ids[in_window],
+                    edit_columns[in_window],
+                    edit_dates[in_window],
+                    edit_amounts[in_window],
+                    opening_balance,
+                )
+            opening_balance = ledger.closing_balance
+
+            yield ledger
+
+    @classmethod
+    def balance_before(cls, start_date, date):
+        """
+        Returns the balance of the ledger starting at start_date on the day before date.
+        The rows before date are not built, the balance is the nearest snapshot plus the totals
+        aggregated between the snapshot and date.
+        """
+        start_date = as_date(start_date)
+        date = as_date(date)
+
+        if date <= start_date:
+            return 0
+
+        snapshot = cls.checkpoint(start_date, date)
+
+        return snapshot.balance + sum(cls.group_totals_between(snapshot.date, date).values())
+
+    @classmethod
+    def checkpoint(cls, start_date, date) -> BalanceSnapshot:
+        """
+        Returns the snapshot on the first day of date's month, or an empty snapshot on start_date
+        when that is later. A missing snapshot is computed forward from the nearest earlier one,
+        and saved.
+
+        The snapshot is not saved when the data version changed while it was computed, since a
+        write may have invalidated the snapshots between the read and the save. Writers bump the
+        version before invalidating, so a snapshot saved before the bump is deleted by them.
+        """
+        checkpoint_date = date.replace(day=1)
+
+        if checkpoint_date <= start_date:
+            return BalanceSnapshot(start_date=start_date, date=start_date, balance=0, group_totals={})
+
+        version = DataVersion.get()
+
+        snapshot = BalanceSnapshot.objects.filter(
+            start_date=start_date, date__lte=checkpoint_date).order_by("-date").first()
+
+        if snapshot is not None and snapshot.date == checkpoint_date:
+            return snapshot
+
+        if snapshot is None:
+            snapshot = BalanceSnapshot(start_date=start_date, date=start_date, balance=0, group_totals={})
+
+        totals_between = cls.group_totals_between(snapshot.date, checkpoint_date)
+        group_totals = {group: Decimal(total) for group, total in snapshot.group_totals.items()}
+        for group, total in totals_between.items():
+            group_totals[group] = group_totals.get(group, 0) + total
+
+        snapshot = BalanceSnapshot(
+            start_date=start_date,
+            date=checkpoint_date,
+            balance=snapshot.balance + sum(totals_between.values()),
+            group_totals=group_totals,
+        )
+
+        with transaction.atomic():
+            if DataVersion.get(for_update=True) != version:
+                return snapshot
+
+            snapshot, _ = BalanceSnapshot.objects.get_or_create(
+                start_date=start_date,
+                date=checkpoint_date,
+                defaults={"balance": snapshot.balance, "group_totals": snapshot.group_totals},
+            )
+
+        return snapshot
+
+    @classmethod
+    def group_totals_between(cls, start_date, date) -> dict:
+        """
+        Returns the total of each category group from start_date up to, but not including, date.
+
+        The rows are not built, the totals are aggregated from the budget edits and the number of
+        occurrences of each rule: every budget edit counts once, and each rule occurrence counts
+        the category's adjusted_amount unless an edit of that category replaces it.
+        Categories without a rule only occur on the date of one of their edits.
+        """
+        start_date = np.datetime64(as_date(start_date), "D")
+        end_date = np.datetime64(as_date(date), "D") - 1
+
+        if end_date < start_date:
+            return {}
+
+        edits = BudgetEdit.objects.filter(date__gte=start_date.item(), date__lte=end_date.item())
+        group_totals = {
+            group: total
+            for group, total in edits.values("category__group").annotate(total=Sum(
+                "adjusted_amount", output_field=DecimalField(max_digits=15, decimal_places=2)
+            )).values_list("category__group", "total")
+        }
+
+        categories = Category.objects.select_related("rule").filter(rule__isnull=False)
+        edit_dates = {}
+        for category_id, edit_date in edits.filter(category__rule__isnull=False).values_list(
+                "category_id", "date"):
+            edit_dates.setdefault(category_id, []).append(edit_date)
+
+        for category in categories:
+            count = category.rule.get_occurrence_count(start_date, end_date)
+            if category.id in edit_dates:
+                count -= int(category.rule.occurs_on(edit_dates[category.id]).sum())
+            if count:
+                group_totals[category.group] = group_totals.get(
+                    category.group, 0) + category.adjusted_amount * count
+
+        return group_totals
+
+    @staticmethod
+    def _rule_occurrences(categories, start_date, end_date) -> list:
+        """
+        Returns the rule occurrences of each category, categories without a rule have none.
+        The rules are read from the occurrence cache, or expanded from their recurrence tuples, in
+        a process pool when there are many of them, see OccurrenceCache and occurrences.expand.
+        """
+        occurrences = [EMPTY_DATES] * len(categories)
+        missing = []
+
+        for j, category in enumerate(categories):
+            if category.rule is not None:
+                dates = occurrence_cache.get(
+                    category.rule_id, category.rule.get_recurrence(), start_date, end_date)
+                if dates is None:
+                    missing.append(j)
+                else:
+                    occurrences[j] = dates
+
+        expanded = expand(
+            [categories[j].rule.get_recurrence() for j in missing],
+            start_date,
+            end_date,
+            workers=settings.LEDGER_EXPANSION_WORKERS,
+            threshold=settings.LEDGER_EXPANSION_THRESHOLD,
+        )
+
+        for j, dates in zip(missing, expanded):
+            occurrence_cache.put(categories[j].rule_id, categories[j].rule.get_recurrence(),
+                                 start_date, end_date, dates)
+            occurrences[j] = dates
+
+        return occurrences
+
+    @classmethod
+    def _build(cls, categories, occurrences, edit_ids, edit_columns, edit_dates, edit_amounts,
+               opening_balance):
+        """
+        Scatters the occurrences and budget edits of one window into the matrix.
+        """
+        dates = np.union1d(np.concatenate([EMPTY_DATES] + occurrences), edit_dates)
+
+        occurs = np.zeros((len(dates), len(categories)), dtype=bool)
+        occurrence_columns = np.repeat(
+            np.arange(len(categories)), [len(category_dates) for category_dates in occurrences])
+        occurs[np.searchsorted(dates, np.concatenate([EMPTY_DATES] + occurrences)),
+               occurrence_columns] = True
+
+        adjusted_amounts = to_cents([category.adjusted_amount for category in categories])
+        amounts = np.where(occurs, adjusted_amounts, 0)
+
+        # budget edits override the category amount, (category, date) is unique
+        rows = np.searchsorted(dates, edit_dates)
+        amounts[rows, edit_columns] = edit_amounts
+
+        ids = [[] for _ in range(len(dates))]
+        for row, edit_id in zip(rows.tolist(), edit_ids.tolist()):
+            ids[row].append(edit_id)
+
+        return cls(dates, categories, occurs, amounts, ids, opening_balance)
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def slice(self, start, stop):
+        """
+        Returns the ledger of the dates from index start up to stop, with its opening balance.
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        opening_balance = self.balance()[start - 1] if start > 0 else self.opening_balance
+
+        return Ledger(
+            self.dates[start:stop],
+            self.categories,
+            self.occurs[start:stop],
+            self.amounts[start:stop],
+            self.edit_ids[start:stop],
+            opening_balance,
+        )
+
+    @property
+    def groups(self) -> list:
+        """
+        Returns the category groups in order of their first category.
+        """
+        return list(dict.fromkeys(category.group for category in self.categories))
+
+    def group_totals(self) -> dict:
+        """
+        Returns a dictionary of group to an array of total cents for each date.
+        """
+        group_of = np.array([category.group for category in self.categories])
+
+        return {
+            group: self.amounts[:, group_of == group].sum(axis=1, initial=0)
+            for group in self.groups
+        }
+
+    def row_totals(self):
+        """
+        Returns an array of the total cents for each date.
+        """
+        return self.amounts.sum(axis=1, initial=0)
+
+    def balance(self):
+        """
+        Returns an array of the opening balance plus the cumulative sum of the row totals, in cents.
+        """
+        return np.cumsum(self.row_totals()) + self.opening_balance
+
+    @property
+    def closing_balance(self):
+        """
+        Returns the cents of the balance after the last date.
+        """
+        return self.balance()[-1] if len(self.dates) else self.opening_balance
+
+    def to_dataframe(self) -> "pandas.DataFrame":
+        """
+        Returns a dataframe with the date, categories, budget_edits, group_totals, row_total and
+        balance columns, with the amounts as Decimals, for callers that want one. The API
+        serializes the rows from the arrays instead, see BudgetSerializer.
+        """
+        # pandas is slow to import and only needed here
+        import pandas as pd
+
+        names = [category.name for category in self.categories]
+        group_totals = {group: to_decimals(totals) for group, totals in self.group_totals().items()}
+        row_totals = self.row_totals()
+
+        data = {
+            "date": self.dates.astype(object),
+            "categories": [
+                [names[j] for j in np.flatnonzero(row)]
+                for row in self.occurs
+            ],
+            "budget_edits": list(self.edit_ids),
+            "group_totals": [
+                {group: totals[i] for group, totals in group_totals.items()}
+                for i in range(len(self.dates))
+            ],
+            "row_total": to_decimals(row_totals),
+            "balance": to_decimals(np.cumsum(row_totals) + self.opening_balance),
+        }
+
+        df = pd.DataFrame(data)
+        df.index = range(0, len(df))
+
+        return df
@@ -0,0 +1,286 @@
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import django
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import override_settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIRequestFactory
+
+from api.ledger import Ledger
+from api.models import Rule, Category, BudgetEdit, BalanceSnapshot
+from api.renderers import ORJSONRenderer
+from api.serializers import BudgetSerializer
+from api.synthetic import generate_budget_data
+from api.views import BudgetView, BudgetScenarioView, BudgetThresholdView, CategoryViewset, CategoryBatchView, BudgetEditBatch
+
+
+class Command(BaseCommand):
+    help = (
+        "Times the budget projection pipeline over synthetic data of increasing size, on a throwaway "
+        "test database, and prints the wall time, query count and peak memory of each case as JSON. "
+        "Also measures the import time of a fresh process against a startup budget."
+    )
+
+    start_date = date(2023, 1, 1)
+
+    def add_arguments(self, parser):
+        parser.add_argument("--categories", type=int, nargs="+", default=[10, 100, 1_000])
+        parser.add_argument("--years", type=int, nargs="+", default=[1, 5, 20])
+        parser.add_argument("--edits-per-category", type=int, default=10)
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--import-budget-ms", type=float, default=500,
+                            help="Startup budget, the import time of a process serving the API.")
+        parser.add_argument("--output", help="Writes the results to this file instead of stdout.")
+
+    def handle(self, *args, **options):
+        database_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        results = []
+
+        # the memory-mapped ledgers of the test data are removed with it
+        mmap_dir = tempfile.TemporaryDirectory()
+        self.mmap_dir = mmap_dir.name
+
+        try:
+            for category_count in options["categories"]:
+                for years in options["years"]:
+                    edit_count = category_count * options["edits_per_category"]
+                    self.populate(category_count, edit_count, years, options["seed"])
+                    end_date = self.start_date + timedelta(days=365 * years)
+
+                    for name, case in self.cases(end_date).items():
+                        results.append({
+                            "case": name,
+                            "categories": category_count,
+                            "years": years,
+                            "budget_edits": BudgetEdit.objects.count(),
+                            **self.measure(case, options["repeat"]),
+                        })
+
+                        if options["verbosity"] > 1:
+                            self.stderr.write(json.dumps(results[-1]))
+
+        finally:
+            connection.creation.destroy_test_db(database_name, verbosity=0)
+            mmap_dir.cleanup()
+
+        report = json.dumps({
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "repeat": options["repeat"],
+            "startup": self.startup(options["import_budget_ms"]),
+            "results": results,
+        }, indent=2)
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(report)
+        else:
+            self.stdout.write(report)
+
+    def populate(self, category_count, edit_count, years, seed):
+        """
+        Replaces the data with category_count synthetic categories over the given years.
+        """
+        BalanceSnapshot.objects.all().delete()
+        Category.objects.all().delete()
+        Rule.objects.all().delete()
+
+        generate_budget_data(category_count, edit_count, self.start_date, years, seed)
+
+    def cases(self, end_date) -> dict:
+        """
+        Returns the benchmarked callables by name. Deletes run in a transaction that is rolled back,
+        so every case sees the same data. Cases may return extra metrics, the size of the response
+        in bytes or the number of rows deleted.
+        """
+        factory = APIRequestFactory()
+        params = {"end_date": end_date.isoformat()}
+
+        def budget_view(**extra):
+            def case():
+                response = BudgetView.as_view()(factory.get("/api/budget", {**params, **extra}))
+                response.render()
+                return {"bytes": len(response.content)}
+            return case
+
+        def budget_view_mmap():
+            # the first run writes the ledger's files, the others map them
+            with override_settings(LEDGER_MMAP=True, LEDGER_MMAP_DIR=self.mmap_dir):
+                return budget_view()()
+
+        def budget_view_ndjson():
+            response = BudgetView.as_view()(factory.get("/api/budget", {**params, "format": "ndjson"}))
+            return {"bytes": len(b"".join(response.streaming_content))}
+
+        category_ids = list(Category.objects.values_list("id", flat=True)[:100])
+        budget_edit_ids = list(BudgetEdit.objects.values_list("id", flat=True)[:100])
+
+        def budget_scenarios(count):
+            # each scenario doubles the amount of one category
+            scenarios = [
+                {"name": str(i), "categories": [{"id": category_ids[i % len(category_ids)], "amount": 2 * (i + 1)}]}
+                for i in range(count)
+            ]
+
+            def case():
+                response = BudgetScenarioView.as_view()(factory.post(
+                    "/api/budget-scenarios", {**params, "scenarios": scenarios}, format="json"))
+                response.render()
+                return {"bytes": len(response.content)}
+            return case
+
+        def budget_thresholds():
+            # the index is cached per data version, measure() clears the cache so it is built every run
+            response = BudgetThresholdView.as_view()(factory.get(
+                "/api/budget-thresholds", {**params, "threshold": list(range(-100_000, 100_000, 2_000))}))
+            response.render()
+            return {"bytes": len(response.content)}
+
+        ledger = Ledger.build(self.start_date, end_date)
+
+        def budget_serializer():
+            BudgetSerializer(ledger).data
+
+        data = BudgetSerializer(ledger).data
+
+        def render(renderer):
+            def case():
+                return {"bytes": len(renderer.render(data))}
+            return case
+
+        def category_list():
+            response = CategoryViewset.as_view({"get": "list"})(factory.get("/api/category"))
+            response.render()
+
+        def category_batch_delete():
+            with transaction.atomic():
+                response = CategoryBatchView.as_view()(factory.delete(
+                    "/api/category-batch-delete", [{"id": id} for id in category_ids], format="json"))
+                transaction.set_rollback(True)
+
+            return {"rows": response.data["categories"] + response.data["budget_edits"] + response.data["rules"]}
+
+        def budget_edit_batch_delete():
+            with transaction.atomic():
+                response = BudgetEditBatch.as_view()(factory.delete(
+                    "/api/budget-edit-batch-delete", [{"id": id} for id in budget_edit_ids], format="json"))
+                transaction.set_rollback(True)
+
+            return {"rows": response.data["budget_edits"]}
+
+        return {
+            "budget view": budget_view(),
+            "budget view mmap": budget_view_mmap,
+            "budget view ndjson": budget_view_ndjson,
+            "budget view columnar": budget_view(shape="columnar"),
+            "budget view columnar msgpack": budget_view(shape="columnar", format="msgpack"),
+            "budget view monthly": budget_view(granularity="month"),
+            "budget view weekly": budget_view(granularity="week"),
+            "budget scenarios 1": budget_scenarios(1),
+            "budget scenarios 50": budget_scenarios(50),
+            "budget thresholds": budget_thresholds,
+            "budget serializer": budget_serializer,
+            "render json": render(JSONRenderer()),
+            "render orjson": render(ORJSONRenderer()),
+            "category list": category_list,
+            "category batch delete": category_batch_delete,
+            "budget edit batch delete": budget_edit_batch_delete,
+        }
+
+    def startup(self, budget_ms, top=10) -> dict:
+        """
+        Returns the import time of a fresh process that sets up Django and loads the API urls, as
+        reported by python -X importtime, whether it is within budget_ms, and the slowest top level
+        imports. Also reports whether pandas was imported, it is only needed by Ledger.to_dataframe.
+        """
+        code = (
+            "import sys, django; django.setup(); "
+            "from django.urls import resolve; resolve('/api/budget'); "
+            "print('pandas' in sys.modules)"
+        )
+        process = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", code],
+            capture_output=True, text=True, check=True, cwd=settings.BASE_DIR,
+            env={**os.environ, "DJANGO_SETTINGS_MODULE": os.environ.get("DJANGO_SETTINGS_MODULE", "backend.settings")},
+        )
+
+        imports = []
+        for line in process.stderr.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative, name = line.split("|")
+            # nested imports are indented, top level ones sum up to the whole import time
+            if cumulative.strip().isdigit() and not name[1:].startswith(" "):
+                imports.append((name.strip(), int(cumulative) / 1000))
+
+        import_ms = sum(ms for _, ms in imports)
+
+        return {
+            "import_ms": round(import_ms, 3),
+            "budget_ms": budget_ms,
+            "within_budget": import_ms <= budget_ms,
+            "pandas_imported": process.stdout.strip() == "True",
+            "slowest": [
+                {"module": name, "ms": round(ms, 3)}
+                for name, ms in sorted(imports, key=lambda item: item[1], reverse=True)[:top]
+            ],
+        }
+
+    def measure(self, case, repeat) -> dict:
+        """
+        Returns the best wall time and the query count of repeat runs, and the peak memory of one
+        more run. Memory is traced separately because tracing slows the timed runs down.
+        Cases that return a number of rows also report rows per second.
+        """
+        seconds = []
+        metrics = None
+        queries = []
+
+        # counted with a wrapper rather than CaptureQueriesContext, whose log is capped at 9000 queries
+        def count(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+
+        for _ in range(repeat):
+            # time the computation, not the response cache
+            cache.clear()
+            queries.clear()
+            with connection.execute_wrapper(count):
+                start = time.perf_counter()
+                metrics = case()
+                seconds.append(time.perf_counter() - start)
+
+        cache.clear()
+        tracemalloc.start()
+        try:
+            case()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        result = {
+            "seconds": round(min(seconds), 6),
+            "queries": len(queries),
+            "peak_memory_bytes": peak,
+        }
+
+        if metrics is not None:
+            result.update(metrics)
+        if "rows" in result:
+            result["rows_per_second"] = round(result["rows"] / min(seconds))
+
+        return result
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from api.models import Rule, DataVersion, delete_rows
+
+
+class Command(BaseCommand):
+    help = (
+        "Deletes the rules that no category uses, with a single query. Category saves only delete "
+        "the rule they detach, this sweeps the rest, e.g. rules created for a category that was "
+        "never saved."
+    )
+
+    def handle(self, *args, **options):
+        # rules without a category are not part of the budget, so no snapshot is affected
+        count = delete_rows(Rule, "id", Rule.objects.filter(category=None).values_list("id", flat=True))
+
+        if count:
+            DataVersion.bump()
+
+        self.stdout.write(self.style.SUCCESS(f"Deleted {count} orphaned rules."))
@@ -0,0 +1,126 @@
+import time
+from datetime import date, timedelta
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import DecimalField, Sum
+
+from api.models import Rule, Category, BudgetEdit
+
+
+class Command(BaseCommand):
+    help = (
+        "Shows the query plans and timings of the budget queries before and after the indexes of "
+        "migration 0005, on a throwaway test database filled with synthetic budget edits."
+    )
+
+    # migration before the budget indexes
+    before_indexes = "0004"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--edits", type=int, default=1_000_000)
+        parser.add_argument("--categories", type=int, default=1_000)
+        parser.add_argument("--repeat", type=int, default=3)
+
+    def handle(self, *args, **options):
+        database_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+
+        try:
+            call_command("migrate", "api", self.before_indexes, verbosity=0)
+            self.populate(options["categories"], options["edits"])
+            before = self.explain(options["repeat"])
+
+            call_command("migrate", "api", verbosity=0)
+            after = self.explain(options["repeat"])
+
+        finally:
+            connection.creation.destroy_test_db(database_name, verbosity=0)
+
+        self.stdout.write(f"{options['edits']} budget edits, {options['categories']} categories\n")
+
+        for name in before:
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            for label, (plan, seconds) in [("before", before[name]), ("after", after[name])]:
+                self.stdout.write(f"  {label}: {seconds * 1000:.2f} ms")
+                for line in plan.splitlines():
+                    self.stdout.write(f"    {line}")
+
+    def populate(self, category_count, edit_count):
+        """
+        Creates the categories, half of them with a monthly rule, and spreads the budget edits
+        over consecutive dates of each category.
+        """
+        start_date = date(2020, 1, 1)
+
+        rules = Rule.objects.bulk_create([
+            Rule(frequency="Monthly", start_date=start_date + timedelta(days=i), day_of_month=1)
+            for i in range(category_count // 2)
+        ])
+        categories = Category.objects.bulk_create([
+            Category(
+                name=f"Category {i}",
+                amount=100,
+                adjusted_amount=-100,
+                group="Fixed",
+                rule=rules[i] if i < len(rules) else None,
+            )
+            for i in range(category_count)
+        ])
+
+        edits_per_category = -(-edit_count // category_count)
+        batch = []
+
+        for i in range(edit_count):
+            batch.append(BudgetEdit(
+                category=categories[i // edits_per_category],
+                date=start_date + timedelta(days=i % edits_per_category),
+                amount=50,
+                adjusted_amount=-50,
+            ))
+            if len(batch) == 50_000:
+                BudgetEdit.objects.bulk_create(batch)
+                batch = []
+
+        BudgetEdit.objects.bulk_create(batch)
+
+    def queries(self) -> dict:
+        """
+        Returns the budget queries by name.
+        """
+        window_start, window_end = date(2021, 1, 1), date(2021, 1, 31)
+        edits = BudgetEdit.objects.filter(date__gte=window_start, date__lte=window_end)
+
+        return {
+            "earliest budget edit": BudgetEdit.objects.order_by("date")[:1],
+            "earliest rule": Rule.objects.order_by("start_date")[:1],
+            "budget edits on a date": BudgetEdit.objects.filter(date=window_start),
+            "ledger budget edits in a month": edits.order_by("id").values_list(
+                "id", "category_id", "date", "adjusted_amount"),
+            "group totals before a date": BudgetEdit.objects.filter(date__lt=window_start).values(
+                "category__group").annotate(total=Sum(
+                    "adjusted_amount", output_field=DecimalField(max_digits=15, decimal_places=2))),
+        }
+
+    def explain(self, repeat) -> dict:
+        """
+        Returns the query plan and the best time of each query.
+        """
+        results = {}
+
+        # refresh the planner statistics, including those of new indexes
+        if connection.vendor == "sqlite":
+            with connection.cursor() as cursor:
+                cursor.execute("ANALYZE")
+
+        for name, queryset in self.queries().items():
+            seconds = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                list(queryset.all())
+                seconds.append(time.perf_counter() - start)
+
+            results[name] = (queryset.explain(), min(seconds))
+
+        return results
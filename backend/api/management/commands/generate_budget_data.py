@@ -0,0 +1,46 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from api.models import Rule, Category, BudgetEdit
+from api.synthetic import generate_budget_data
+
+
+class Command(BaseCommand):
+    help = (
+        "Creates synthetic categories, rules and budget edits, see api.synthetic.generate_budget_data. "
+        "Use --clear to delete the existing rules, categories and budget edits first."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--categories", type=int, default=100)
+        parser.add_argument("--edits", type=int, default=1_000)
+        parser.add_argument("--start-date", type=date.fromisoformat, default=date.today().replace(day=1))
+        parser.add_argument("--years", type=float, default=1)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--clear", action="store_true")
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        if options["clear"]:
+            # budget edits cascade with their category
+            Category.objects.all().delete()
+            Rule.objects.all().delete()
+
+        elif Category.objects.filter(name__startswith="Category ").exists():
+            raise CommandError("Synthetic categories already exist, use --clear to replace them.")
+
+        categories = generate_budget_data(
+            options["categories"],
+            options["edits"],
+            options["start_date"],
+            options["years"],
+            options["seed"],
+        )
+
+        # there are at most one edit per category and day, the number of edits is capped to that
+        edit_count = BudgetEdit.objects.filter(category__in=categories).count()
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Created {len(categories)} categories and {edit_count} budget edits."))
@@ -0,0 +1,237 @@
+import os
+import shutil
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+
+from .ledger import Ledger, as_date
+from .models import Category, DataVersion
+
+
+class EditIds:
+    """
+    This class is the list of the budget edit ids of each date of a MappedLedger, read from the
+    mapped arrays when it is indexed or iterated, so that only the rows that are serialized are
+    turned into lists.
+
+    Attributes:
+    - ids (ndarray): Memory-mapped int64 array of the budget edit ids of every date.
+    - offsets (ndarray): Int64 array of the index in ids of the first id of each date, and of the
+                         end of the last date.
+
+    Example usage:
+
+    # The ids of the first date, and of the dates of a window
+    edit_ids[0]
+    edit_ids[start:stop]
+
+    """
+
+    def __init__(self, ids, offsets):
+        self.ids = ids
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, _ = index.indices(len(self))
+            return EditIds(self.ids, self.offsets[start:max(start, stop) + 1])
+
+        index = range(len(self))[index]
+        return self.ids[self.offsets[index]:self.offsets[index + 1]].tolist()
+
+    def __iter__(self):
+        offsets = np.asarray(self.offsets).tolist()
+        if not offsets:
+            return
+
+        ids = self.ids[offsets[0]:offsets[-1]].tolist()
+        for start, stop in zip(offsets[:-1], offsets[1:]):
+            yield ids[start - offsets[0]:stop - offsets[0]]
+
+
+class MappedLedger(Ledger):
+    """
+    This class represents a Ledger read from files that every worker process memory-maps, so that
+    a ledger is built once per data version instead of once per process, and its arrays live in
+    the page cache, shared by the processes, instead of in each of them.
+
+    A ledger is saved under settings.LEDGER_MMAP_DIR, in a directory named after the data version,
+    its dates and opening balance, holding one .npy file per array. The directory is written
+    under a temporary name and renamed, so a process never maps a partial ledger. Once a new one
+    is written, the directories of older data versions are removed, and those of the same version
+    beyond the settings.LEDGER_MMAP_WINDOWS most recently used. A directory removed by another
+    process before it is mapped is built again.
+
+    The group totals and balance are saved too, so that they are read without reducing the matrix.
+    The budget edit ids stay mapped as well, see EditIds. The categories are loaded from the
+    database, in the same order as Ledger.build loads them.
+
+    Attributes, besides those of Ledger:
+    - amounts (ndarray): Memory-mapped int64 matrix of the cents of each date and category.
+    - group_cents (ndarray): Int64 matrix of the cents of each date and group.
+    - balance_cents (ndarray): Int64 array of the cents of the balance after each date.
+    - edit_ids (EditIds): BudgetEdit ids for each date, read from the mapped arrays.
+
+    Example usage:
+
+    # Build, save and map the ledger, or map the one saved by another process
+    ledger = MappedLedger.get(start_date, end_date)
+
+    """
+
+    def __init__(self, dates, categories, occurs, amounts, edit_ids, opening_balance,
+                 group_cents, balance_cents):
+        super().__init__(dates, categories, occurs, amounts, edit_ids, opening_balance)
+        self.group_cents = group_cents
+        self.balance_cents = balance_cents
+
+    @classmethod
+    def get(cls, start_date, end_date, opening_balance=0):
+        """
+        Returns the ledger between start_date and end_date at the current data version, mapped from
+        its files, which are written first when no process has written them yet.
+        """
+        directory = Path(settings.LEDGER_MMAP_DIR)
+        version = DataVersion.get()
+        path = directory / "{}-{}-{}-{}".format(
+            version, as_date(start_date), as_date(end_date), int(opening_balance * 100))
+
+        categories = list(Category.objects.select_related("rule").order_by("id"))
+
+        ledger = cls.load(path, categories, int(opening_balance * 100))
+        if ledger is not None:
+            return ledger
+
+        built = Ledger.build(start_date, end_date, opening_balance)
+        cls.write(directory, path, built)
+        cls.prune(directory, version, path)
+
+        # a category changed between reading the version and building the ledger, or the files
+        # were pruned by another process in between
+        ledger = cls.load(path, categories, int(opening_balance * 100))
+
+        return built if ledger is None else ledger
+
+    @staticmethod
+    def write(directory, path, ledger) -> None:
+        """
+        Saves the arrays of a ledger under path.
+        """
+        directory.mkdir(parents=True, exist_ok=True)
+
+        category_ids = np.array([category.id for category in ledger.categories], dtype=np.int64)
+        group_totals = ledger.group_totals()
+        arrays = {
+            "dates": ledger.dates,
+            "category_ids": category_ids,
+            "occurs": ledger.occurs,
+            "amounts": ledger.amounts,
+            "group_cents": np.column_stack([group_totals[group] for group in ledger.groups])
+            if ledger.groups else np.zeros((len(ledger), 0), dtype=np.int64),
+            "balance_cents": ledger.balance(),
+            "edit_ids": np.array(
+                [edit_id for edit_ids in ledger.edit_ids for edit_id in edit_ids], dtype=np.int64),
+            "edit_offsets": np.cumsum([0] + [len(edit_ids) for edit_ids in ledger.edit_ids], dtype=np.int64),
+        }
+
+        temporary = Path(tempfile.mkdtemp(prefix=".", dir=directory))
+        for name, array in arrays.items():
+            np.save(temporary / f"{name}.npy", array)
+
+        try:
+            os.rename(temporary, path)
+        except OSError:
+            # another process saved the same ledger first
+            shutil.rmtree(temporary, ignore_errors=True)
+
+    @staticmethod
+    def prune(directory, version, path) -> None:
+        """
+        Removes the ledgers of older data versions, and the least recently used ledgers of version
+        beyond settings.LEDGER_MMAP_WINDOWS, keeping path. Newer versions are left to the process
+        that wrote them, and entries that are not named after a version are left alone. Processes that still map a removed ledger keep its pages until they
+        unmap them.
+        """
+        windows = []
+
+        for entry in directory.iterdir():
+            if entry.name.startswith("."):
+                continue
+
+            try:
+                entry_version = int(entry.name.split("-")[0])
+            except ValueError:
+                # not a ledger, e.g. lost+found
+                continue
+
+            if entry_version < version:
+                shutil.rmtree(entry, ignore_errors=True)
+            elif entry_version == version and entry != path:
+                try:
+                    windows.append((entry.stat().st_mtime, entry))
+                except FileNotFoundError:
+                    pass
+
+        for _, entry in sorted(windows, reverse=True)[max(settings.LEDGER_MMAP_WINDOWS - 1, 0):]:
+            shutil.rmtree(entry, ignore_errors=True)
+
+    @classmethod
+    def load(cls, path, categories, opening_balance):
+        """
+        Maps the arrays saved under path, returns None when they are missing, not written yet or
+        removed by prune, or when they were saved for other categories.
+        """
+        try:
+            arrays = {
+                name: np.load(path / f"{name}.npy", mmap_mode="r")
+                for name in ["dates", "category_ids", "occurs", "amounts", "group_cents",
+                             "balance_cents", "edit_ids", "edit_offsets"]
+            }
+            # the modification time orders the ledgers of a version by use, see prune
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+
+        if arrays["category_ids"].tolist() != [category.id for category in categories]:
+            return None
+
+        return cls(
+            arrays["dates"],
+            categories,
+            arrays["occurs"],
+            arrays["amounts"],
+            EditIds(arrays["edit_ids"], arrays["edit_offsets"]),
+            opening_balance,
+            arrays["group_cents"],
+            arrays["balance_cents"],
+        )
+
+    def slice(self, start, stop):
+        start, stop, _ = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        opening_balance = self.balance()[start - 1] if start > 0 else self.opening_balance
+
+        return MappedLedger(
+            self.dates[start:stop],
+            self.categories,
+            self.occurs[start:stop],
+            self.amounts[start:stop],
+            self.edit_ids[start:stop],
+            opening_balance,
+            self.group_cents[start:stop],
+            self.balance_cents[start:stop],
+        )
+
+    def group_totals(self) -> dict:
+        return {group: self.group_cents[:, g] for g, group in enumerate(self.groups)}
+
+    def row_totals(self):
+        return self.group_cents.sum(axis=1, initial=0)
+
+    def balance(self):
+        return self.balance_cents
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_balancesnapshot'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='rule',
+            name='start_date',
+            field=models.DateField(db_index=True),
+        ),
+        migrations.AddIndex(
+            model_name='budgetedit',
+            index=models.Index(fields=['date', 'category', 'adjusted_amount'], name='api_budgetedit_date_idx'),
+        ),
+    ]
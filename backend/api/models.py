@@ -1,8 +1,14 @@
-from django.db import models
+import time
+
+from django.db import connection, models
+from django.db.models.functions import Greatest
 from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
 from django.core.validators import MinValueValidator, MaxValueValidator
 from dateutil.rrule import rrule, WEEKLY, DAILY, MONTHLY, YEARLY, SU, MO, TU, WE, TH, FR, SA
 
+from .occurrences import occurrence_dates, occurrence_count, occurs_on
+
 
 class Rule(models.Model):
     """
@@ -38,7 +44,7 @@ class Rule(models.Model):
         ("Weekly", "Weekly"),
         ("Daily", "Daily"),
     ])
-    start_date = models.DateField()
+    start_date = models.DateField(db_index=True)
     end_date = models.DateField(null=True, blank=True)
     weekday = models.CharField(max_length=100, null=True, blank=True, choices=[
         ("Monday", "Monday"),
@@ -126,6 +132,39 @@ class Rule(models.Model):
         """
         return self.get_rrule().between(start_date, end_date, inc=True)
 
+    def get_recurrence(self) -> tuple:
+        """
+        Returns the fields that define the occurrences, in the argument order of the
+        functions in occurrences.py.
+        """
+        return (
+            self.frequency,
+            self.start_date,
+            self.end_date,
+            self.weekday,
+            self.day_of_month,
+            self.month_of_year,
+        )
+
+    def get_occurrence_dates(self, start_date, end_date):
+        """
+        Returns a numpy datetime64[D] array of occurrences between start and end, inclusive.
+        The dates are computed in closed form, get_occurrences remains the rrule reference.
+        """
+        return occurrence_dates(*self.get_recurrence(), start_date, end_date)
+
+    def get_occurrence_count(self, start_date, end_date) -> int:
+        """
+        Returns the number of occurrences between start and end, inclusive.
+        """
+        return occurrence_count(*self.get_recurrence(), start_date, end_date)
+
+    def occurs_on(self, dates):
+        """
+        Returns a boolean array, True for each of the dates that is an occurrence.
+        """
+        return occurs_on(*self.get_recurrence(), dates)
+
     def save(self, *args, **kwargs):
         self.full_clean()
         super().save(*args, **kwargs)
@@ -216,6 +255,10 @@ class BudgetEdit(models.Model):
 
     class Meta:
         unique_together = ["category", "date"]
+        indexes = [
+            # date scans, covering the columns the budget reads
+            models.Index(fields=["date", "category", "adjusted_amount"], name="api_budgetedit_date_idx"),
+        ]
 
     def __str__(self) -> str:
         return f"{self.category.name} - {self.amount} - {self.date}"
@@ -223,3 +266,139 @@ class BudgetEdit(models.Model):
     def save(self, *args, **kwargs) -> None:
         self.adjusted_amount = self.amount if self.category.group == "Income" else self.amount * -1
         return super().save(*args, **kwargs)
+
+
+class BalanceSnapshot(models.Model):
+    """
+    This model represents a checkpoint of the running balance of the budget.
+    It includes the balance and the group totals of every budget row before the date, for the budget
+    starting at start_date, so balances can be computed forward from it instead of from start_date.
+
+    Fields:
+    - start_date (Date): The first date of the budget the snapshot belongs to.
+    - date (Date): The date of the snapshot, rows on this date are not included.
+    - balance (Decimal): The balance before the date.
+    - group_totals (dict): The total of each category group before the date.
+
+    Snapshots are taken on the first day of a month when a balance in that month is requested,
+    see Ledger.checkpoint. Changes to rules, categories and budget edits bump the DataVersion and
+    then delete the snapshots after the date of the change, see signals.py.
+
+    Example usage:
+
+    # Deleting the snapshots affected by a change on a date
+    BalanceSnapshot.invalidate("2021-01-01")
+
+    """
+    start_date = models.DateField()
+    date = models.DateField()
+    balance = models.DecimalField(max_digits=15, decimal_places=2)
+    group_totals = models.JSONField(default=dict, encoder=DjangoJSONEncoder)
+
+    class Meta:
+        unique_together = ["start_date", "date"]
+
+    def __str__(self) -> str:
+        return f"{self.start_date} - {self.date} - {self.balance}"
+
+    @classmethod
+    def invalidate(cls, date) -> None:
+        """
+        Deletes the snapshots that include rows on or after date.
+        """
+        cls.objects.filter(date__gt=date).delete()
+
+
+class DataVersion(models.Model):
+    """
+    This model holds a counter of the writes to rules, categories and budget edits.
+    It has a single row, the version is incremented by the signals in signals.py, and by the
+    batch views that write without sending signals.
+
+    Fields:
+    - version (int): Incremented on every write.
+
+    Responses computed from the data are cached and tagged with the version they were computed at,
+    see caching.py, so a changed version means every cached response is stale.
+
+    Example usage:
+
+    # Getting the current version
+    DataVersion.get()
+    await DataVersion.aget()
+
+    # Incrementing the version after a write
+    DataVersion.bump()
+
+    """
+    version = models.BigIntegerField(default=0)
+
+    def __str__(self) -> str:
+        return str(self.version)
+
+    @classmethod
+    def get(cls, for_update=False) -> int:
+        """
+        Returns the current version. With for_update, the row is locked until the end of the
+        transaction, so that a concurrent bump waits for it.
+        """
+        versions = cls.objects.filter(pk=1)
+        if for_update:
+            versions = versions.select_for_update()
+
+        return versions.values_list("version", flat=True).first() or 0
+
+    @classmethod
+    async def aget(cls) -> int:
+        """
+        Returns the current version, with the async ORM.
+        """
+        return await cls.objects.filter(pk=1).values_list("version", flat=True).afirst() or 0
+
+    @classmethod
+    def bump(cls) -> None:
+        """
+        Increments the version, with a single update once the row exists.
+
+        The version also moves up to the current time in microseconds, so it does not repeat an
+        earlier version when the table is flushed or restored while the cache still holds
+        responses of that earlier version.
+        """
+        now = time.time_ns() // 1000
+        versions = cls.objects.filter(pk=1)
+        version = Greatest(models.F("version") + 1, models.Value(now))
+
+        if not versions.update(version=version):
+            _, created = cls.objects.get_or_create(pk=1, defaults={"version": now})
+            if not created:
+                versions.update(version=version)
+
+
+def delete_rows(model, field, values) -> int:
+    """
+    Deletes the rows of model whose field is one of values, a list or a values_list queryset, with
+    a single DELETE statement, and returns the number of rows deleted. Unlike QuerySet.delete, the
+    rows are not collected first, and neither cascades nor signals run, so the caller deletes the
+    related rows and does the work of the signals.
+
+    Example usage:
+
+    # Deleting the budget edits of categories, before the categories
+    delete_rows(BudgetEdit, "category", category_ids)
+
+    """
+    table = connection.ops.quote_name(model._meta.db_table)
+    column = connection.ops.quote_name(model._meta.get_field(field).column)
+
+    # a queryset of values is deleted as a subquery, in the same statement
+    if isinstance(values, models.QuerySet):
+        subquery, params = values.query.sql_with_params()
+    else:
+        params = list(values)
+        if not params:
+            return 0
+        subquery = ", ".join(["%s"] * len(params))
+
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {table} WHERE {column} IN ({subquery})", params)
+        return cursor.rowcount
@@ -0,0 +1,312 @@
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+import numpy as np
+
+
+WEEKDAYS = {
+    "Monday": 0,
+    "Tuesday": 1,
+    "Wednesday": 2,
+    "Thursday": 3,
+    "Friday": 4,
+    "Saturday": 5,
+    "Sunday": 6,
+}
+
+
+def occurrence_dates(frequency, start_date, end_date, weekday, day_of_month, month_of_year,
+                     window_start, window_end):
+    """
+    Returns a datetime64[D] array of the occurrences of a rule between window_start and window_end,
+    inclusive, computed in closed form instead of iterating an rrule.
+
+    The arguments after frequency are the Rule fields, so rules can be expanded without model instances.
+    The results are the dates of Rule.get_rrule().between(), which remains the reference:
+    - Daily and Weekly are arithmetic progressions of 1 and 7 days.
+    - Biweekly steps 14 days from the rule's weekday in the week (starting Monday) of the start date,
+      so when that weekday is before the start date the first occurrence is two weeks later.
+    - Monthly and Yearly pick day_of_month in every month, or in month_of_year of every year,
+      and skip months that do not have that day, as rrule does for bymonthday.
+    """
+    lo, hi = _bounds(start_date, end_date, window_start, window_end)
+
+    if hi < lo:
+        return np.array([], dtype="datetime64[D]")
+
+    if frequency == "Daily":
+        return np.arange(lo, hi + 1, dtype="datetime64[D]")
+
+    if frequency == "Weekly" or frequency == "Biweekly":
+        step = 7 if frequency == "Weekly" else 14
+        return np.arange(_first_weekly(start_date, weekday, step, lo), hi + 1, step,
+                         dtype="datetime64[D]")
+
+    if frequency == "Monthly":
+        months = np.arange(
+            lo.astype("datetime64[M]"), hi.astype("datetime64[M]") + 1, dtype="datetime64[M]")
+        return _days_of_months(months, day_of_month, lo, hi)
+
+    if frequency == "Yearly":
+        years = np.arange(
+            lo.astype("datetime64[Y]"), hi.astype("datetime64[Y]") + 1, dtype="datetime64[Y]")
+        months = years.astype("datetime64[M]") + (month_of_year - 1)
+        return _days_of_months(months, day_of_month, lo, hi)
+
+    raise ValueError(f"Unsupported frequency: {frequency}")
+
+
+def occurrence_count(frequency, start_date, end_date, weekday, day_of_month, month_of_year,
+                     window_start, window_end) -> int:
+    """
+    Returns the number of occurrences of a rule between window_start and window_end, inclusive.
+    Daily, Weekly and Biweekly rules are counted without generating their dates.
+    """
+    lo, hi = _bounds(start_date, end_date, window_start, window_end)
+
+    if hi < lo:
+        return 0
+
+    if frequency == "Daily":
+        return int((hi - lo).astype(np.int64)) + 1
+
+    if frequency == "Weekly" or frequency == "Biweekly":
+        step = 7 if frequency == "Weekly" else 14
+        first = _first_weekly(start_date, weekday, step, lo)
+        return max(0, int((hi - first).astype(np.int64)) // step + 1)
+
+    return len(occurrence_dates(frequency, start_date, end_date, weekday, day_of_month, month_of_year,
+                                window_start, window_end))
+
+
+def occurs_on(frequency, start_date, end_date, weekday, day_of_month, month_of_year, dates):
+    """
+    Returns a boolean array, True for each of the dates that is an occurrence of the rule.
+    """
+    dates = np.asarray(dates, dtype="datetime64[D]")
+    mask = dates >= np.datetime64(start_date, "D")
+
+    if end_date is not None:
+        mask &= dates <= np.datetime64(end_date, "D")
+
+    if frequency == "Daily":
+        return mask
+
+    if frequency == "Weekly" or frequency == "Biweekly":
+        step = 7 if frequency == "Weekly" else 14
+        first = _first_weekly(start_date, weekday, step, np.datetime64(start_date, "D"))
+        return mask & (dates >= first) & ((dates - first).astype(np.int64) % step == 0)
+
+    months = dates.astype("datetime64[M]")
+    days = (dates - months.astype("datetime64[D]")).astype(np.int64) + 1
+
+    if frequency == "Monthly":
+        return mask & (days == day_of_month)
+
+    if frequency == "Yearly":
+        return mask & (days == day_of_month) & (months.astype(np.int64) % 12 + 1 == month_of_year)
+
+    raise ValueError(f"Unsupported frequency: {frequency}")
+
+
+def expand(recurrences, window_start, window_end, workers=1, threshold=5000) -> list:
+    """
+    Returns the occurrence_dates of each recurrence, a tuple of the Rule fields as returned by
+    Rule.get_recurrence, between window_start and window_end.
+
+    With at least `threshold` recurrences and more than one worker, the recurrences are split into
+    one partition per worker and expanded in a process pool. Each worker returns its dates as one
+    array with the number of dates of each recurrence, which is cheaper to send back than an array
+    per recurrence. Below the threshold the cost of sending the partitions outweighs the work,
+    and they are expanded serially.
+    """
+    if workers < 2 or len(recurrences) < threshold:
+        return [
+            occurrence_dates(*recurrence, window_start, window_end)
+            for recurrence in recurrences
+        ]
+
+    size = -(-len(recurrences) // workers)
+    partitions = [recurrences[i:i + size] for i in range(0, len(recurrences), size)]
+    results = _process_pool(workers).map(
+        _expand_partition, partitions, [window_start] * len(partitions), [window_end] * len(partitions))
+
+    occurrences = []
+    for dates, counts in results:
+        occurrences += np.split(dates, np.cumsum(counts)[:-1])
+
+    return occurrences
+
+
+def _expand_partition(recurrences, window_start, window_end) -> tuple:
+    """
+    Returns the occurrences of a partition of recurrences as one array, and the number of
+    occurrences of each recurrence.
+    """
+    occurrences = [
+        occurrence_dates(*recurrence, window_start, window_end)
+        for recurrence in recurrences
+    ]
+
+    return (
+        np.concatenate([np.array([], dtype="datetime64[D]")] + occurrences),
+        np.array([len(dates) for dates in occurrences], dtype=np.int64),
+    )
+
+
+class OccurrenceCache:
+    """
+    This class caches the occurrence dates of each rule, so that rules that have not changed are not
+    expanded again on every budget request.
+
+    Entries are keyed by the rule id and its recurrence, the tuple of Rule.get_recurrence, and hold
+    the dates of one contiguous window. A window inside the cached one is a slice, a window that
+    overlaps it only expands the missing days before or after it and extends the entry. Because the
+    recurrence is part of the key, a rule changed by another process never hits a stale entry, the
+    signals in signals.py only free the memory held by the old entries. At most maxsize entries,
+    the most recently used, are kept.
+
+    Example usage:
+
+    # Get the cached dates of a rule, None when they have to be expanded
+    dates = occurrence_cache.get(rule.id, rule.get_recurrence(), window_start, window_end)
+
+    # Cache the expanded dates of a rule
+    occurrence_cache.put(rule.id, rule.get_recurrence(), window_start, window_end, dates)
+
+    # Drop the cached dates of rules
+    occurrence_cache.invalidate(rule.id, other_rule.id)
+
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, rule_id, recurrence, window_start, window_end):
+        """
+        Returns the occurrence dates of the rule between window_start and window_end, inclusive,
+        or None when no cached window overlaps them.
+        """
+        window_start = np.datetime64(window_start, "D")
+        window_end = np.datetime64(window_end, "D")
+
+        with self._lock:
+            entry = self._entries.get((rule_id, recurrence))
+
+        if entry is None:
+            return None
+
+        start, end, dates = entry
+
+        # disjoint windows are not worth joining, the caller expands the requested one
+        if window_end < start - 1 or window_start > end + 1:
+            return None
+
+        if window_start < start:
+            dates = np.concatenate([occurrence_dates(*recurrence, window_start, start - 1), dates])
+        if window_end > end:
+            dates = np.concatenate([dates, occurrence_dates(*recurrence, end + 1, window_end)])
+        if window_start < start or window_end > end:
+            self.put(rule_id, recurrence, min(start, window_start), max(end, window_end), dates)
+
+        return dates[np.searchsorted(dates, window_start):np.searchsorted(dates, window_end, side="right")]
+
+    def put(self, rule_id, recurrence, window_start, window_end, dates) -> None:
+        """
+        Caches the occurrence dates of the rule between window_start and window_end, inclusive.
+        """
+        # the dates are shared by every ledger that reads them
+        dates.flags.writeable = False
+
+        key = (rule_id, recurrence)
+        entry = (np.datetime64(window_start, "D"), np.datetime64(window_end, "D"), dates)
+
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *rule_ids) -> None:
+        """
+        Drops every cached entry of the rules.
+        """
+        rule_ids = set(rule_ids)
+
+        with self._lock:
+            for key in [key for key in self._entries if key[0] in rule_ids]:
+                del self._entries[key]
+
+    def clear(self) -> None:
+        """
+        Drops every cached entry.
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+occurrence_cache = OccurrenceCache()
+
+
+_process_pools = {}
+_process_pools_lock = Lock()
+
+
+def _process_pool(workers) -> ProcessPoolExecutor:
+    """
+    Returns the process pool with `workers` processes, created on first use. Workers are spawned
+    rather than forked, so they do not inherit the server's threads and database connections,
+    and only import this module.
+    """
+    with _process_pools_lock:
+        if workers not in _process_pools:
+            _process_pools[workers] = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+        return _process_pools[workers]
+
+
+def _bounds(start_date, end_date, window_start, window_end) -> tuple:
+    """
+    Returns the first and last dates of the window that the rule can occur on.
+    """
+    lo = max(np.datetime64(start_date, "D"), np.datetime64(window_start, "D"))
+    hi = np.datetime64(window_end, "D")
+
+    if end_date is not None:
+        hi = min(hi, np.datetime64(end_date, "D"))
+
+    return lo, hi
+
+
+def _first_weekly(start_date, weekday, step, lo):
+    """
+    Returns the first occurrence of a Weekly (step 7) or Biweekly (step 14) rule on or after lo.
+    """
+    start_date = np.datetime64(start_date, "D")
+
+    # 1970-01-01 is a Thursday
+    monday = start_date - (start_date.astype(np.int64) + 3) % 7
+    first = monday + WEEKDAYS[weekday]
+    if first < start_date:
+        first += step
+
+    if lo > first:
+        first += -(-(lo - first).astype(np.int64) // step) * step
+
+    return first
+
+
+def _days_of_months(months, day, lo, hi):
+    """
+    Returns day of each month between lo and hi, skipping months that do not have that day.
+    """
+    dates = months.astype("datetime64[D]") + (day - 1)
+    in_month = dates.astype("datetime64[M]") == months
+
+    return dates[in_month & (dates >= lo) & (dates <= hi)]
+
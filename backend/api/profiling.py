@@ -0,0 +1,206 @@
+import cProfile
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from pathlib import Path
+from threading import Lock
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+
+logger = logging.getLogger(__name__)
+
+_profile = ContextVar("profile", default=None)
+
+
+class RequestProfile:
+    """
+    This class collects the timings of one request: the number of queries, the time spent in SQL,
+    and the total time of each named span.
+
+    Example usage:
+
+    # Timing a phase of the current request, does nothing when the request is not profiled
+    with span("build"):
+        ...
+
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.sql_seconds = 0.0
+        self.spans = {}
+        self.seconds = 0.0
+
+    def add(self, name, seconds) -> None:
+        """
+        Adds seconds to a span, spans entered more than once are summed.
+        """
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def execute(self, execute, sql, params, many, context):
+        """
+        Database execute wrapper, counts the queries and times them.
+        """
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.sql_seconds += time.perf_counter() - start
+
+    def server_timing(self) -> str:
+        """
+        Returns the Server-Timing header value, durations are in milliseconds.
+        """
+        metrics = [f'sql;dur={self.sql_seconds * 1000:.2f};desc="{self.queries} queries"']
+        metrics += [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.spans.items()]
+        metrics.append(f"total;dur={self.seconds * 1000:.2f}")
+
+        return ", ".join(metrics)
+
+
+@contextmanager
+def span(name):
+    """
+    Times the enclosed block as a span of the current request's profile.
+    """
+    profile = _profile.get()
+
+    if profile is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - start)
+
+
+class ProfileStats:
+    """
+    This class aggregates the request profiles of each view since the process started.
+    """
+
+    def __init__(self):
+        self._views = {}
+        self._lock = Lock()
+
+    def record(self, view, profile) -> None:
+        with self._lock:
+            stats = self._views.setdefault(view, {
+                "requests": 0,
+                "seconds": 0.0,
+                "max_seconds": 0.0,
+                "queries": 0,
+                "sql_seconds": 0.0,
+                "spans": {},
+            })
+            stats["requests"] += 1
+            stats["seconds"] += profile.seconds
+            stats["max_seconds"] = max(stats["max_seconds"], profile.seconds)
+            stats["queries"] += profile.queries
+            stats["sql_seconds"] += profile.sql_seconds
+            for name, seconds in profile.spans.items():
+                stats["spans"][name] = stats["spans"].get(name, 0.0) + seconds
+
+    def summary(self) -> dict:
+        """
+        Returns the number of requests of each view and their mean timings, in milliseconds.
+        """
+        with self._lock:
+            return {
+                view: {
+                    "requests": stats["requests"],
+                    "mean_ms": stats["seconds"] * 1000 / stats["requests"],
+                    "max_ms": stats["max_seconds"] * 1000,
+                    "mean_queries": stats["queries"] / stats["requests"],
+                    "mean_sql_ms": stats["sql_seconds"] * 1000 / stats["requests"],
+                    "mean_spans_ms": {
+                        name: seconds * 1000 / stats["requests"]
+                        for name, seconds in stats["spans"].items()
+                    },
+                }
+                for view, stats in self._views.items()
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._views.clear()
+
+
+stats = ProfileStats()
+
+
+class ProfilingMiddleware:
+    """
+    Profiles every request when settings.API_PROFILING is True, and is removed otherwise.
+
+    - The query count, SQL time, the spans entered during the request and the total time are
+      returned in a Server-Timing header, logged to the api.profiling logger, and aggregated
+      per view in `stats`, see ProfilingStatsView.
+    - Rendering is timed as the render span. Streamed responses are rendered after the headers
+      are sent, so their rendering is not included.
+    - With ?profile=1 the request also runs under cProfile, the stats are dumped to
+      settings.API_PROFILING_DIR and the file name is returned in an X-Profile header.
+    """
+
+    def __init__(self, get_response):
+        if not getattr(settings, "API_PROFILING", False):
+            raise MiddlewareNotUsed
+
+        self.get_response = get_response
+
+    def __call__(self, request):
+        profile = RequestProfile()
+        token = _profile.set(profile)
+        start = time.perf_counter()
+
+        try:
+            with connection.execute_wrapper(profile.execute):
+                if request.GET.get("profile"):
+                    response = self.run_profiler(request)
+                else:
+                    response = self.get_response(request)
+        finally:
+            _profile.reset(token)
+
+        profile.seconds = time.perf_counter() - start
+
+        response["Server-Timing"] = profile.server_timing()
+        response["Timing-Allow-Origin"] = "*"
+
+        view = request.resolver_match.view_name if request.resolver_match else request.path
+        stats.record(f"{request.method} {view}", profile)
+        logger.info("%s %s %s", request.method, request.get_full_path(), response["Server-Timing"])
+
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF responses are rendered after this hook, the callback runs once rendering is done
+        profile = _profile.get()
+
+        if profile is not None:
+            start = time.perf_counter()
+            response.add_post_render_callback(lambda _: profile.add("render", time.perf_counter() - start))
+
+        return response
+
+    def run_profiler(self, request):
+        profiler = cProfile.Profile()
+        response = profiler.runcall(self.get_response, request)
+
+        directory = Path(settings.API_PROFILING_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        now = time.time()
+        name = "{}{:03d}-{}.prof".format(
+            time.strftime("%Y%m%d-%H%M%S", time.localtime(now)), int(now * 1000) % 1000,
+            request.path.strip("/").replace("/", "-") or "root")
+        profiler.dump_stats(directory / name)
+
+        response["X-Profile"] = name
+        return response
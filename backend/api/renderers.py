@@ -0,0 +1,107 @@
+import datetime
+import math
+from decimal import Decimal
+
+import msgpack
+import numpy as np
+import orjson
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class ORJSONRenderer(JSONRenderer):
+    """
+    Renders JSON with orjson, which encodes dicts, lists, strings, numbers, dates and numpy arrays
+    natively instead of in Python. The output parses to the same data as that of JSONRenderer:
+    compact, UTF-8, Decimals as floats and dates as YYYY-MM-DD. Other types go through the DRF
+    encoder, and an indented response is rendered by JSONRenderer.
+
+    It is not byte for byte the same. orjson formats some floats differently, e.g. 1e16 where
+    JSONRenderer writes 1e+16, and it writes null for non-finite floats where JSONRenderer raises.
+    Decimals out of the float range raise ValueError as in JSONRenderer, and U+2028 and U+2029
+    are escaped as JSONRenderer does, so the output can be embedded in JavaScript.
+    """
+    options = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_UTC_Z
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+
+        renderer_context = renderer_context or {}
+        if self.get_indent(accepted_media_type, renderer_context):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        # orjson raises its own TypeError for any error of default, keep the ValueError of encode
+        errors = []
+
+        def encode(obj):
+            try:
+                return self.encode(obj)
+            except ValueError as e:
+                errors.append(e)
+                raise
+
+        try:
+            content = orjson.dumps(data, default=encode, option=self.options)
+        except orjson.JSONEncodeError:
+            if errors:
+                raise errors[0] from None
+            raise
+
+        # the line separators only appear in strings, replace returns content itself when there are none
+        return content.replace(b"\xe2\x80\xa8", b"\\u2028").replace(b"\xe2\x80\xa9", b"\\u2029")
+
+    @staticmethod
+    def encode(obj):
+        if isinstance(obj, Decimal):
+            value = float(obj)
+            if not math.isfinite(value):
+                raise ValueError("Out of range float values are not JSON compliant")
+            return value
+        if isinstance(obj, np.ndarray):
+            # object arrays are not encoded natively
+            return obj.tolist()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        return JSONEncoder().default(obj)
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Renders newline delimited JSON, one line for each item of a list, or a single line otherwise.
+    Streaming views render their rows in batches with render() as they are produced.
+    """
+    media_type = "application/x-ndjson"
+    format = "ndjson"
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        rows = data if isinstance(data, list) else [data]
+        return b"".join(ORJSONRenderer().render(row) + b"\n" for row in rows)
+
+
+class MessagePackRenderer(BaseRenderer):
+    """
+    Renders MessagePack, a binary encoding of the same data as JSON. Decimals are encoded as
+    floats and dates as YYYY-MM-DD strings, as the JSON renderer does.
+    """
+    media_type = "application/msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+
+        return msgpack.packb(data, default=self.encode)
+
+    @staticmethod
+    def encode(obj):
+        if isinstance(obj, Decimal):
+            return float(obj)
+        if isinstance(obj, (datetime.date, datetime.time)):
+            return obj.isoformat()
+        if isinstance(obj, np.generic):
+            return obj.item()
+        raise TypeError(f"Object of type {type(obj).__name__} is not MessagePack serializable")
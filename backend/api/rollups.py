@@ -0,0 +1,161 @@
+import numpy as np
+from django.conf import settings
+from django.db.models import DecimalField, Sum
+from django.db.models.functions import TruncMonth, TruncWeek, TruncYear
+
+from .ledger import EMPTY_DATES, as_date, to_cents
+from .models import Category, BudgetEdit
+from .occurrences import expand
+from .profiling import span
+
+
+TRUNCATE = {
+    "week": TruncWeek,
+    "month": TruncMonth,
+    "year": TruncYear,
+}
+
+
+def period_starts(start_date, end_date, granularity):
+    """
+    Returns the first day of every week (starting Monday), month or year between start_date and
+    end_date, as datetime64[D], the first one being the period of start_date.
+    """
+    if granularity == "week":
+        # 1970-01-01 is a Thursday, the Monday of its week is 3 days earlier
+        first = start_date - (start_date.astype(np.int64) + 3) % 7
+        return np.arange(first, end_date + 1, 7, dtype="datetime64[D]")
+
+    unit = "M" if granularity == "month" else "Y"
+    return np.arange(
+        start_date.astype(f"datetime64[{unit}]"), end_date.astype(f"datetime64[{unit}]") + 1,
+        dtype=f"datetime64[{unit}]"
+    ).astype("datetime64[D]")
+
+
+class Rollup:
+    """
+    This class represents the budget projection between two dates aggregated by week, month or year,
+    as a period x group matrix of totals. The rows of the projection are never built:
+
+    - The budget edits are summed by the database, grouped by truncated date and category group.
+    - The rule occurrences are expanded and counted by period and category with numpy, leaving out
+      the occurrences replaced by a budget edit, and multiplied by the category's adjusted_amount.
+
+    Every period between the dates is returned, the first and last ones may be partial.
+
+    Attributes:
+    - dates (ndarray): The first day of each period, as datetime64[D].
+    - groups (list): Category groups, one per matrix column, in order of their first category.
+    - totals (ndarray): Int64 matrix of the total cents of each group in each period.
+    - opening_balance (int): The cents of the balance before the first period.
+
+    Example usage:
+
+    rollup = Rollup.build(start_date, end_date, "month")
+    closing_balances = rollup.balance()
+
+    """
+
+    def __init__(self, dates, groups, totals, opening_balance=0):
+        self.dates = dates
+        self.groups = groups
+        self.totals = totals
+        self.opening_balance = opening_balance
+
+    @classmethod
+    def build(cls, start_date, end_date, granularity, opening_balance=0):
+        """
+        Aggregates the budget between start_date and end_date by granularity, week, month or year.
+        The opening_balance is an amount, a Decimal, not cents.
+        """
+        start_date = np.datetime64(as_date(start_date), "D")
+        end_date = np.datetime64(as_date(end_date), "D")
+        dates = period_starts(start_date, end_date, granularity)
+
+        categories = list(Category.objects.select_related("rule").order_by("id"))
+        groups = list(dict.fromkeys(category.group for category in categories))
+        group_column = {group: g for g, group in enumerate(groups)}
+
+        totals = np.zeros((len(dates), len(groups)), dtype=np.int64)
+
+        edits = BudgetEdit.objects.filter(date__gte=start_date.item(), date__lte=end_date.item())
+
+        for period, group, total in (
+            edits
+            .annotate(period=TRUNCATE[granularity]("date"))
+            .values("period", "category__group")
+            .annotate(total=Sum(
+                "adjusted_amount", output_field=DecimalField(max_digits=15, decimal_places=2)))
+            .values_list("period", "category__group", "total")
+        ):
+            totals[np.searchsorted(dates, np.datetime64(period, "D"), side="right") - 1,
+                   group_column[group]] += int(total * 100)
+
+        rules = [j for j, category in enumerate(categories) if category.rule is not None]
+
+        with span("expand"):
+            occurrences = expand(
+                [categories[j].rule.get_recurrence() for j in rules],
+                start_date,
+                end_date,
+                workers=settings.LEDGER_EXPANSION_WORKERS,
+                threshold=settings.LEDGER_EXPANSION_THRESHOLD,
+            )
+
+        with span("build"):
+            occurrence_dates = np.concatenate([EMPTY_DATES] + occurrences)
+            occurrence_columns = np.repeat(np.array(rules, dtype=np.int64), [len(d) for d in occurrences])
+
+            # budget edits replace the occurrence of their category on their date
+            column = {category.id: j for j, category in enumerate(categories)}
+            edited = np.array([
+                column[category_id] * (1 << 32) + (date - start_date.item()).days
+                for category_id, date in edits.filter(category__rule__isnull=False).values_list(
+                    "category_id", "date")
+            ], dtype=np.int64)
+            offsets = (occurrence_dates - start_date).astype(np.int64)
+            kept = ~np.isin(occurrence_columns * (1 << 32) + offsets, edited)
+
+            periods = np.searchsorted(dates, occurrence_dates[kept], side="right") - 1
+            pairs, counts = np.unique(
+                periods * len(categories) + occurrence_columns[kept], return_counts=True)
+            periods, columns = np.divmod(pairs, max(len(categories), 1))
+
+            adjusted_amounts = to_cents([category.adjusted_amount for category in categories])
+            category_groups = np.array([group_column[category.group] for category in categories], dtype=np.int64)
+
+            np.add.at(totals, (periods, category_groups[columns]), adjusted_amounts[columns] * counts)
+
+        return cls(dates, groups, totals, int(opening_balance * 100))
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def slice(self, start, stop):
+        """
+        Returns the rollup of the periods from index start up to stop, with its opening balance.
+        """
+        start, stop, _ = slice(start, stop).indices(len(self))
+        stop = max(start, stop)
+        opening_balance = self.balance()[start - 1] if start > 0 else self.opening_balance
+
+        return Rollup(self.dates[start:stop], self.groups, self.totals[start:stop], opening_balance)
+
+    def group_totals(self) -> dict:
+        """
+        Returns a dictionary of group to an array of total cents for each period.
+        """
+        return {group: self.totals[:, g] for g, group in enumerate(self.groups)}
+
+    def row_totals(self):
+        """
+        Returns an array of the net flow of each period, in cents.
+        """
+        return self.totals.sum(axis=1, initial=0)
+
+    def balance(self):
+        """
+        Returns an array of the closing balance of each period, in cents.
+        """
+        return np.cumsum(self.row_totals()) + self.opening_balance
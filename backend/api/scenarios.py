@@ -0,0 +1,178 @@
+import numpy as np
+
+from .ledger import EMPTY_DATES, Ledger, as_date, to_cents
+from .models import BudgetEdit
+from .occurrences import occurrence_dates
+from .profiling import span
+
+
+class Scenario:
+    """
+    This class represents hypothetical changes to the budget. Scenarios are evaluated in memory
+    by ScenarioMatrix, nothing is saved.
+
+    Attributes:
+    - name (str): The name of the scenario.
+    - amounts (dict): Category id to (adjusted_amount, start_date), the new adjusted amount of the
+                      category's occurrences from start_date on, or all of them when it is None.
+    - rules (dict): Category id to the recurrence tuple of its new rule, as returned by
+                    Rule.get_recurrence, or None to remove the category's rule.
+    - budget_edits (dict): (category id, date) to the adjusted amount of a one-off budget edit,
+                           or None to remove the budget edit on that date.
+
+    Example usage:
+
+    # Rent goes up by $200 from March
+    scenario = Scenario("rent", amounts={rent.id: (Decimal("-1700.00"), date(2024, 3, 1))})
+
+    """
+
+    def __init__(self, name, amounts=None, rules=None, budget_edits=None):
+        self.name = name
+        self.amounts = amounts or {}
+        self.rules = rules or {}
+        self.budget_edits = budget_edits or {}
+
+    @property
+    def category_ids(self) -> set:
+        """
+        Returns the ids of the categories changed by the scenario.
+        """
+        return {*self.amounts, *self.rules, *(category_id for category_id, _ in self.budget_edits)}
+
+
+class ScenarioMatrix:
+    """
+    This class represents the projection of several scenarios between two dates as a date x scenario
+    matrix of row totals, the first column being the baseline, the budget as it is saved.
+
+    The baseline is a single Ledger, and a scenario only recomputes the categories it changes:
+    its column is the baseline minus the old amounts of those categories plus their new amounts,
+    so comparing many scenarios costs about one projection. The rows are the dates of every
+    scenario, a scenario's total is 0 on the dates where it has no occurrence.
+
+    Attributes:
+    - dates (ndarray): Sorted unique dates of all scenarios, as datetime64[D].
+    - names (list): The name of each column, "baseline" first.
+    - row_totals (ndarray): Int64 matrix of the total cents of each date in each scenario.
+    - opening_balance (int): The cents of the balance before the first date.
+
+    Example usage:
+
+    matrix = ScenarioMatrix.build(start_date, end_date, [scenario])
+    baseline, rent = matrix.balance().T
+
+    """
+
+    def __init__(self, dates, names, row_totals, opening_balance=0):
+        self.dates = dates
+        self.names = names
+        self.row_totals = row_totals
+        self.opening_balance = opening_balance
+
+    @classmethod
+    def build(cls, start_date, end_date, scenarios, opening_balance=0):
+        """
+        Builds the baseline ledger between start_date and end_date, loads the budget edits of the
+        changed categories, and returns the matrix of the baseline and each scenario.
+        The opening_balance is an amount, a Decimal, not cents.
+        """
+        ledger = Ledger.build(start_date, end_date, opening_balance)
+        start_date = np.datetime64(as_date(start_date), "D")
+        end_date = np.datetime64(as_date(end_date), "D")
+
+        column = {category.id: j for j, category in enumerate(ledger.categories)}
+        changed = set().union(*(scenario.category_ids for scenario in scenarios))
+
+        budget_edits = {}
+        for category_id, date, adjusted_amount in BudgetEdit.objects.filter(
+                category_id__in=changed, date__gte=start_date.item(), date__lte=end_date.item()
+        ).values_list("category_id", "date", "adjusted_amount"):
+            budget_edits.setdefault(category_id, {})[np.datetime64(date, "D")] = adjusted_amount
+
+        with span("scenarios"):
+            # the new occurrences and amounts of each changed category, per scenario
+            columns = [
+                [
+                    cls._column(ledger.categories[column[category_id]], scenario,
+                                budget_edits.get(category_id, {}), start_date, end_date)
+                    for category_id in sorted(scenario.category_ids)
+                ]
+                for scenario in scenarios
+            ]
+
+            dates = np.union1d(ledger.dates, np.concatenate(
+                [EMPTY_DATES] + [dates for scenario in columns for dates, _ in scenario]))
+            rows = np.searchsorted(dates, ledger.dates)
+
+            row_totals = np.zeros((len(dates), len(scenarios) + 1), dtype=np.int64)
+            row_totals[rows, 0] = ledger.row_totals()
+
+            for i, (scenario, scenario_columns) in enumerate(zip(scenarios, columns), start=1):
+                row_totals[:, i] = row_totals[:, 0]
+
+                old = [column[category_id] for category_id in scenario.category_ids]
+                row_totals[rows, i] -= ledger.amounts[:, old].sum(axis=1, initial=0)
+
+                for category_dates, amounts in scenario_columns:
+                    np.add.at(row_totals[:, i], np.searchsorted(dates, category_dates), amounts)
+
+        return cls(dates, ["baseline"] + [scenario.name for scenario in scenarios], row_totals,
+                   ledger.opening_balance)
+
+    @staticmethod
+    def _column(category, scenario, budget_edits, start_date, end_date) -> tuple:
+        """
+        Returns the dates and cents of a category with the changes of a scenario applied:
+        its rule occurrences at its adjusted amount, overridden by its budget edits.
+        """
+        if category.id in scenario.rules:
+            recurrence = scenario.rules[category.id]
+        else:
+            recurrence = category.rule.get_recurrence() if category.rule is not None else None
+
+        occurrences = EMPTY_DATES if recurrence is None else occurrence_dates(*recurrence, start_date, end_date)
+
+        amounts = np.full(len(occurrences), to_cents([category.adjusted_amount])[0], dtype=np.int64)
+        if category.id in scenario.amounts:
+            adjusted_amount, amount_start_date = scenario.amounts[category.id]
+            if amount_start_date is None:
+                amounts[:] = to_cents([adjusted_amount])[0]
+            else:
+                amounts[occurrences >= np.datetime64(amount_start_date, "D")] = to_cents([adjusted_amount])[0]
+
+        budget_edits = dict(budget_edits)
+        for (category_id, date), adjusted_amount in scenario.budget_edits.items():
+            date = np.datetime64(date, "D")
+            if category_id == category.id and start_date <= date <= end_date:
+                budget_edits[date] = adjusted_amount
+
+        budget_edits = {date: amount for date, amount in budget_edits.items() if amount is not None}
+
+        # budget edits override the occurrence on their date
+        edit_dates = np.array(sorted(budget_edits), dtype="datetime64[D]")
+        keep = ~np.isin(occurrences, edit_dates)
+        edit_amounts = to_cents([budget_edits[date] for date in edit_dates])
+
+        return (np.concatenate([occurrences[keep], edit_dates]),
+                np.concatenate([amounts[keep], edit_amounts]))
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    def balance(self):
+        """
+        Returns the matrix of the opening balance plus the cumulative sum of the row totals,
+        one column per scenario, in cents.
+        """
+        return np.cumsum(self.row_totals, axis=0) + self.opening_balance
+
+    @property
+    def closing_balance(self):
+        """
+        Returns the cents of the balance after the last date of each scenario.
+        """
+        if not len(self.dates):
+            return np.full(len(self.names), self.opening_balance, dtype=np.int64)
+
+        return self.balance()[-1]
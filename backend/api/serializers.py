@@ -1,5 +1,7 @@
+import numpy as np
 from rest_framework import serializers
 
+from .ledger import to_decimals
 from .models import Rule, Category, BudgetEdit
 
 
@@ -15,75 +17,189 @@ class CategorySerializer(serializers.ModelSerializer):
         fields = "__all__"
 
 
+class CategoryRuleSerializer(serializers.ModelSerializer):
+    # embed the rule, categories should be fetched with select_related("rule")
+    rule = RuleSerializer(read_only=True)
+    repeat = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Category
+        fields = ["id", "name", "amount", "adjusted_amount", "group", "rule", "repeat"]
+
+    def get_repeat(self, instance):
+        return "Yes" if instance.rule is not None else "No"
+
+
 class BudgetSerializer(serializers.Serializer):
-    # serialize pandas dataframe
+    """
+    Serializes the rows of a Ledger straight from its arrays, without building a dataframe:
+
+    date: date of the row
+    categories: the categories that occurred on the date
+    budget_edits: the budget edits on the date, with their category
+    group_totals: dictionary of group totals for the date
+    row_total: total amount for the date
+    balance: balance after the date
+
+    The amounts of the ledger are cents, they are returned as Decimals.
+    """
     dataframe = serializers.SerializerMethodField()
 
     def get_dataframe(self, instance):
-        # convert dataframe occurence column to date string format YYYY-MM-DD
-        instance["date"] = instance["date"].map(
-            lambda x: x.strftime("%Y-%m-%d"))
-
-        # convert categories and budget_edits to nested objects
-        data = instance.to_dict(orient="records")
-        for row in data:
-
-            row["categories"] = map(
-                lambda category: CategorySerializer(
-                    Category.objects.get(name=category)).data,
-                row["categories"]
+        # the dates are formatted as YYYY-MM-DD at once
+        dates = np.datetime_as_string(instance.dates, unit="D").tolist()
+
+        # the ids of a MappedLedger are read from its arrays, once
+        edit_ids = list(instance.edit_ids)
+
+        # fetch every referenced budget_edit once, their categories are the ledger's
+        budget_edits = BudgetEdit.objects.in_bulk(
+            {budget_edit for row in edit_ids for budget_edit in row})
+        columns = {category.id: j for j, category in enumerate(instance.categories)}
+        referenced = set(np.flatnonzero(instance.occurs.any(axis=0)).tolist()) | {
+            columns[budget_edit.category_id] for budget_edit in budget_edits.values()}
+
+        # serialize each category once, rows and budget_edits share the same dicts
+        referenced = sorted(referenced)
+        categories_data = dict(zip(
+            referenced,
+            CategorySerializer([instance.categories[j] for j in referenced], many=True).data
+        ))
+        budget_edits_data = {
+            budget_edit.id: {
+                **budget_edit_data,
+                "category": categories_data[columns[budget_edit.category_id]]
+            }
+            for budget_edit, budget_edit_data in zip(
+                budget_edits.values(),
+                BudgetEditAmountSerializer(budget_edits.values(), many=True).data
             )
-
-            row["budget_edits"] = map(
-                lambda budget_edit: BudgetEditSerializer(
-                    BudgetEdit.objects.get(id=budget_edit)).data,
-                row["budget_edits"])
-
-
-            # row["budget_edits"] = map(
-            #     lambda budget_edit: BudgetEditSerializer(
-            #         BudgetEdit.objects.get(id=budget_edit["id"])).data,
-            #     BudgetEdit.objects.filter(date=row["date"]).values())
-
-        # update group_totals, row_total, and balance by replacing category
-        # adjusted_amounts with their respective budget_edits adjusted_amounts
-        # change only rows with budget_edits
-        
-
-
-        #     print(data[data.index(row)])
-        #     row["group_totals"] = {
-        #         group: 0
-        #         for group in ["Fixed", "Variable", "Discretionary", "Income", "Savings"]
-        #     }
-        #     for category in row["categories"]:
-        #         for budget_edit in row["budget_edits"]:
-        #             if category["id"] == budget_edit["category"]["id"]:
-        #                 category["adjusted_amount"] = budget_edit["adjusted_amount"]
-
-
-        #     row["group_totals"] = {
-        #         group: sum(map(
-        #             lambda category:
-        #             category["adjusted_amount"],
-        #             filter(lambda category: category["group"] == group, row["categories"])))
-        #         for group in ["Fixed", "Variable", "Discretionary", "Income", "Savings"]
-        #     }
-            
-
-        # for row in data:
-        #     row["group_totals"] = {
-        #         group: sum(map(
-        #             lambda category:
-        #             category["adjusted_amount"],
-        #             filter(lambda category: category["group"] == group, row["categories"])))
-        #         for group in ["Fixed", "Variable", "Discretionary", "Income", "Savings"]
-        #     }
-        #     row["row_total"] = sum(
-        #         map(lambda category: category["adjusted_amount"], row["categories"]))
-            # row["balance"] = row["row_total"] + row["group_totals"]["Income"]
-
-        return data
+        }
+
+        # a group total is the int 0 on the dates where none of the group's categories occurs or is
+        # edited, as the sums of the pandas implementation were, and a Decimal otherwise
+        group_of = np.array([category.group for category in instance.categories])
+        edited = [
+            {group_of[columns[budget_edits[budget_edit].category_id]] for budget_edit in budget_edit_ids}
+            for budget_edit_ids in edit_ids
+        ]
+        group_totals = {}
+        for group, totals in instance.group_totals().items():
+            occurred = instance.occurs[:, group_of == group].any(axis=1).tolist()
+            group_totals[group] = [
+                total if occurred[i] or group in edited[i] else 0
+                for i, total in enumerate(to_decimals(totals))
+            ]
+
+        return [
+            {
+                "date": date,
+                "categories": [categories_data[j] for j in np.flatnonzero(occurs).tolist()],
+                "budget_edits": [budget_edits_data[budget_edit] for budget_edit in budget_edit_ids],
+                "group_totals": {group: totals[i] for group, totals in group_totals.items()},
+                "row_total": row_total,
+                "balance": balance,
+            }
+            for i, (date, occurs, budget_edit_ids, row_total, balance) in enumerate(zip(
+                dates,
+                instance.occurs,
+                edit_ids,
+                to_decimals(instance.row_totals()),
+                to_decimals(instance.balance()),
+            ))
+        ]
+
+
+class BudgetColumnarSerializer(serializers.Serializer):
+    """
+    Serializes a Ledger as columns instead of rows. Every category and budget edit is serialized
+    once, in the categories and budget_edits tables, and the rows refer to them by id:
+
+    categories: the categories of the ledger
+    budget_edits: the budget edits of the ledger, with the id of their category
+    date: date of each row
+    category_ids: list of the ids of the categories that occurred on each date
+    budget_edit_ids: list of the ids of the budget edits on each date
+    group_totals: dictionary of group to the totals of each date
+    row_total: total amount of each date
+    balance: balance after each date
+
+    The amounts of the ledger are cents, they are returned as Decimals.
+    """
+
+    def to_representation(self, instance):
+        edit_ids = list(instance.edit_ids)
+        ids = [budget_edit for budget_edit_ids in edit_ids for budget_edit in budget_edit_ids]
+        budget_edits = BudgetEdit.objects.in_bulk(ids).values()
+        category_ids = np.array([category.id for category in instance.categories])
+
+        return {
+            "categories": CategorySerializer(instance.categories, many=True).data,
+            "budget_edits": [
+                {**budget_edit_data, "category": budget_edit.category_id}
+                for budget_edit, budget_edit_data in zip(
+                    budget_edits,
+                    BudgetEditAmountSerializer(budget_edits, many=True).data
+                )
+            ],
+            "date": np.datetime_as_string(instance.dates, unit="D").tolist(),
+            "category_ids": [category_ids[row].tolist() for row in instance.occurs],
+            "budget_edit_ids": edit_ids,
+            "group_totals": {group: to_decimals(totals) for group, totals in instance.group_totals().items()},
+            "row_total": to_decimals(instance.row_totals()),
+            "balance": to_decimals(instance.balance()),
+        }
+
+
+class BudgetRollupSerializer(serializers.Serializer):
+    """
+    Serializes a Rollup as one row per period, with the first day of the period as its date:
+
+    date: first day of the period
+    group_totals: dictionary of group totals for the period
+    row_total: net flow of the period
+    balance: balance at the end of the period
+    """
+
+    def to_representation(self, instance):
+        group_totals = {group: to_decimals(totals) for group, totals in instance.group_totals().items()}
+
+        return {
+            "dataframe": [
+                {
+                    "date": date,
+                    "group_totals": {group: totals[i] for group, totals in group_totals.items()},
+                    "row_total": row_total,
+                    "balance": balance,
+                }
+                for i, (date, row_total, balance) in enumerate(zip(
+                    np.datetime_as_string(instance.dates, unit="D").tolist(),
+                    to_decimals(instance.row_totals()),
+                    to_decimals(instance.balance()),
+                ))
+            ]
+        }
+
+
+class BudgetRollupColumnarSerializer(serializers.Serializer):
+    """
+    Serializes a Rollup as columns, see BudgetRollupSerializer for their meaning.
+    """
+
+    def to_representation(self, instance):
+        return {
+            "date": np.datetime_as_string(instance.dates, unit="D").tolist(),
+            "group_totals": {group: to_decimals(totals) for group, totals in instance.group_totals().items()},
+            "row_total": to_decimals(instance.row_totals()),
+            "balance": to_decimals(instance.balance()),
+        }
+
+
+class BudgetEditAmountSerializer(serializers.ModelSerializer):
+    # BudgetEditSerializer without the nested category, BudgetSerializer adds it from its own map
+    class Meta:
+        model = BudgetEdit
+        exclude = ["category"]
 
 
 class BudgetEditSerializer(serializers.ModelSerializer):
@@ -1,6 +1,8 @@
-from django.db.models.signals import pre_delete, post_save
+from django.db.models import DateField, Min
+from django.db.models.signals import pre_delete, pre_save, post_save, post_delete
 from django.dispatch import receiver
-from .models import Category, Rule, BudgetEdit
+from .models import Category, Rule, BudgetEdit, BalanceSnapshot, DataVersion
+from .occurrences import occurrence_cache
 
 @receiver(pre_delete, sender=Category)
 def delete_rule_on_delete_category(sender, instance, **kwargs):
@@ -8,11 +10,67 @@ def delete_rule_on_delete_category(sender, instance, **kwargs):
     if rule is not None:
         rule.delete()
 
+@receiver(pre_save, sender=Category)
+def remember_rule_on_update_category(sender, instance, **kwargs):
+    instance._previous_rule_id = Category.objects.filter(pk=instance.pk).values_list(
+        "rule_id", flat=True).first() if instance.pk is not None else None
+
+# only the rule detached by this save is deleted, rules orphaned some other way are deleted
+# by the delete_orphan_rules command
 @receiver(post_save, sender=Category)
 def delete_rule_on_update_category(sender, instance, **kwargs):
-    categoryless_rules = Rule.objects.filter(category=None)
-    for rule in categoryless_rules:
-        rule.delete()
+    previous_rule_id = getattr(instance, "_previous_rule_id", None)
+    if previous_rule_id is not None and previous_rule_id != instance.rule_id:
+        Rule.objects.filter(id=previous_rule_id, category=None).delete()
+
+# cached responses are keyed by the data version, see caching.py. Receivers run in the order
+# they are connected, the version is bumped before the snapshots are invalidated so that a
+# snapshot computed before the change is either deleted or not saved, see Ledger.checkpoint
+@receiver([post_save, post_delete], sender=Rule)
+@receiver([post_save, post_delete], sender=Category)
+@receiver([post_save, post_delete], sender=BudgetEdit)
+def bump_data_version_on_change(sender, instance, **kwargs):
+    DataVersion.bump()
+
+# the cache is keyed by the rule's fields, so a changed rule never reads stale dates, this only
+# frees the memory of its old entries
+@receiver([post_save, post_delete], sender=Rule)
+def invalidate_occurrences_on_change_rule(sender, instance, **kwargs):
+    occurrence_cache.invalidate(instance.id)
+
+# snapshots include every row before their date, so a change on a date deletes the later snapshots,
+# and a change that moves a date deletes them from the earlier of the two dates
+def invalidate_snapshots(*dates):
+    dates = [DateField().to_python(date) for date in dates if date is not None]
+    if dates:
+        BalanceSnapshot.invalidate(min(dates))
+
+@receiver(pre_save, sender=Rule)
+def remember_start_date_on_update_rule(sender, instance, **kwargs):
+    instance._previous_date = Rule.objects.filter(pk=instance.pk).values_list(
+        "start_date", flat=True).first() if instance.pk is not None else None
+
+@receiver(pre_save, sender=BudgetEdit)
+def remember_date_on_update_budget_edit(sender, instance, **kwargs):
+    instance._previous_date = BudgetEdit.objects.filter(pk=instance.pk).values_list(
+        "date", flat=True).first() if instance.pk is not None else None
+
+@receiver([post_save, post_delete], sender=Rule)
+def invalidate_snapshots_on_change_rule(sender, instance, **kwargs):
+    invalidate_snapshots(instance.start_date, getattr(instance, "_previous_date", None))
+
+@receiver([post_save, post_delete], sender=BudgetEdit)
+def invalidate_snapshots_on_change_budget_edit(sender, instance, **kwargs):
+    invalidate_snapshots(instance.date, getattr(instance, "_previous_date", None))
+
+@receiver(post_save, sender=Category)
+def invalidate_snapshots_on_update_category(sender, instance, **kwargs):
+    # the amount changes the rule occurrences, the group moves the edits between group totals.
+    # deleted categories delete their rule and edits, which invalidate the snapshots
+    invalidate_snapshots(
+        instance.rule.start_date if instance.rule is not None else None,
+        instance.edits.aggregate(date=Min("date"))["date"],
+    )
 
 # TODO: clean up any $0 budget_edits for categories with rules but have dates other than their rule occurnces
 #     (i.e. if a rule is set to occur on the 1st of every month, but the category has a budget_edit for the 15th of the month,
@@ -0,0 +1,83 @@
+import random
+from datetime import timedelta
+from decimal import Decimal
+
+from .models import Rule, Category, BudgetEdit, BalanceSnapshot, DataVersion
+
+
+GROUPS = [group for group, _ in Category._meta.get_field("group").choices]
+WEEKDAYS = [weekday for weekday, _ in Rule._meta.get_field("weekday").choices]
+
+# most categories repeat monthly, daily rules end after a few weeks
+FREQUENCIES = ["Monthly"] * 4 + ["Weekly"] * 2 + ["Biweekly"] * 2 + ["Yearly", "Daily"]
+
+
+def generate_budget_data(category_count, edit_count, start_date, years, seed=0) -> list:
+    """
+    Creates category_count categories spread over the five groups, nine in ten with a rule of one of
+    the five frequencies, and edit_count budget edits on random dates of the first `years` years.
+    Rows are bulk created, so adjusted amounts are computed here and no signals are sent, the data
+    version is bumped and the snapshots from start_date are invalidated here instead.
+    Returns the categories.
+    """
+    rnd = random.Random(seed)
+    days = int(years * 365)
+
+    rules = []
+    categories = []
+
+    for i in range(category_count):
+        group = GROUPS[i % len(GROUPS)]
+        amount = Decimal(rnd.randint(100, 500_000)) / 100
+        rule = None
+
+        if i % 10:
+            frequency = FREQUENCIES[i % len(FREQUENCIES)]
+            rule_start_date = start_date + timedelta(days=rnd.randint(0, 27))
+            rule = Rule(
+                frequency=frequency,
+                start_date=rule_start_date,
+                end_date=rule_start_date + timedelta(days=rnd.randint(30, 90)) if frequency == "Daily" else None,
+                weekday=rnd.choice(WEEKDAYS) if frequency in ["Weekly", "Biweekly"] else None,
+                day_of_month=rnd.randint(1, 31) if frequency in ["Monthly", "Yearly"] else None,
+                month_of_year=rnd.randint(1, 12) if frequency == "Yearly" else None,
+            )
+            rules.append(rule)
+
+        categories.append(Category(
+            name=f"Category {i}",
+            amount=amount,
+            adjusted_amount=amount if group == "Income" else -amount,
+            group=group,
+            rule=rule,
+        ))
+
+    Rule.objects.bulk_create(rules)
+    Category.objects.bulk_create(categories)
+
+    keys = set()
+    edits = []
+
+    while len(edits) < min(edit_count, category_count * days):
+        category = rnd.choice(categories)
+        date = start_date + timedelta(days=rnd.randrange(days))
+
+        if (category.id, date) in keys:
+            continue
+
+        keys.add((category.id, date))
+        amount = Decimal(rnd.randint(0, 500_000)) / 100
+        edits.append(BudgetEdit(
+            category=category,
+            date=date,
+            amount=amount,
+            adjusted_amount=amount if category.group == "Income" else -amount,
+        ))
+
+    BudgetEdit.objects.bulk_create(edits, batch_size=10_000)
+
+    # every row is on or after start_date
+    DataVersion.bump()
+    BalanceSnapshot.invalidate(start_date)
+
+    return categories
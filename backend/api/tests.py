@@ -1,3 +1,1324 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import pstats
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+from decimal import Decimal
+from datetime import date, datetime, time, timedelta
 
-# Create your tests here.
+import json
+from unittest import mock
+
+import msgpack
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from asgiref.sync import sync_to_async
+from django.test import AsyncClient, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from .concurrency import InFlight, call_view
+from .ledger import Ledger
+from .mapped import MappedLedger
+from .models import Rule, Category, BudgetEdit, BalanceSnapshot, DataVersion
+from .occurrences import OccurrenceCache, expand, occurrence_cache, occurrence_dates
+from .profiling import stats as profiling_stats
+from .renderers import ORJSONRenderer
+from .synthetic import generate_budget_data
+from .views import BudgetView
+
+
+class OccurrenceDatesTests(SimpleTestCase):
+    """
+    Parity of the closed-form Rule.get_occurrence_dates with the rrule from Rule.get_rrule.
+    """
+    weekdays = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+    def assertParity(self, rule, start_date, end_date):
+        expected = np.array([
+            occurrence.date()
+            for occurrence in rule.get_rrule().between(
+                datetime.combine(start_date, time()), datetime.combine(end_date, time()), inc=True)
+        ], dtype="datetime64[D]")
+
+        actual = rule.get_occurrence_dates(start_date, end_date)
+
+        self.assertEqual(actual.dtype, np.dtype("datetime64[D]"))
+        np.testing.assert_array_equal(
+            actual, expected, err_msg=f"{rule.__dict__} between {start_date} and {end_date}")
+
+    def random_rule(self, rnd, frequency):
+        start_date = date(2020, 1, 1) + timedelta(days=rnd.randint(0, 1500))
+        end_date = start_date + timedelta(days=rnd.randint(-5, 3000)) if rnd.random() < 0.5 else None
+
+        return Rule(
+            frequency=frequency,
+            start_date=start_date,
+            end_date=end_date,
+            weekday=rnd.choice(self.weekdays),
+            day_of_month=rnd.choice([rnd.randint(1, 31), 29, 30, 31]),
+            month_of_year=rnd.randint(1, 12),
+        )
+
+    def test_randomized_rules(self):
+        rnd = random.Random(0)
+
+        for frequency in ["Daily", "Weekly", "Biweekly", "Monthly", "Yearly"]:
+            with self.subTest(frequency=frequency):
+                for _ in range(200):
+                    rule = self.random_rule(rnd, frequency)
+                    start_date = date(2019, 1, 1) + timedelta(days=rnd.randint(0, 4000))
+                    end_date = start_date + timedelta(days=rnd.randint(-3, 3000))
+                    self.assertParity(rule, start_date, end_date)
+
+    def test_count_and_occurs_on(self):
+        rnd = random.Random(1)
+
+        for frequency in ["Daily", "Weekly", "Biweekly", "Monthly", "Yearly"]:
+            with self.subTest(frequency=frequency):
+                for _ in range(200):
+                    rule = self.random_rule(rnd, frequency)
+                    start_date = date(2019, 1, 1) + timedelta(days=rnd.randint(0, 4000))
+                    end_date = start_date + timedelta(days=rnd.randint(0, 3000))
+                    occurrences = rule.get_occurrence_dates(start_date, end_date)
+                    dates = np.arange(start_date, end_date + timedelta(days=1), dtype="datetime64[D]")
+
+                    self.assertEqual(rule.get_occurrence_count(start_date, end_date), len(occurrences))
+                    np.testing.assert_array_equal(dates[rule.occurs_on(dates)], occurrences)
+
+    def test_expand_in_process_pool(self):
+        rnd = random.Random(2)
+        recurrences = [
+            self.random_rule(rnd, frequency).get_recurrence()
+            for frequency in ["Daily", "Weekly", "Biweekly", "Monthly", "Yearly"] * 8
+        ]
+        window_start, window_end = np.datetime64("2020-06-01"), np.datetime64("2026-06-01")
+
+        serial = expand(recurrences, window_start, window_end)
+        parallel = expand(recurrences, window_start, window_end, workers=3, threshold=10)
+
+        self.assertEqual(len(parallel), len(recurrences))
+        for expected, actual in zip(serial, parallel):
+            np.testing.assert_array_equal(actual, expected)
+
+    def test_biweekly_weekday_before_start_date(self):
+        # 2023-10-04 is a Wednesday, the Monday of that week is before the start date
+        rule = Rule(frequency="Biweekly", start_date=date(2023, 10, 4), weekday="Monday")
+
+        self.assertEqual(rule.get_occurrence_dates(date(2023, 10, 1), date(2023, 10, 31))[0],
+                         np.datetime64("2023-10-16"))
+        self.assertParity(rule, date(2023, 10, 1), date(2024, 10, 1))
+
+    def test_day_of_month_missing_from_month(self):
+        rule = Rule(frequency="Monthly", start_date=date(2023, 1, 1), day_of_month=31)
+
+        self.assertEqual(len(rule.get_occurrence_dates(date(2023, 1, 1), date(2023, 12, 31))), 7)
+        self.assertParity(rule, date(2023, 1, 1), date(2023, 12, 31))
+
+        rule = Rule(frequency="Yearly", start_date=date(2023, 1, 1), day_of_month=29, month_of_year=2)
+
+        self.assertEqual(rule.get_occurrence_dates(date(2023, 1, 1), date(2030, 1, 1)).tolist(),
+                         [date(2024, 2, 29), date(2028, 2, 29)])
+        self.assertParity(rule, date(2023, 1, 1), date(2030, 1, 1))
+
+
+class OccurrenceCacheTests(TestCase):
+    """
+    The ledger reads rule occurrences from the cache, which extends its windows and is invalidated
+    when rules change.
+    """
+
+    def setUp(self):
+        cache.clear()
+        occurrence_cache.clear()
+
+    def test_windows(self):
+        occurrences = OccurrenceCache()
+        recurrence = ("Weekly", date(2023, 1, 2), None, "Friday", None, None)
+
+        def dates(start, end):
+            return occurrence_dates(*recurrence, np.datetime64(start), np.datetime64(end))
+
+        self.assertIsNone(occurrences.get(1, recurrence, "2023-03-01", "2023-06-30"))
+        occurrences.put(1, recurrence, "2023-03-01", "2023-06-30", dates("2023-03-01", "2023-06-30"))
+
+        for start, end in [("2023-04-01", "2023-04-30"), ("2023-01-01", "2023-12-31"), ("2023-07-01", "2024-03-31")]:
+            np.testing.assert_array_equal(occurrences.get(1, recurrence, start, end), dates(start, end))
+        np.testing.assert_array_equal(
+            occurrences.get(1, recurrence, "2023-01-01", "2024-03-31"), dates("2023-01-01", "2024-03-31"))
+
+        self.assertIsNone(occurrences.get(1, recurrence, "2025-01-01", "2025-12-31"))
+        self.assertIsNone(occurrences.get(2, recurrence, "2023-04-01", "2023-04-30"))
+        self.assertIsNone(occurrences.get(1, ("Weekly", date(2023, 1, 2), None, "Monday", None, None),
+                                          "2023-04-01", "2023-04-30"))
+
+        occurrences.invalidate(1)
+        self.assertIsNone(occurrences.get(1, recurrence, "2023-04-01", "2023-04-30"))
+
+    def test_ledger_reads_cache(self):
+        rule = Rule.objects.create(frequency="Weekly", start_date=date(2023, 1, 2), weekday="Friday")
+        Category.objects.create(name="Groceries", amount=100, group="Variable", rule=rule)
+
+        expected = Ledger.build(date(2023, 1, 2), date(2023, 12, 31))
+
+        with mock.patch("api.ledger.expand", wraps=expand) as expanded:
+            ledger = Ledger.build(date(2023, 1, 2), date(2024, 6, 30))
+        self.assertEqual(expanded.call_args.args[0], [])
+        np.testing.assert_array_equal(ledger.dates[:len(expected)], expected.dates)
+        np.testing.assert_array_equal(
+            ledger.dates, rule.get_occurrence_dates(date(2023, 1, 2), date(2024, 6, 30)))
+
+        rule.weekday = "Monday"
+        rule.save()
+        self.assertIsNone(occurrence_cache.get(rule.id, ("Weekly", date(2023, 1, 2), None, "Friday", None, None),
+                                               "2023-01-02", "2023-12-31"))
+        np.testing.assert_array_equal(
+            Ledger.build(date(2023, 1, 2), date(2023, 12, 31)).dates,
+            rule.get_occurrence_dates(date(2023, 1, 2), date(2023, 12, 31)))
+
+    def test_batch_delete_invalidates(self):
+        rule = Rule.objects.create(frequency="Weekly", start_date=date(2023, 1, 2), weekday="Friday")
+        category = Category.objects.create(name="Groceries", amount=100, group="Variable", rule=rule)
+        Ledger.build(date(2023, 1, 2), date(2023, 12, 31))
+        self.assertIsNotNone(occurrence_cache.get(rule.id, rule.get_recurrence(), "2023-01-02", "2023-12-31"))
+
+        response = APIClient().delete("/api/category-batch-delete", [{"id": category.id}], format="json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(occurrence_cache.get(rule.id, rule.get_recurrence(), "2023-01-02", "2023-12-31"))
+
+
+class CategoryViewsetTests(TestCase):
+    """
+    The category endpoints read rules with a join, so their queries do not grow with the categories.
+    The other query reads the data version.
+    """
+
+    def setUp(self):
+        # the response cache outlives the rolled back test data
+        cache.clear()
+
+    def create_categories(self, count):
+        start = Category.objects.count()
+
+        for i in range(start, start + count):
+            rule = Rule.objects.create(
+                frequency="Monthly", start_date=date(2023, 1, 1), day_of_month=1) if i % 2 else None
+            Category.objects.create(name=f"Category {i}", amount=100, group="Fixed", rule=rule)
+
+    def test_list_query_count(self):
+        client = APIClient()
+        self.create_categories(3)
+
+        with self.assertNumQueries(2):
+            response = client.get("/api/category")
+        self.assertEqual(len(response.data), 3)
+
+        self.create_categories(30)
+
+        with self.assertNumQueries(2):
+            response = client.get("/api/category")
+        self.assertEqual(len(response.data), 33)
+
+    def test_list_embeds_rule(self):
+        self.create_categories(2)
+
+        response = APIClient().get("/api/category")
+
+        self.assertIsNone(response.data[0]["rule"])
+        self.assertEqual(response.data[0]["repeat"], "No")
+        self.assertEqual(response.data[1]["rule"]["frequency"], "Monthly")
+        self.assertEqual(response.data[1]["repeat"], "Yes")
+
+    def test_retrieve_query_count(self):
+        self.create_categories(2)
+        category = Category.objects.get(name="Category 1")
+
+        with self.assertNumQueries(2):
+            response = APIClient().get(f"/api/category/{category.id}")
+        self.assertEqual(response.data["rule"]["id"], category.rule_id)
+        self.assertEqual(response.data["repeat"], "Yes")
+
+
+class BudgetViewTests(TestCase):
+    """
+    The budget is computed from one load of the categories and budget edits.
+    """
+
+    def setUp(self):
+        # the response cache outlives the rolled back test data
+        cache.clear()
+
+    def create_categories(self, count):
+        start = Category.objects.count()
+
+        for i in range(start, start + count):
+            rule = Rule.objects.create(frequency="Weekly", start_date=date(2023, 1, 2), weekday="Friday")
+            category = Category.objects.create(
+                name=f"Category {i}", amount=10 + i, group="Variable", rule=rule)
+            BudgetEdit.objects.create(category=category, date=date(2023, 1, 6), amount=5)
+            BudgetEdit.objects.create(category=category, date=date(2023, 1, 7), amount=1)
+
+    def test_query_count(self):
+        client = APIClient()
+        self.create_categories(2)
+
+        with self.assertNumQueries(6):
+            response = client.get("/api/budget", {"end_date": "2023-03-31"})
+        self.assertEqual(len(response.data["dataframe"]), 14)
+
+        self.create_categories(20)
+
+        with self.assertNumQueries(6):
+            response = client.get("/api/budget", {"end_date": "2023-03-31"})
+        self.assertEqual(len(response.data["dataframe"]), 14)
+
+    def test_query_count_as_rules_grow(self):
+        client = APIClient()
+        frequencies = [
+            {"frequency": "Daily"},
+            {"frequency": "Weekly", "weekday": "Monday"},
+            {"frequency": "Biweekly", "weekday": "Friday"},
+            {"frequency": "Monthly", "day_of_month": 15},
+        ]
+
+        for count in [4, 40]:
+            for i in range(Rule.objects.count(), count):
+                rule = Rule.objects.create(start_date=date(2023, 1, 2), **frequencies[i % 4])
+                Category.objects.create(name=f"Category {i}", amount=10, group="Variable", rule=rule)
+                category = Category.objects.create(name=f"One time {i}", amount=5, group="Income")
+                BudgetEdit.objects.create(category=category, date=date(2023, 2, 1), amount=5)
+
+            with self.assertNumQueries(6):
+                response = client.get("/api/budget", {"end_date": "2023-03-31"})
+            self.assertEqual(len(response.data["dataframe"]), 89)
+
+    def test_matches_baseline(self):
+        rent = Category.objects.create(
+            name="Rent", amount=Decimal("1200.00"), group="Fixed",
+            rule=Rule.objects.create(frequency="Monthly", start_date=date(2023, 1, 1), day_of_month=1))
+        groceries = Category.objects.create(
+            name="Groceries", amount=Decimal("85.50"), group="Variable",
+            rule=Rule.objects.create(frequency="Weekly", start_date=date(2023, 1, 2), weekday="Friday"))
+        salary = Category.objects.create(
+            name="Salary", amount=Decimal("2100.00"), group="Income",
+            rule=Rule.objects.create(frequency="Biweekly", start_date=date(2023, 1, 2), weekday="Friday"))
+        gift = Category.objects.create(name="Gift", amount=Decimal("40.00"), group="Discretionary")
+        edits = [
+            BudgetEdit.objects.create(category=groceries, date=date(2023, 1, 13), amount=Decimal("120.25")),
+            BudgetEdit.objects.create(category=rent, date=date(2023, 2, 1), amount=0),
+            BudgetEdit.objects.create(category=gift, date=date(2023, 1, 20), amount=Decimal("40.00")),
+            BudgetEdit.objects.create(category=gift, date=date(2023, 1, 25), amount=Decimal("15.00")),
+        ]
+
+        response = APIClient().get("/api/budget", {"end_date": "2023-02-10"})
+
+        categories = {
+            category.name: {
+                "id": category.id, "name": category.name, "amount": amount, "adjusted_amount": adjusted_amount,
+                "group": category.group, "rule": category.rule_id,
+            }
+            for category, amount, adjusted_amount in [
+                (rent, "1200.00", "-1200.00"), (groceries, "85.50", "-85.50"), (salary, "2100.00", "2100.00"),
+                (gift, "40.00", "-40.00"),
+            ]
+        }
+        budget_edits = [
+            {"id": budget_edit.id, "amount": amount, "adjusted_amount": adjusted_amount,
+             "date": budget_edit.date.isoformat(), "category": categories[budget_edit.category.name]}
+            for budget_edit, amount, adjusted_amount in zip(
+                edits, ["120.25", "0.00", "40.00", "15.00"], ["-120.25", "0.00", "-40.00", "-15.00"])
+        ]
+
+        # the response of the pandas implementation, before the ledger replaced it. A group total is
+        # the int 0 when none of its categories occurs or is edited on the date, a float otherwise
+        baseline = [
+            ("2023-01-01", ["Rent"], [], [-1200.0, 0, 0, 0], -1200.0, -1200.0),
+            ("2023-01-06", ["Groceries", "Salary"], [], [0, -85.5, 2100.0, 0], 2014.5, 814.5),
+            ("2023-01-13", ["Groceries"], [0], [0, -120.25, 0, 0], -120.25, 694.25),
+            ("2023-01-20", ["Groceries", "Salary"], [2], [0, -85.5, 2100.0, -40.0], 1974.5, 2668.75),
+            ("2023-01-25", ["Gift"], [3], [0, 0, 0, -15.0], -15.0, 2653.75),
+            ("2023-01-27", ["Groceries"], [], [0, -85.5, 0, 0], -85.5, 2568.25),
+            ("2023-02-01", ["Rent"], [1], [0.0, 0, 0, 0], 0.0, 2568.25),
+            ("2023-02-03", ["Groceries", "Salary"], [], [0, -85.5, 2100.0, 0], 2014.5, 4582.75),
+            ("2023-02-10", ["Groceries"], [], [0, -85.5, 0, 0], -85.5, 4497.25),
+        ]
+        expected = {"dataframe": [
+            {
+                "date": day,
+                "categories": [categories[name] for name in names],
+                "budget_edits": [budget_edits[i] for i in edit_indexes],
+                "group_totals": dict(zip(["Fixed", "Variable", "Income", "Discretionary"], group_totals)),
+                "row_total": row_total,
+                "balance": balance,
+            }
+            for day, names, edit_indexes, group_totals, row_total, balance in baseline
+        ]}
+
+        self.assertEqual(response.content, json.dumps(expected, separators=(",", ":")).encode())
+
+    def test_budget_edits_override_amounts(self):
+        self.create_categories(2)
+
+        rows = APIClient().get("/api/budget", {"end_date": "2023-01-13"}).data["dataframe"]
+
+        self.assertEqual([row["date"] for row in rows], ["2023-01-06", "2023-01-07", "2023-01-13"])
+        self.assertEqual(rows[0]["row_total"], -10)
+        self.assertEqual(rows[1]["row_total"], -2)
+        self.assertEqual(rows[1]["categories"], [])
+        self.assertEqual(len(rows[1]["budget_edits"]), 2)
+        self.assertIs(rows[0]["budget_edits"][0]["category"], rows[0]["categories"][0])
+        self.assertEqual(rows[2]["row_total"], -21)
+        self.assertEqual(rows[2]["balance"], -33)
+
+    def test_amounts_are_exact(self):
+        client = APIClient()
+        rule = Rule.objects.create(frequency="Daily", start_date=date(2023, 1, 1))
+        category = Category.objects.create(name="Coffee", amount=Decimal("0.10"), group="Variable", rule=rule)
+        Category.objects.create(name="Refund", amount=Decimal("0.20"), group="Income")
+
+        response = client.post("/api/budget-edit",
+                               {"category": category.id + 1, "date": "2023-01-02", "amount": "0.30"})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(BudgetEdit.objects.get().adjusted_amount, Decimal("0.30"))
+
+        response = client.post("/api/budget-edit",
+                               {"category": category.id, "date": "2023-01-01", "amount": "0.001"})
+        self.assertEqual(response.status_code, 400)
+
+        rows = client.get("/api/budget", {"end_date": "2025-12-31"}).data["dataframe"]
+
+        # 1096 days of -0.10 and one +0.30, float sums would drift
+        self.assertEqual(rows[1]["row_total"], Decimal("0.20"))
+        self.assertEqual(rows[-1]["balance"], Decimal("-109.30"))
+        self.assertEqual(rows[-1]["group_totals"], {"Variable": Decimal("-0.10"), "Income": Decimal("0.00")})
+
+    def test_json_float_amounts(self):
+        client = APIClient()
+        category = Category.objects.create(name="Coffee", amount=Decimal("0.10"), group="Variable")
+
+        response = client.post("/api/budget-edit",
+                               {"category": category.id, "date": "2023-01-02", "amount": 19.99}, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(BudgetEdit.objects.get().amount, Decimal("19.99"))
+
+        response = client.post("/api/budget-edit",
+                               {"category": category.id, "date": "2023-01-02", "amount": 0.001}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_ndjson_stream_matches_rows(self):
+        client = APIClient()
+        self.create_categories(3)
+        Category.objects.create(name="One time", amount=50, group="Income")
+        BudgetEdit.objects.create(category=Category.objects.get(name="One time"),
+                                  date=date(2023, 2, 1), amount=50)
+
+        rows = client.get("/api/budget", {"end_date": "2023-03-31"}).data["dataframe"]
+
+        with mock.patch.object(BudgetView, "chunk_days", 10):
+            response = client.get("/api/budget", {"end_date": "2023-03-31", "format": "ndjson"})
+
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        lines = b"".join(response.streaming_content).splitlines()
+        self.assertEqual([json.loads(line) for line in lines], json.loads(json.dumps(rows, default=float)))
+
+    def test_columnar_matches_rows(self):
+        client = APIClient()
+        self.create_categories(3)
+        Category.objects.create(name="One time", amount=50, group="Income")
+        BudgetEdit.objects.create(category=Category.objects.get(name="One time"),
+                                  date=date(2023, 2, 1), amount=50)
+
+        response = client.get("/api/budget", {"end_date": "2023-03-31"})
+        rows = json.loads(response.content)["dataframe"]
+        columnar = client.get("/api/budget", {"end_date": "2023-03-31", "shape": "columnar"})
+        columns = json.loads(columnar.content)
+
+        categories = {category["id"]: category for category in columns["categories"]}
+        budget_edits = {
+            budget_edit["id"]: {**budget_edit, "category": categories[budget_edit["category"]]}
+            for budget_edit in columns["budget_edits"]
+        }
+        self.assertEqual([
+            {
+                "date": columns["date"][i],
+                "categories": [categories[id] for id in columns["category_ids"][i]],
+                "budget_edits": [budget_edits[id] for id in columns["budget_edit_ids"][i]],
+                "group_totals": {group: totals[i] for group, totals in columns["group_totals"].items()},
+                "row_total": columns["row_total"][i],
+                "balance": columns["balance"][i],
+            }
+            for i in range(len(columns["date"]))
+        ], rows)
+        self.assertLess(len(columnar.content), len(response.content))
+
+        response = client.get("/api/budget", {"end_date": "2023-03-31", "shape": "columnar", "format": "msgpack"})
+        self.assertEqual(response["Content-Type"], "application/msgpack")
+        self.assertEqual(msgpack.unpackb(response.content), columns)
+
+        response = client.get("/api/budget", {"end_date": "2023-03-31", "shape": "columns"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_orjson_renderer_matches_json_renderer(self):
+        self.create_categories(3)
+        data = APIClient().get("/api/budget", {"end_date": "2023-03-31"}).data
+
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(ORJSONRenderer().render({"values": np.array([Decimal("1.50"), 2], dtype=object)}),
+                         b'{"values":[1.5,2]}')
+
+        data = {"name": "a\u2028b\u2029c"}
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+
+        for renderer in [ORJSONRenderer(), JSONRenderer()]:
+            with self.assertRaises(ValueError):
+                renderer.render({"threshold": Decimal("1e400")})
+
+    def test_window(self):
+        client = APIClient()
+        self.create_categories(3)
+
+        rows = client.get("/api/budget", {"end_date": "2023-03-31"}).data["dataframe"]
+        response = client.get("/api/budget", {
+            "end_date": "2023-03-31", "start_date": "2023-02-01", "offset": 2, "limit": 3
+        })
+        window = [row for row in rows if row["date"] >= "2023-02-01"]
+
+        self.assertEqual(response.data["count"], len(window))
+        self.assertEqual(response.data["dataframe"], window[2:5])
+        self.assertEqual(response.data["opening_balance"], window[1]["balance"])
+
+    def test_granularity_matches_rows(self):
+        client = APIClient()
+        self.create_categories(3)
+        Category.objects.create(name="One time", amount=50, group="Income")
+        BudgetEdit.objects.create(category=Category.objects.get(name="One time"),
+                                  date=date(2023, 2, 1), amount=50)
+
+        rows = client.get("/api/budget", {"end_date": "2023-03-31"}).data["dataframe"]
+
+        for granularity, period in [("week", lambda day: day - timedelta(days=day.weekday())),
+                                    ("month", lambda day: day.replace(day=1)),
+                                    ("year", lambda day: day.replace(month=1, day=1))]:
+            with self.assertNumQueries(6):
+                periods = client.get("/api/budget", {
+                    "end_date": "2023-03-31", "granularity": granularity}).data["dataframe"]
+
+            expected = {}
+            for row in rows:
+                key = period(date.fromisoformat(row["date"])).isoformat()
+                expected.setdefault(key, {"row_total": 0, "balance": None, "group_totals": {}})
+                expected[key]["row_total"] += row["row_total"]
+                expected[key]["balance"] = row["balance"]
+                for group, total in row["group_totals"].items():
+                    expected[key]["group_totals"][group] = expected[key]["group_totals"].get(group, 0) + total
+
+            for row in periods:
+                if row["date"] in expected:
+                    self.assertEqual({key: row[key] for key in ["row_total", "balance", "group_totals"]},
+                                     expected[row["date"]])
+                else:
+                    self.assertEqual(row["row_total"], 0)
+
+        self.assertEqual([row["date"] for row in periods], ["2023-01-01"])
+
+    def test_granularity_window(self):
+        client = APIClient()
+        self.create_categories(2)
+        params = {"end_date": "2023-06-30", "granularity": "month"}
+
+        months = client.get("/api/budget", params).data["dataframe"]
+        self.assertEqual([row["date"] for row in months],
+                         ["2023-01-01", "2023-02-01", "2023-03-01", "2023-04-01", "2023-05-01", "2023-06-01"])
+
+        response = client.get("/api/budget", {**params, "start_date": "2023-02-01", "offset": 1, "limit": 2})
+        self.assertEqual(response.data["count"], 5)
+        self.assertEqual(response.data["opening_balance"], months[1]["balance"])
+        self.assertEqual(response.data["dataframe"], months[2:4])
+
+        columns = client.get("/api/budget", {**params, "shape": "columnar"}).data
+        self.assertEqual(columns["balance"], [row["balance"] for row in months])
+
+        response = client.get("/api/budget", {**params, "granularity": "day"})
+        self.assertEqual(response.status_code, 400)
+
+        # ndjson has no count or opening_balance, only start_date applies
+        response = client.get("/api/budget", {**params, "start_date": "2023-02-01", "format": "ndjson"})
+        self.assertEqual([json.loads(line) for line in response.content.splitlines()],
+                         json.loads(json.dumps(months[1:], default=float)))
+
+        for window in [{"limit": 2}, {"offset": 0}]:
+            response = client.get("/api/budget", {**params, **window, "format": "ndjson"})
+            self.assertEqual(response.status_code, 400)
+            response = client.get("/api/budget", {"end_date": "2023-06-30", **window, "format": "ndjson"})
+            self.assertEqual(response.status_code, 400)
+
+    def test_window_validation(self):
+        client = APIClient()
+        self.create_categories(1)
+
+        for params in [{"start_date": "2023-13-01"}, {"start_date": "2024-01-01"}, {"limit": "-1"},
+                       {"offset": "a"}]:
+            response = client.get("/api/budget", {"end_date": "2023-03-31", **params})
+            self.assertEqual(response.status_code, 400)
+
+    def test_window_snapshot_invalidation(self):
+        client = APIClient()
+        self.create_categories(2)
+        params = {"end_date": "2023-03-31", "start_date": "2023-03-15"}
+
+        opening_balance = client.get("/api/budget", params).data["opening_balance"]
+        snapshot = BalanceSnapshot.objects.get(date=date(2023, 3, 1))
+
+        self.assertEqual(client.get("/api/budget", params).data["opening_balance"], opening_balance)
+
+        budget_edit = BudgetEdit.objects.filter(date=date(2023, 1, 6)).first()
+        budget_edit.amount = 105
+        budget_edit.save()
+
+        self.assertFalse(BalanceSnapshot.objects.filter(id=snapshot.id).exists())
+        self.assertEqual(client.get("/api/budget", params).data["opening_balance"], opening_balance - 100)
+
+    def test_snapshot_not_saved_after_concurrent_write(self):
+        self.create_categories(2)
+        budget_edit = BudgetEdit.objects.filter(date=date(2023, 1, 6)).first()
+        group_totals_between = Ledger.group_totals_between
+
+        def write_during_read(start_date, date):
+            totals = group_totals_between(start_date, date)
+            # another request edits before this one saves the snapshot computed from the old data
+            if budget_edit.amount != 105:
+                budget_edit.amount = 105
+                budget_edit.save()
+            return totals
+
+        with mock.patch.object(Ledger, "group_totals_between", side_effect=write_during_read):
+            stale = Ledger.balance_before(date(2023, 1, 6), date(2023, 3, 15))
+
+        self.assertFalse(BalanceSnapshot.objects.exists())
+        self.assertEqual(Ledger.balance_before(date(2023, 1, 6), date(2023, 3, 15)), stale - 100)
+        self.assertTrue(BalanceSnapshot.objects.filter(date=date(2023, 3, 1)).exists())
+
+class CachingTests(TestCase):
+    """
+    Responses are computed once per data version and revalidated with their ETag.
+    """
+
+    def setUp(self):
+        cache.clear()
+        rule = Rule.objects.create(frequency="Monthly", start_date=date(2023, 1, 1), day_of_month=1)
+        self.category = Category.objects.create(name="Rent", amount=500, group="Fixed", rule=rule)
+
+    def test_not_modified(self):
+        client = APIClient()
+        params = {"end_date": "2023-03-31"}
+
+        response = client.get("/api/budget", params)
+        etag = response["ETag"]
+
+        with self.assertNumQueries(1):
+            response = client.get("/api/budget", params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # other parameters, or another format, have another ETag
+        self.assertNotEqual(client.get("/api/budget", {"end_date": "2023-04-30"})["ETag"], etag)
+        self.assertNotEqual(client.get("/api/budget", {**params, "format": "ndjson"})["ETag"], etag)
+
+        BudgetEdit.objects.create(category=self.category, date=date(2023, 2, 1), amount=400)
+
+        response = client.get("/api/budget", params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_cached_until_write(self):
+        client = APIClient()
+        params = {"end_date": "2023-03-31"}
+
+        rows = client.get("/api/budget", params).data["dataframe"]
+
+        with self.assertNumQueries(1):
+            self.assertEqual(client.get("/api/budget", params).data["dataframe"], rows)
+        client.get("/api/category")
+        with self.assertNumQueries(1):
+            client.get("/api/category")
+
+        self.category.amount = 600
+        self.category.save()
+
+        self.assertEqual(client.get("/api/budget", params).data["dataframe"][0]["row_total"], -600)
+        self.assertEqual(client.get("/api/category").data[0]["amount"], "600.00")
+
+        client.post("/api/budget-edit-batch-upsert",
+                    [{"category": self.category.id, "date": "2023-02-01", "amount": 1}], format="json")
+
+        self.assertEqual(client.get("/api/budget", params).data["dataframe"][1]["row_total"], -1)
+
+
+class ProfilingTests(TestCase):
+    """
+    With API_PROFILING on, responses carry their timings and the timings are aggregated.
+    """
+
+    def setUp(self):
+        cache.clear()
+        profiling_stats.clear()
+        rule = Rule.objects.create(frequency="Monthly", start_date=date(2023, 1, 1), day_of_month=1)
+        Category.objects.create(name="Rent", amount=500, group="Fixed", rule=rule)
+
+    @override_settings(API_PROFILING=True)
+    def test_server_timing(self):
+        client = APIClient()
+
+        response = client.get("/api/budget", {"end_date": "2023-03-31"})
+        metrics = [metric.split(";")[0] for metric in response["Server-Timing"].split(", ")]
+
+        self.assertEqual(metrics, ["sql", "resolve", "expand", "build", "serialize", "render", "total"])
+        self.assertIn('desc="5 queries"', response["Server-Timing"])
+
+        stats = client.get("/api/profiling-stats").data
+        self.assertEqual(stats["GET budget"]["requests"], 1)
+        self.assertEqual(stats["GET budget"]["mean_queries"], 5)
+
+    @override_settings(API_PROFILING=True)
+    def test_cprofile_dump(self):
+        with tempfile.TemporaryDirectory() as directory, override_settings(API_PROFILING_DIR=directory):
+            response = APIClient().get("/api/budget", {"end_date": "2023-03-31", "profile": 1})
+
+            self.assertTrue(pstats.Stats(os.path.join(directory, response["X-Profile"])).total_calls)
+
+    def test_disabled(self):
+        client = APIClient()
+
+        self.assertNotIn("Server-Timing", client.get("/api/budget", {"end_date": "2023-03-31"}))
+        self.assertEqual(client.get("/api/profiling-stats").status_code, 404)
+
+
+class AsyncViewTests(TransactionTestCase):
+    """
+    The async views run the views in the pool, and share the computation of identical requests.
+    Pool threads have their own database connections, so the data is committed.
+    """
+
+    def setUp(self):
+        cache.clear()
+        rule = Rule.objects.create(frequency="Weekly", start_date=date(2023, 1, 2), weekday="Friday")
+        self.category = Category.objects.create(name="Groceries", amount=100, group="Variable", rule=rule)
+        BudgetEdit.objects.create(category=self.category, date=date(2023, 1, 6), amount=50)
+
+    async def test_budget(self):
+        params = {"end_date": "2023-03-31"}
+        expected = (await sync_to_async(APIClient().get)("/api/budget", params)).content
+
+        response = await AsyncClient().get("/api/async/budget", params)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, expected)
+
+        response = await AsyncClient().get("/api/async/budget", {**params, "format": "ndjson"})
+        content = b"".join([chunk async for chunk in response.streaming_content])
+        self.assertEqual([json.loads(line) for line in content.splitlines()], json.loads(expected)["dataframe"])
+
+        response = await AsyncClient().get("/api/async/budget")
+        self.assertEqual(response.status_code, 400)
+
+    async def test_coalescing_keeps_validators_apart(self):
+        params = {"end_date": "2023-03-31"}
+        etag = (await AsyncClient().get("/api/async/budget", params))["ETag"]
+        release = threading.Event()
+
+        def slow_call_view(*args, **kwargs):
+            release.wait(5)
+            return call_view(*args, **kwargs)
+
+        # both requests are in flight before either is computed
+        with mock.patch("api.concurrency.call_view", slow_call_view):
+            asyncio.get_running_loop().call_later(0.2, release.set)
+            validated, fresh = await asyncio.gather(
+                AsyncClient().get("/api/async/budget", params, headers={"If-None-Match": etag}),
+                AsyncClient().get("/api/async/budget", params),
+            )
+
+        self.assertEqual(validated.status_code, 304)
+        self.assertEqual(fresh.status_code, 200)
+        self.assertEqual(len(json.loads(fresh.content)["dataframe"]), 13)
+
+    async def test_concurrent_streams(self):
+        params = {"end_date": "2023-03-31", "format": "ndjson"}
+        release = threading.Event()
+
+        def slow_call_view(*args, **kwargs):
+            release.wait(5)
+            return call_view(*args, **kwargs)
+
+        with mock.patch("api.concurrency.call_view", slow_call_view):
+            asyncio.get_running_loop().call_later(0.2, release.set)
+            responses = await asyncio.gather(
+                AsyncClient().get("/api/async/budget", params),
+                AsyncClient().get("/api/async/budget", params),
+            )
+
+        contents = [b"".join([chunk async for chunk in response.streaming_content]) for response in responses]
+        self.assertEqual(contents[0], contents[1])
+        self.assertEqual(len(contents[0].splitlines()), 13)
+
+    async def test_budget_edit_batch_delete(self):
+        ids = [budget_edit_id async for budget_edit_id in BudgetEdit.objects.values_list("id", flat=True)]
+
+        response = await AsyncClient().delete(
+            "/api/async/budget-edit-batch-delete", [{"id": id} for id in ids], content_type="application/json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(await BudgetEdit.objects.aexists())
+
+    def test_in_flight_coalesces(self):
+        in_flight = InFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def compute(value):
+            calls.append(value)
+            started.set()
+            release.wait(5)
+            return value
+
+        first = in_flight.submit("key", compute, 1)
+        started.wait(5)
+        self.assertIs(in_flight.submit("key", compute, 2), first)
+        other = in_flight.submit("other", compute, 3)
+
+        release.set()
+        self.assertEqual((first.result(5), other.result(5)), (1, 3))
+        self.assertEqual(sorted(calls), [1, 3])
+
+        self.assertEqual(in_flight.submit("key", compute, 4).result(5), 4)
+
+
+class BatchDeleteTests(TestCase):
+    """
+    The batch deletes validate and delete with a fixed number of queries.
+    """
+
+    def create_categories(self, count):
+        start = Category.objects.count()
+
+        for i in range(start, start + count):
+            rule = Rule.objects.create(
+                frequency="Monthly", start_date=date(2023, 1, 1), day_of_month=1) if i % 2 else None
+            category = Category.objects.create(name=f"Category {i}", amount=100, group="Fixed", rule=rule)
+            BudgetEdit.objects.create(category=category, date=date(2023, 2, 1), amount=5)
+            BudgetEdit.objects.create(category=category, date=date(2023, 3, 1), amount=5)
+
+    def test_category_batch_delete(self):
+        self.create_categories(20)
+        categories = list(Category.objects.order_by("id")[:10])
+        kept_rule = Category.objects.order_by("id")[11].rule_id
+        BalanceSnapshot.objects.create(start_date=date(2023, 1, 1), date=date(2023, 3, 1), balance=0, group_totals={})
+
+        with self.assertNumQueries(10):
+            response = APIClient().delete("/api/category-batch-delete",
+                                          [{"id": category.id} for category in categories], format="json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            (response.data["categories"], response.data["budget_edits"], response.data["rules"]), (10, 20, 5))
+        self.assertEqual(Category.objects.count(), 10)
+        self.assertEqual(BudgetEdit.objects.count(), 20)
+        self.assertEqual(Rule.objects.count(), 5)
+        self.assertTrue(Rule.objects.filter(id=kept_rule).exists())
+        self.assertFalse(BalanceSnapshot.objects.exists())
+
+    def test_category_batch_delete_missing_id(self):
+        self.create_categories(2)
+        ids = list(Category.objects.values_list("id", flat=True))
+
+        response = APIClient().delete("/api/category-batch-delete",
+                                      [{"id": id} for id in ids + [max(ids) + 1]], format="json")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Category.objects.count(), 2)
+
+    def test_category_batch_delete_without_rules(self):
+        self.create_categories(1)
+        category = Category.objects.get()
+
+        response = APIClient().delete("/api/category-batch-delete", [{"id": category.id}], format="json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["rules"], 0)
+
+    def test_budget_edit_batch_delete(self):
+        self.create_categories(10)
+        ids = list(BudgetEdit.objects.filter(date=date(2023, 3, 1)).values_list("id", flat=True))
+        BalanceSnapshot.objects.create(start_date=date(2023, 1, 1), date=date(2023, 2, 1), balance=0, group_totals={})
+        BalanceSnapshot.objects.create(start_date=date(2023, 1, 1), date=date(2023, 4, 1), balance=0, group_totals={})
+
+        with self.assertNumQueries(6):
+            response = APIClient().delete("/api/budget-edit-batch-delete",
+                                          [{"id": id} for id in ids], format="json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["budget_edits"], 10)
+        self.assertEqual(BudgetEdit.objects.count(), 10)
+        self.assertEqual(list(BalanceSnapshot.objects.values_list("date", flat=True)), [date(2023, 2, 1)])
+
+        response = APIClient().delete("/api/budget-edit-batch-delete", [{"id": ids[0]}], format="json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_delete_payload_validation(self):
+        self.create_categories(2)
+        budget_edit = BudgetEdit.objects.first()
+        client = APIClient()
+
+        for payload in [[], {}, [{}], [{"id": "a"}], [None, {"name": "x"}]]:
+            with self.subTest(payload=payload):
+                response = client.delete("/api/budget-edit-batch-delete", payload, format="json")
+                self.assertEqual(response.status_code, 400)
+                response = client.delete("/api/category-batch-delete", payload, format="json")
+                self.assertEqual(response.status_code, 400)
+
+        response = client.delete("/api/budget-edit-batch-delete", [None, None], format="json")
+        self.assertEqual(response.status_code, 200)
+
+        response = client.delete("/api/budget-edit-batch-delete", [None, {"id": budget_edit.id}], format="json")
+        self.assertEqual(response.data["budget_edits"], 1)
+
+
+class BudgetEditBatchUpsertTests(TestCase):
+    """
+    The batch upsert writes every valid row with one insert and reports the invalid rows.
+    """
+
+    def setUp(self):
+        self.income = Category.objects.create(name="Salary", amount=1000, group="Income")
+        self.fixed = Category.objects.create(name="Rent", amount=500, group="Fixed")
+        self.existing = BudgetEdit.objects.create(category=self.fixed, date=date(2023, 1, 1), amount=400)
+
+    def test_upsert(self):
+        rows = [{"category": self.fixed.id, "date": f"2023-01-{day:02}", "amount": 10 * day}
+                for day in range(1, 21)]
+        rows.append({"category": str(self.income.id), "date": "2023-02-01", "amount": "1200.50"})
+        rows.append({"category": self.income.id, "date": "2023-02-02", "amount": 19.99})
+
+        with self.assertNumQueries(7):
+            response = APIClient().post("/api/budget-edit-batch-upsert", rows, format="json")
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data["errors"], [])
+        self.assertEqual(len(response.data["budget_edits"]), 22)
+        self.assertEqual(BudgetEdit.objects.count(), 22)
+
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.amount, 10)
+        self.assertEqual(self.existing.adjusted_amount, -10)
+        self.assertEqual(BudgetEdit.objects.get(category=self.income, date=date(2023, 2, 1)).adjusted_amount,
+                         Decimal("1200.50"))
+        self.assertEqual(BudgetEdit.objects.get(category=self.income, date=date(2023, 2, 2)).adjusted_amount,
+                         Decimal("19.99"))
+
+    def test_row_errors(self):
+        rows = [
+            {"category": self.fixed.id, "date": "2023-01-01", "amount": 1},
+            {"category": self.fixed.id, "date": "2023-01-32", "amount": 1},
+            {"category": 0, "date": "2023-01-01", "amount": 1},
+            {"category": self.fixed.id, "date": "2023-01-02"},
+            {"category": self.fixed.id, "date": "2023-01-02", "amount": "a"},
+            {"category": self.fixed.id, "date": 20230102, "amount": 1},
+            {"category": self.fixed.id, "date": "2023-01-01", "amount": 2},
+        ]
+
+        response = APIClient().post("/api/budget-edit-batch-upsert", rows, format="json")
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([error["index"] for error in response.data["errors"]], [1, 2, 3, 4, 5])
+        self.assertEqual(response.data["errors"][4]["error"], "date must be in YYYY-MM-DD format")
+        self.assertEqual(len(response.data["budget_edits"]), 1)
+        self.existing.refresh_from_db()
+        self.assertEqual(self.existing.amount, 2)
+
+        response = APIClient().post("/api/budget-edit-batch-upsert", rows[1:6], format="json")
+        self.assertEqual(response.status_code, 400)
+
+
+class BudgetScenarioTests(TestCase):
+    """
+    Scenarios are evaluated in memory against one load of the budget, as columns of a balance matrix.
+    """
+
+    def setUp(self):
+        salary_rule = Rule.objects.create(frequency="Monthly", start_date=date(2023, 1, 1), day_of_month=1)
+        rent_rule = Rule.objects.create(frequency="Monthly", start_date=date(2023, 1, 1), day_of_month=1)
+        self.salary = Category.objects.create(name="Salary", amount=1000, group="Income", rule=salary_rule)
+        self.rent = Category.objects.create(name="Rent", amount=500, group="Fixed", rule=rent_rule)
+        self.gift = Category.objects.create(name="Gift", amount=0, group="Discretionary")
+
+    def test_scenarios(self):
+        scenarios = [
+            {"name": "rent", "categories": [{"id": self.rent.id, "amount": 700, "start_date": "2023-03-01"}]},
+            {"name": "no salary", "categories": [{"id": self.salary.id, "rule": None}]},
+            {"name": "gift", "budget_edits": [{"category": self.gift.id, "date": "2023-02-14", "amount": 49.99}]},
+        ]
+        version = DataVersion.get()
+
+        with self.assertNumQueries(6):
+            response = APIClient().post(
+                "/api/budget-scenarios", {"end_date": "2023-04-30", "scenarios": scenarios}, format="json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["date"], ["2023-01-01", "2023-02-01", "2023-02-14", "2023-03-01", "2023-04-01"])
+        self.assertEqual([scenario["name"] for scenario in response.data["scenarios"]],
+                         ["baseline", "rent", "no salary", "gift"])
+        self.assertEqual([scenario["balance"] for scenario in response.data["scenarios"]], [
+            [500, 1000, 1000, 1500, 2000],
+            [500, 1000, 1000, 1300, 1600],
+            [-500, -1000, -1000, -1500, -2000],
+            [500, 1000, 950.01, 1450.01, 1950.01],
+        ])
+        self.assertEqual([scenario["closing_balance"] for scenario in response.data["scenarios"]],
+                         [2000, 1600, -2000, 1950.01])
+
+        self.assertEqual(BudgetEdit.objects.count(), 0)
+        self.assertEqual(DataVersion.get(), version)
+
+    def test_scenario_matches_saved_changes(self):
+        BudgetEdit.objects.create(category=self.rent, date=date(2023, 2, 1), amount=450)
+        rule = {"frequency": "Weekly", "start_date": "2023-01-10", "weekday": "Friday"}
+        budget_edits = [
+            {"category": self.rent.id, "date": "2023-02-01", "amount": None},
+            {"category": self.salary.id, "date": "2023-03-01", "amount": 1500},
+        ]
+
+        response = APIClient().post("/api/budget-scenarios", {
+            "end_date": "2023-04-30",
+            "scenarios": [{"categories": [{"id": self.rent.id, "rule": rule}], "budget_edits": budget_edits}],
+        }, format="json")
+        dates = response.data["date"]
+        balance = response.data["scenarios"][1]["balance"]
+
+        self.rent.rule = Rule.objects.create(**rule)
+        self.rent.save()
+        BudgetEdit.objects.filter(category=self.rent).delete()
+        BudgetEdit.objects.create(category=self.salary, date=date(2023, 3, 1), amount=1500)
+        cache.clear()
+
+        rows = APIClient().get("/api/budget", {"end_date": "2023-04-30"}).data["dataframe"]
+
+        self.assertEqual([row["date"] for row in rows], dates)
+        self.assertEqual([row["balance"] for row in rows], balance)
+
+    def test_errors(self):
+        scenarios = [
+            {"categories": [{"id": self.rent.id, "amount": 600}]},
+            {"categories": [{"id": 0, "amount": 600}]},
+            {"categories": [{"id": self.rent.id, "rule": {"frequency": "Weekly", "start_date": "2023-01-01"}}]},
+            {"budget_edits": [{"category": self.rent.id, "date": "2023-13-01", "amount": 1}]},
+            {"budget_edits": [{"category": self.rent.id, "date": 20230101, "amount": 1}]},
+            {"categories": [{"id": self.rent.id, "amount": 600, "start_date": 20230101}]},
+            {"categories": [{"id": self.rent.id, "rule": {
+                "frequency": "Monthly", "start_date": 20230101, "day_of_month": 1}}]},
+            {"categories": [{"id": [self.rent.id], "amount": 600}]},
+            {"budget_edits": [{"category": {}, "date": "2023-01-01", "amount": 1}]},
+        ]
+
+        response = APIClient().post(
+            "/api/budget-scenarios", {"end_date": "2023-04-30", "scenarios": scenarios}, format="json")
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error["index"] for error in response.data["errors"]], [1, 2, 3, 4, 5, 6, 7, 8])
+
+        response = APIClient().post("/api/budget-scenarios", {"end_date": "2023-04-30"}, format="json")
+        self.assertEqual(response.status_code, 400)
+
+
+class BudgetThresholdTests(TestCase):
+    """
+    Threshold crossings and the minimum balance are answered from an index of the ledger's balance.
+    """
+
+    def setUp(self):
+        # the response and index caches outlive the rolled back test data
+        cache.clear()
+
+        salary_rule = Rule.objects.create(frequency="Monthly", start_date=date(2023, 1, 1), day_of_month=1)
+        rent_rule = Rule.objects.create(frequency="Monthly", start_date=date(2023, 1, 1), day_of_month=15)
+        Category.objects.create(name="Salary", amount=1000, group="Income", rule=salary_rule)
+        Category.objects.create(name="Rent", amount=1500, group="Fixed", rule=rent_rule)
+
+    def test_thresholds(self):
+        response = APIClient().get("/api/budget-thresholds", {
+            "end_date": "2023-04-30", "threshold": ["0", "-1000", "-5000"]})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data["minimum"], {"date": date(2023, 4, 15), "balance": -2000})
+        self.assertEqual(
+            [(crossing["date"], crossing["balance"]) for crossing in response.data["crossings"]],
+            [(date(2023, 1, 15), -500), (date(2023, 3, 15), -1500), (None, None)])
+
+    def test_start_date(self):
+        response = APIClient().get("/api/budget-thresholds", {
+            "end_date": "2023-04-30", "start_date": "2023-02-10", "threshold": ["600", "-100"]})
+
+        self.assertEqual(response.data["minimum"], {"date": date(2023, 4, 15), "balance": -2000})
+        self.assertEqual(
+            [(crossing["date"], crossing["balance"]) for crossing in response.data["crossings"]],
+            [(date(2023, 2, 10), 500), (date(2023, 2, 15), -1000)])
+
+        response = APIClient().get("/api/budget-thresholds", {
+            "end_date": "2023-02-28", "start_date": "2023-02-02"})
+        self.assertEqual(response.data["minimum"], {"date": date(2023, 2, 15), "balance": -1000})
+
+    def test_matches_budget(self):
+        generate_budget_data(10, 60, date(2023, 1, 1), 2, seed=2)
+        thresholds = [-5000, 0, 2500, 10000]
+
+        rows = APIClient().get("/api/budget", {"end_date": "2024-12-31"}).data["dataframe"]
+        response = APIClient().get("/api/budget-thresholds", {"end_date": "2024-12-31", "threshold": thresholds})
+
+        minimum = min(rows, key=lambda row: row["balance"])
+        self.assertEqual(response.data["minimum"]["balance"], minimum["balance"])
+        for threshold, crossing in zip(thresholds, response.data["crossings"]):
+            row = next((row for row in rows if row["balance"] < threshold), None)
+            self.assertEqual(crossing["balance"], None if row is None else row["balance"])
+
+    def test_index_is_cached(self):
+        client = APIClient()
+        client.get("/api/budget-thresholds", {"end_date": "2023-04-30", "threshold": "0"})
+
+        with self.assertNumQueries(4):
+            response = client.get("/api/budget-thresholds", {"end_date": "2023-04-30", "threshold": "100"})
+        self.assertEqual(response.data["crossings"][0]["date"], date(2023, 1, 15))
+
+    def test_errors(self):
+        client = APIClient()
+
+        self.assertEqual(client.get("/api/budget-thresholds").status_code, 400)
+        for threshold in ["a", "nan", "sNaN", "inf", "1e400"]:
+            self.assertEqual(client.get("/api/budget-thresholds", {
+                "end_date": "2023-04-30", "threshold": threshold}).status_code, 400)
+        self.assertEqual(client.get("/api/budget-thresholds", {
+            "end_date": "2023-04-30", "start_date": "2023-05-01"}).status_code, 400)
+
+
+class MappedLedgerTests(TestCase):
+    """
+    With LEDGER_MMAP the ledger is saved once per data version and memory-mapped by every process.
+    """
+
+    def setUp(self):
+        # the response cache outlives the rolled back test data
+        cache.clear()
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+        rule = Rule.objects.create(frequency="Weekly", start_date=date(2023, 1, 2), weekday="Friday")
+        self.category = Category.objects.create(name="Groceries", amount=100, group="Variable", rule=rule)
+        Category.objects.create(name="Gift", amount=25, group="Income")
+        BudgetEdit.objects.create(category=self.category, date=date(2023, 1, 6), amount=80)
+        BudgetEdit.objects.create(category=Category.objects.get(name="Gift"), date=date(2023, 1, 7), amount=25)
+
+    def get(self, **params):
+        cache.clear()
+        response = APIClient().get("/api/budget", {"end_date": "2023-03-31", **params})
+        return response.content
+
+    def test_matches_built_ledger(self):
+        cases = [{}, {"shape": "columnar"}, {"start_date": "2023-02-01", "offset": 2, "limit": 3}]
+        built = [self.get(**params) for params in cases]
+
+        with override_settings(LEDGER_MMAP=True, LEDGER_MMAP_DIR=self.directory.name):
+            self.assertEqual([self.get(**params) for params in cases], built)
+
+            # the second time every ledger is mapped from its files
+            with mock.patch("api.mapped.Ledger.build") as build:
+                self.assertEqual([self.get(**params) for params in cases], built)
+            build.assert_not_called()
+
+    def test_arrays_are_mapped(self):
+        with override_settings(LEDGER_MMAP=True, LEDGER_MMAP_DIR=self.directory.name):
+            ledger = MappedLedger.get(date(2023, 1, 2), date(2023, 3, 31))
+
+        self.assertIsInstance(ledger.amounts, np.memmap)
+        self.assertIsInstance(ledger.occurs, np.memmap)
+        self.assertEqual(ledger.amounts[0].tolist(), [-8000, 0])
+        built = Ledger.build(date(2023, 1, 2), date(2023, 3, 31))
+        self.assertEqual(ledger.balance()[-1], built.closing_balance)
+
+        # the edit ids are read from the mapped arrays for the rows that are used only
+        self.assertIsInstance(ledger.edit_ids.ids, np.memmap)
+        self.assertEqual(list(ledger.edit_ids), built.edit_ids)
+        self.assertEqual(list(ledger.slice(0, 2).edit_ids), built.edit_ids[0:2])
+        self.assertEqual(list(ledger.slice(5, 3).edit_ids), [])
+        self.assertEqual(ledger.edit_ids[1], built.edit_ids[1])
+        self.assertEqual(ledger.edit_ids[-1], built.edit_ids[-1])
+
+    def test_new_version_replaces_files(self):
+        with override_settings(LEDGER_MMAP=True, LEDGER_MMAP_DIR=self.directory.name):
+            self.get()
+            [before] = os.listdir(self.directory.name)
+
+            self.category.amount = 120
+            self.category.save()
+            content = self.get()
+            [after] = os.listdir(self.directory.name)
+
+        self.assertNotEqual(before, after)
+        self.assertEqual(content, self.get())
+
+    def test_removed_files_are_rebuilt(self):
+        with override_settings(LEDGER_MMAP=True, LEDGER_MMAP_DIR=self.directory.name):
+            content = self.get()
+            [name] = os.listdir(self.directory.name)
+
+            # another process prunes the ledger between the lookup and the load
+            os.remove(os.path.join(self.directory.name, name, "balance_cents.npy"))
+
+            self.assertEqual(self.get(), content)
+
+    def test_prune_keeps_newer_versions_and_recent_windows(self):
+        newer = os.path.join(self.directory.name, f"{DataVersion.get() + 1}-2023-01-01-2023-03-31-0")
+        os.mkdir(newer)
+        os.mkdir(os.path.join(self.directory.name, "lost+found"))
+        open(os.path.join(self.directory.name, "notes.txt"), "w").close()
+
+        with override_settings(LEDGER_MMAP=True, LEDGER_MMAP_DIR=self.directory.name, LEDGER_MMAP_WINDOWS=2):
+            for day in range(1, 5):
+                MappedLedger.get(date(2023, 1, day), date(2023, 3, 31))
+
+        names = sorted(os.listdir(self.directory.name))
+        self.assertEqual(len(names), 5)
+        self.assertIn(os.path.basename(newer), names)
+        self.assertIn("lost+found", names)
+        self.assertIn("notes.txt", names)
+        self.assertTrue(any("-2023-01-04-" in name for name in names))
+        self.assertTrue(any("-2023-01-03-" in name for name in names))
+
+
+class OrphanRuleTests(TestCase):
+    """
+    A category save only deletes the rule it detaches, the other orphans are swept by a command.
+    """
+
+    def test_update_deletes_detached_rule(self):
+        rule = Rule.objects.create(frequency="Monthly", start_date=date(2023, 1, 1), day_of_month=1)
+        category = Category.objects.create(name="Rent", amount=500, group="Fixed", rule=rule)
+        orphans = Rule.objects.bulk_create([
+            Rule(frequency="Monthly", start_date=date(2023, 1, 1), day_of_month=1) for _ in range(20)
+        ])
+
+        category.rule = Rule.objects.create(frequency="Weekly", start_date=date(2023, 1, 1), weekday="Friday")
+        category.save()
+
+        self.assertFalse(Rule.objects.filter(id=rule.id).exists())
+        self.assertEqual(Rule.objects.filter(category=None).count(), len(orphans))
+
+        category.amount = 600
+        with self.assertNumQueries(5):
+            category.save()
+
+        category.rule = None
+        category.save()
+
+        self.assertEqual(Rule.objects.filter(category=None).count(), len(orphans))
+
+    def test_delete_orphan_rules_command(self):
+        rule = Rule.objects.create(frequency="Monthly", start_date=date(2023, 1, 1), day_of_month=1)
+        Category.objects.create(name="Rent", amount=500, group="Fixed", rule=rule)
+        Rule.objects.create(frequency="Monthly", start_date=date(2023, 1, 1), day_of_month=1)
+
+        call_command("delete_orphan_rules", stdout=io.StringIO())
+
+        self.assertEqual(list(Rule.objects.values_list("id", flat=True)), [rule.id])
+
+
+class SyntheticDataTests(TestCase):
+    """
+    The synthetic data used by the benchmark_budget command is valid budget data.
+    """
+
+    def setUp(self):
+        # the response cache outlives the rolled back test data
+        cache.clear()
+
+    def test_generate_budget_data(self):
+        categories = generate_budget_data(50, 400, date(2023, 1, 1), 2, seed=1)
+
+        self.assertEqual(Category.objects.count(), 50)
+        self.assertEqual(Rule.objects.count(), 45)
+        self.assertEqual(BudgetEdit.objects.count(), 400)
+        self.assertEqual(BudgetEdit.objects.filter(date__gte=date(2025, 1, 1)).count(), 0)
+        self.assertEqual({category.group for category in categories},
+                         {"Fixed", "Variable", "Discretionary", "Income", "Savings"})
+
+        response = APIClient().get("/api/budget", {"end_date": "2024-12-31"})
+        self.assertEqual(response.status_code, 200)
+
+    def test_command_reports_created_edits(self):
+        stdout = io.StringIO()
+
+        # one category over one year holds at most 365 edits
+        call_command("generate_budget_data", categories=1, edits=1000, years=1,
+                     start_date=date(2023, 1, 1), stdout=stdout)
+
+        self.assertEqual(BudgetEdit.objects.count(), 365)
+        self.assertIn("Created 1 categories and 365 budget edits.", stdout.getvalue())
+
+    def test_generate_budget_data_invalidates(self):
+        client = APIClient()
+        params = {"end_date": "2023-06-30", "start_date": "2023-03-15"}
+        rule = Rule.objects.create(frequency="Monthly", start_date=date(2023, 1, 1), day_of_month=1)
+        Category.objects.create(name="Rent", amount=500, group="Fixed", rule=rule)
+        before = client.get("/api/budget", params)
+        version = DataVersion.get()
+        self.assertTrue(BalanceSnapshot.objects.exists())
+
+        generate_budget_data(10, 50, date(2023, 1, 1), 1, seed=1)
+
+        self.assertGreater(DataVersion.get(), version)
+        self.assertFalse(BalanceSnapshot.objects.exists())
+        self.assertNotEqual(client.get("/api/budget", params)["ETag"], before["ETag"])
+
+
+class StartupTests(SimpleTestCase):
+    """
+    Serving the API does not import pandas, which is only needed by Ledger.to_dataframe.
+    """
+
+    def test_urls_do_not_import_pandas(self):
+        code = (
+            "import sys, django; django.setup(); "
+            "from django.urls import resolve; resolve('/api/budget'); "
+            "print('pandas' in sys.modules)"
+        )
+        process = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True,
+            cwd=settings.BASE_DIR, env={**os.environ, "DJANGO_SETTINGS_MODULE": "backend.settings"},
+        )
+
+        self.assertEqual(process.stdout.strip(), "False")
+
+
+class QueryPlanTests(SimpleTestCase):
+    """
+    The budget edit queries use the indexes of migration 0005, see the explain_budget_queries command.
+    """
+
+    def test_explain_budget_queries(self):
+        # the command creates and destroys its own test database, so it runs in another process
+        process = subprocess.run(
+            [sys.executable, "manage.py", "explain_budget_queries", "--edits", "2000", "--categories", "20",
+             "--repeat", "1"],
+            capture_output=True, text=True, check=True,
+            cwd=settings.BASE_DIR, env={**os.environ, "DJANGO_SETTINGS_MODULE": "backend.settings"},
+        )
+
+        self.assertIn("2000 budget edits, 20 categories", process.stdout)
+        plans = process.stdout.split("ledger budget edits in a month")[1].split("group totals before a date")[0]
+        before, after = plans.split("after:")
+        self.assertNotIn("api_budgetedit_date_idx", before)
+        self.assertIn("COVERING INDEX api_budgetedit_date_idx", after)
@@ -0,0 +1,118 @@
+import numpy as np
+from django.core.cache import cache
+
+from .ledger import Ledger, as_date
+from .models import DataVersion
+
+
+class BalanceIndex:
+    """
+    This class answers minimum and threshold queries on the running balance of a ledger without
+    scanning it, from a sparse table of running minimums built from the ledger's balance.
+
+    The balance on a date is the balance after the last row on or before it, or the opening balance
+    before the first row. The values are the cents of the opening balance followed by the balance
+    of each row, so the value in effect on a date is at position searchsorted(dates, date, "right").
+    Level k of the table holds, for each position, the position of the minimum of the 2**k values
+    starting there, the first one on ties. Building it takes O(n log n), then:
+
+    - minimum(start_date, end_date) is the minimum of two overlapping blocks, in O(1).
+    - first_below(thresholds, date) skips the largest blocks whose minimum is not below each
+      threshold, in O(log n) per threshold, all thresholds at once.
+
+    Example usage:
+
+    index = BalanceIndex.from_ledger(Ledger.build(start_date, end_date))
+    date, balance = index.minimum(start_date, end_date)
+    dates = index.first_below([0, 50000], start_date)
+
+    """
+
+    def __init__(self, dates, values):
+        self.dates = dates
+        self.values = values
+        self.table = [np.arange(len(values))]
+
+        size = 1
+        while 2 * size <= len(values):
+            previous = self.table[-1]
+            left = previous[:len(previous) - size]
+            right = previous[size:]
+            self.table.append(np.where(values[right] < values[left], right, left))
+            size *= 2
+
+    @classmethod
+    def from_ledger(cls, ledger):
+        """
+        Returns the index of a ledger's balance.
+        """
+        values = np.empty(len(ledger) + 1, dtype=np.int64)
+        values[0] = ledger.opening_balance
+        values[1:] = ledger.balance()
+
+        return cls(ledger.dates, values)
+
+    @classmethod
+    def get(cls, start_date, end_date, opening_balance=0):
+        """
+        Returns the index of the ledger between start_date and end_date, cached per data version,
+        so that requests with other thresholds do not build the ledger again.
+        """
+        key = f"api:balance-index:{DataVersion.get()}:{as_date(start_date)}:{as_date(end_date)}:{opening_balance}"
+        index = cache.get(key)
+
+        if index is None:
+            index = cls.from_ledger(Ledger.build(start_date, end_date, opening_balance))
+            cache.set(key, index)
+
+        return index
+
+    def position(self, date) -> int:
+        """
+        Returns the position of the value in effect on date.
+        """
+        return int(np.searchsorted(self.dates, np.datetime64(as_date(date), "D"), side="right"))
+
+    def date_of(self, position, date):
+        """
+        Returns the date of the row at a position, or date for the value in effect on date.
+        """
+        return as_date(date) if position == self.position(date) else self.dates[position - 1].item()
+
+    def minimum(self, start_date, end_date) -> tuple:
+        """
+        Returns the first date with the minimum balance between start_date and end_date, inclusive,
+        and the cents of that balance.
+        """
+        lo = self.position(start_date)
+        hi = self.position(end_date)
+        k = (hi - lo + 1).bit_length() - 1
+
+        left = self.table[k][lo]
+        right = self.table[k][hi - 2 ** k + 1]
+        position = right if self.values[right] < self.values[left] else left
+
+        return self.date_of(position, start_date), self.values[position]
+
+    def first_below(self, thresholds, date) -> list:
+        """
+        Returns the first date on or after date with a balance below each threshold, in cents, and
+        the cents of that balance, or None when the balance never goes below it.
+        """
+        thresholds = np.array(thresholds, dtype=object)
+        start = self.position(date)
+        positions = np.full(len(thresholds), start)
+
+        # skip blocks whose minimum is not below the threshold, from the largest size down,
+        # the value in effect on date is compared first, so a balance already below returns date
+        for k in reversed(range(len(self.table))):
+            size = 2 ** k
+            level = self.table[k]
+            within = positions + size <= len(self.values)
+            minimums = self.values[level[np.minimum(positions, len(level) - 1)]]
+            positions[within & (minimums >= thresholds)] += size
+
+        return [
+            (self.date_of(position, date), self.values[position]) if position < len(self.values) else None
+            for position in positions.tolist()
+        ]
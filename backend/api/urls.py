@@ -2,6 +2,7 @@ from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
 from . import views
+from .concurrency import async_view
 
 router = DefaultRouter(trailing_slash=False)
 router.register("rule", views.RuleViewset)
@@ -11,6 +12,17 @@ router.register("budget-edit", views.BudgetEditViewset)
 urlpatterns = [
     path("", include(router.urls)),
     path("budget", views.BudgetView.as_view(), name="budget"),
+    path("budget-scenarios", views.BudgetScenarioView.as_view(), name="budget-scenarios"),
+    path("budget-thresholds", views.BudgetThresholdView.as_view(), name="budget-thresholds"),
     path("category-batch-delete", views.CategoryBatchView.as_view(), name="category-batch-delete"),
+    path("budget-edit-batch-upsert", views.BudgetEditBatchUpsert.as_view(), name="budget-edit-batch-upsert"),
     path("budget-edit-batch-delete", views.BudgetEditBatch.as_view(), name="budget-edit-batch-delete"),
+    path("async/budget", async_view(views.BudgetView.as_view(), coalesce=True), name="async-budget"),
+    path("async/category-batch-delete", async_view(views.CategoryBatchView.as_view()),
+         name="async-category-batch-delete"),
+    path("async/budget-edit-batch-upsert", async_view(views.BudgetEditBatchUpsert.as_view()),
+         name="async-budget-edit-batch-upsert"),
+    path("async/budget-edit-batch-delete", async_view(views.BudgetEditBatch.as_view()),
+         name="async-budget-edit-batch-delete"),
+    path("profiling-stats", views.ProfilingStatsView.as_view(), name="profiling-stats"),
 ]
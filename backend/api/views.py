@@ -1,20 +1,36 @@
+import math
 from datetime import datetime
+from decimal import ROUND_CEILING, Decimal, InvalidOperation
 
 from rest_framework import viewsets
 from rest_framework import views
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 from rest_framework.status import *
 
+from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count, Min
+from django.http import StreamingHttpResponse
 
-import pandas as pd
+import numpy as np
 
-from .models import Rule, Category, BudgetEdit
-from .serializers import RuleSerializer, CategorySerializer, BudgetSerializer, BudgetEditSerializer
+from .models import Rule, Category, BudgetEdit, BalanceSnapshot, DataVersion, delete_rows
+from .serializers import RuleSerializer, CategorySerializer, CategoryRuleSerializer, BudgetSerializer, BudgetColumnarSerializer, BudgetRollupSerializer, BudgetRollupColumnarSerializer, BudgetEditSerializer
 from .filters import RuleFilter, CategoryFilter
-
-
-class RuleViewset(viewsets.ModelViewSet):
+from .caching import CachedResponseMixin, cache_response
+from .ledger import Ledger, to_decimal
+from .mapped import MappedLedger
+from .profiling import span, stats as profiling_stats
+from .rollups import Rollup
+from .scenarios import Scenario, ScenarioMatrix
+from .thresholds import BalanceIndex
+from .occurrences import occurrence_cache
+from .renderers import NDJSONRenderer, MessagePackRenderer
+
+
+class RuleViewset(CachedResponseMixin, viewsets.ModelViewSet):
     queryset = Rule.objects.all()
     serializer_class = RuleSerializer
     filterset_class = RuleFilter
@@ -22,49 +38,41 @@ class RuleViewset(viewsets.ModelViewSet):
     ordering_fields = "__all__"
 
 
-class CategoryViewset(viewsets.ModelViewSet):
-    queryset = Category.objects.all()
+class CategoryViewset(CachedResponseMixin, viewsets.ModelViewSet):
+    queryset = Category.objects.select_related("rule")
     serializer_class = CategorySerializer
     filterset_class = CategoryFilter
     search_fields = "__all__"
     ordering_fields = "__all__"
 
-    def retrieve(self, request, *args, **kwargs):
-        instance = self.get_object()
-        serializer = self.get_serializer(instance)
-        data = serializer.data
-
-        has_rule = Rule.objects.filter(category=instance).exists()
-
-        data["rule"] = RuleSerializer(
-            Rule.objects.get(category=instance)
-        ).data if has_rule else None
-
-        data["repeat"] = "Yes" if has_rule else "No"
-
-        return Response(data, HTTP_200_OK)
+    def get_serializer_class(self):
+        # rule and repeat are read from the joined rule
+        if self.action in ["list", "retrieve"]:
+            return CategoryRuleSerializer
+        return super().get_serializer_class()
 
+    @cache_response
     def list(self, request, *args, **kwargs):
         queryset = self.filter_queryset(self.get_queryset())
         serializer = self.get_serializer(queryset, many=True)
 
-        data = serializer.data
-
-        for i in range(len(data)):
-            has_rule = Rule.objects.filter(
-                category=Category.objects.get(name=data[i]["name"])).exists()
+        return Response(serializer.data, HTTP_200_OK)
 
-            data[i]["rule"] = RuleSerializer(
-                Rule.objects.get(
-                    category=Category.objects.get(name=data[i]["name"]))
-            ).data if has_rule else None
 
-            data[i]["repeat"] = "Yes" if has_rule else "No"
+def clean_amount(field, value) -> Decimal:
+    """
+    Returns value as the Decimal that the amount field stores, raises ValidationError when it is
+    not valid for the field. A JSON float is parsed from its shortest repr, 19.99 as
+    Decimal("19.99"), since the field would convert it at its full precision and reject the
+    digits that the float adds.
+    """
+    if isinstance(value, float):
+        value = Decimal(str(value))
 
-        return Response(data, HTTP_200_OK)
+    return field.clean(value, None)
 
 
-class BudgetEditViewset(viewsets.ModelViewSet):
+class BudgetEditViewset(CachedResponseMixin, viewsets.ModelViewSet):
     queryset = BudgetEdit.objects.all()
     serializer_class = BudgetEditSerializer
     search_fields = "__all__"
@@ -90,18 +98,19 @@ class BudgetEditViewset(viewsets.ModelViewSet):
             )
 
         try:
-            date = pd.to_datetime(date).date()
-        except ValueError:
+            date = datetime.fromisoformat(date).date()
+        except (TypeError, ValueError):
             return Response(
                 {"error": "date must be in YYYY-MM-DD format"},
                 HTTP_400_BAD_REQUEST
             )
 
+        # parse the amount as the Decimal the field stores, a float would round it
         try:
-            amount = float(amount)
-        except ValueError:
+            amount = clean_amount(BudgetEdit._meta.get_field("amount"), amount)
+        except ValidationError as e:
             return Response(
-                {"error": "amount must be a number"},
+                {"error": e.messages},
                 HTTP_400_BAD_REQUEST
             )
 
@@ -129,7 +138,108 @@ class BudgetEditViewset(viewsets.ModelViewSet):
         return Response(serializer.data, HTTP_201_CREATED)
 
 
+class BudgetEditBatchUpsert(views.APIView):
+    def post(self, request, *args, **kwargs):
+        """
+        Creates or updates a batch of budget edits, given as an array of {category, date, amount}.
+
+        The categories are read with one query, every row is validated in memory, and the valid rows
+        are written with one insert that updates the amount of the existing (category, date) edits.
+        Rows with errors are skipped and returned with their index, the other rows are still written.
+        When a (category, date) appears more than once the last row wins.
+        """
+        rows = request.data
+
+        if not isinstance(rows, list):
+            return Response(
+                {"error": "an array of budget_edits is required"},
+                HTTP_400_BAD_REQUEST
+            )
+
+        category_field = BudgetEdit._meta.get_field("category")
+        date_field = BudgetEdit._meta.get_field("date")
+        amount_field = BudgetEdit._meta.get_field("amount")
+
+        category_ids = []
+        for row in rows:
+            try:
+                category_ids.append(category_field.to_python(row["category"]))
+            except (TypeError, KeyError, ValidationError):
+                category_ids.append(None)
+
+        groups = dict(Category.objects.filter(
+            id__in={category_id for category_id in category_ids if category_id is not None}
+        ).values_list("id", "group"))
+
+        budget_edits = {}
+        errors = []
+
+        for index, (row, category_id) in enumerate(zip(rows, category_ids)):
+            if not isinstance(row, dict) or any(row.get(key) is None for key in ["category", "date", "amount"]):
+                errors.append({"index": index, "error": "category, date, and amount are required"})
+                continue
+
+            if category_id not in groups:
+                errors.append({"index": index, "error": "category does not exist"})
+                continue
+
+            try:
+                date = date_field.clean(row["date"], None)
+            except (TypeError, ValueError, ValidationError):
+                errors.append({"index": index, "error": "date must be in YYYY-MM-DD format"})
+                continue
+
+            try:
+                amount = clean_amount(amount_field, row["amount"])
+            except ValidationError as e:
+                errors.append({"index": index, "error": e.messages})
+                continue
+
+            budget_edits[category_id, date] = BudgetEdit(
+                category_id=category_id,
+                date=date,
+                amount=amount,
+                adjusted_amount=amount if groups[category_id] == "Income" else amount * -1,
+            )
+
+        if budget_edits:
+            with transaction.atomic():
+                BudgetEdit.objects.bulk_create(
+                    budget_edits.values(),
+                    update_conflicts=True,
+                    unique_fields=["category", "date"],
+                    update_fields=["amount", "adjusted_amount"],
+                )
+
+                # bulk_create does not send signals
+                DataVersion.bump()
+                BalanceSnapshot.invalidate(min(date for _, date in budget_edits))
+
+            # read the rows back for their ids, bulk_create does not set them on updated rows
+            saved = BudgetEdit.objects.select_related("category").filter(
+                category_id__in={category_id for category_id, _ in budget_edits},
+                date__in={date for _, date in budget_edits},
+            )
+            saved = [
+                budget_edit for budget_edit in saved
+                if (budget_edit.category_id, budget_edit.date) in budget_edits
+            ]
+        else:
+            saved = []
+
+        return Response({
+            "budget_edits": BudgetEditSerializer(saved, many=True).data,
+            "errors": errors,
+        }, HTTP_201_CREATED if saved or not errors else HTTP_400_BAD_REQUEST)
+
+
 class BudgetView(views.APIView):
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, NDJSONRenderer, MessagePackRenderer]
+
+    # days of the ledger built at a time when streaming
+    chunk_days = 366
+
+    @cache_response
     def get(self, request, *args, **kwargs):
         """
         This will return a dataframe with the following columns:
@@ -147,35 +257,248 @@ class BudgetView(views.APIView):
         The group_totals, row_total, and balance will be modified with BudgetEdits if they exist
         based on the category(s) that were edited.
 
+        Responses are cached per data version and answer a matching If-None-Match with
+        304 Not Modified, see caching.py.
+
+        With ?format=ndjson the rows are streamed one per line instead, building the ledger
+        chunk_days at a time so memory does not grow with the length of the projection.
+
+        With API_PROFILING on, the resolve, expand, build, serialize and render phases are
+        returned as Server-Timing spans, see profiling.py.
+
+        With LEDGER_MMAP on, the ledger is built once per data version and memory-mapped by every
+        worker process, see MappedLedger.
+
+        The optional start_date, limit and offset parameters return a window of the rows instead.
+        The response then also has the number of rows from start_date (count) and the balance before
+        the first returned row (opening_balance). The rows before start_date are not built, their
+        balance is aggregated by Ledger.balance_before. ndjson only applies start_date, limit and
+        offset are rejected with it.
+
+        With ?shape=columnar the ledger is returned as a table of categories and of budget_edits,
+        each serialized once, and one array per column, see BudgetColumnarSerializer.
+        Any shape can also be rendered as MessagePack with ?format=msgpack.
+
+        With ?granularity=week, month or year there is one row per period instead, dated by its
+        first day, with the group totals, the net flow (row_total) and the closing balance
+        of the period. The rows are aggregated without building the ledger, see Rollup.
+        limit and offset then count periods.
+
         """
-        end_date = request.query_params.get("end_date", None)
+        with span("resolve"):
+            end_date = request.query_params.get("end_date", None)
 
-        # validate end_date
-        if end_date is None:
+            # validate end_date
+            if end_date is None:
+                return Response(
+                    {"error": "end_date is required"},
+                    HTTP_400_BAD_REQUEST
+                )
+
+            try:
+                start_date = self.get_start_date()
+                end_date = datetime.fromisoformat(end_date)
+
+            except ValueError:
+                return Response(
+                    {"error": "end_date must be in YYYY-MM-DD format"},
+                    HTTP_400_BAD_REQUEST
+                )
+
+            if start_date > end_date:
+                return Response(
+                    {"error": f"end_date must be after {start_date}"},
+                    HTTP_400_BAD_REQUEST
+                )
+
+            # validate window
+            window_start = request.query_params.get("start_date", None)
+            limit = request.query_params.get("limit", None)
+            offset = request.query_params.get("offset", None)
+            windowed = window_start is not None or limit is not None or offset is not None
+
+            try:
+                window_start = start_date if window_start is None else max(
+                    start_date, datetime.fromisoformat(window_start))
+            except ValueError:
+                return Response(
+                    {"error": "start_date must be in YYYY-MM-DD format"},
+                    HTTP_400_BAD_REQUEST
+                )
+
+            if window_start > end_date:
+                return Response(
+                    {"error": "start_date must be before end_date"},
+                    HTTP_400_BAD_REQUEST
+                )
+
+            try:
+                limit = None if limit is None else int(limit)
+                offset = 0 if offset is None else int(offset)
+                if (limit is not None and limit < 0) or offset < 0:
+                    raise ValueError
+            except ValueError:
+                return Response(
+                    {"error": "limit and offset must be non-negative integers"},
+                    HTTP_400_BAD_REQUEST
+                )
+
+            shape = request.query_params.get("shape", "rows")
+            if shape not in ["rows", "columnar"]:
+                return Response(
+                    {"error": "shape must be rows or columnar"},
+                    HTTP_400_BAD_REQUEST
+                )
+
+            if shape == "columnar" and request.accepted_renderer.format == NDJSONRenderer.format:
+                return Response(
+                    {"error": "shape=columnar cannot be streamed as ndjson"},
+                    HTTP_400_BAD_REQUEST
+                )
+
+            # ndjson has no envelope for count and opening_balance
+            paginated = "limit" in request.query_params or "offset" in request.query_params
+            if paginated and request.accepted_renderer.format == NDJSONRenderer.format:
+                return Response(
+                    {"error": "limit and offset cannot be used with ndjson"},
+                    HTTP_400_BAD_REQUEST
+                )
+
+            granularity = request.query_params.get("granularity", None)
+            if granularity not in [None, "week", "month", "year"]:
+                return Response(
+                    {"error": "granularity must be week, month or year"},
+                    HTTP_400_BAD_REQUEST
+                )
+
+            opening_balance = Ledger.balance_before(start_date, window_start)
+
+        if granularity is not None:
+            ledger = Rollup.build(window_start, end_date, granularity, opening_balance)
+
+            # a rollup is small, rendering its rows as ndjson needs no streaming
+            if request.accepted_renderer.format == NDJSONRenderer.format:
+                return Response(self.serialize(ledger, shape)["dataframe"], HTTP_200_OK)
+
+        elif request.accepted_renderer.format == NDJSONRenderer.format:
+            return StreamingHttpResponse(
+                self.stream(request.accepted_renderer, window_start, end_date, opening_balance),
+                content_type=NDJSONRenderer.media_type
+            )
+
+        elif settings.LEDGER_MMAP:
+            ledger = MappedLedger.get(window_start, end_date, opening_balance)
+
+        else:
+            ledger = Ledger.build(window_start, end_date, opening_balance)
+
+        if not windowed:
+            with span("serialize"):
+                data = self.serialize(ledger, shape)
+            return Response(data, HTTP_200_OK)
+
+        count = len(ledger)
+        ledger = ledger.slice(offset, None if limit is None else offset + limit)
+
+        with span("serialize"):
+            data = self.serialize(ledger, shape)
+
+        return Response({
+            "count": count,
+            "opening_balance": to_decimal(ledger.opening_balance),
+            **data,
+        }, HTTP_200_OK)
+
+    @staticmethod
+    def get_start_date() -> datetime:
+        """
+        Returns the first date of the budget, the earliest date among rules and budget_edits.
+        """
+        # get earliest date among rules and budget_edits
+        earliest_date = None
+        try:
+            earliest_date = BudgetEdit.objects.earliest("date").date
+        except BudgetEdit.DoesNotExist:
+            earliest_date = datetime.today().date()
+
+        return datetime.combine(
+            min(
+                [
+                    Rule.objects.earliest("start_date").start_date,
+                    earliest_date
+                ]
+            ),
+            datetime.min.time()
+        )
+
+    @staticmethod
+    def serialize(ledger, shape):
+        """
+        Returns the serialized rows of the ledger, or its columns when shape is columnar.
+        The ledger may also be a Rollup.
+        """
+        if isinstance(ledger, Rollup):
+            if shape == "columnar":
+                return BudgetRollupColumnarSerializer(ledger).data
+            return BudgetRollupSerializer(ledger).data
+
+        if shape == "columnar":
+            return BudgetColumnarSerializer(ledger).data
+
+        return BudgetSerializer(ledger).data
+
+    def stream(self, renderer, start_date, end_date, opening_balance=0):
+        """
+        Yields the rendered rows of each ledger chunk, the balance is carried between chunks.
+        """
+        for ledger in Ledger.build_chunks(start_date, end_date, days=self.chunk_days,
+                                          opening_balance=opening_balance):
+            rows = BudgetSerializer(ledger).data["dataframe"]
+            if rows:
+                yield renderer.render(rows)
+
+
+class BudgetScenarioView(views.APIView):
+    # every scenario adds a column to the matrix
+    max_scenarios = 100
+
+    rule_fields = ["frequency", "start_date", "end_date", "weekday", "day_of_month", "month_of_year"]
+
+    def post(self, request, *args, **kwargs):
+        """
+        Evaluates hypothetical changes to the budget in memory, nothing is saved. Given as
+        {end_date, scenarios: [{name, categories, budget_edits}]}:
+
+        - categories: an array of {id, amount, start_date, rule}, with id and any of the others.
+          amount replaces the category's amount from start_date on, or on every date without it.
+          rule replaces the category's rule, or removes it when null.
+        - budget_edits: an array of one-off {category, date, amount}, that replaces the category's
+          budget edit on that date, or removes it when amount is null.
+
+        Returns the dates and, for the baseline and each scenario, the total and balance of each date,
+        see ScenarioMatrix. The budget starts on the same date as BudgetView's. When a scenario has
+        errors they are returned with its index, and nothing is evaluated.
+        """
+        data = request.data if isinstance(request.data, dict) else {}
+        end_date = data.get("end_date", None)
+        scenarios = data.get("scenarios", None)
+
+        if end_date is None or not isinstance(scenarios, list):
             return Response(
-                {"error": "end_date is required"},
+                {"error": "end_date and an array of scenarios are required"},
                 HTTP_400_BAD_REQUEST
             )
 
-        try:
-            # get earliest date among rules and budget_edits
-            earliest_date = None
-            try:
-                earliest_date = BudgetEdit.objects.earliest("date").date
-            except BudgetEdit.DoesNotExist:
-                earliest_date = datetime.today().date()
-
-            start_date = pd.to_datetime(
-                min(
-                    [
-                        Rule.objects.earliest("start_date").start_date,
-                        earliest_date
-                    ]
-                )
+        if len(scenarios) > self.max_scenarios:
+            return Response(
+                {"error": f"at most {self.max_scenarios} scenarios can be evaluated at once"},
+                HTTP_400_BAD_REQUEST
             )
-            end_date = pd.to_datetime(end_date)
 
-        except ValueError:
+        try:
+            start_date = BudgetView.get_start_date()
+            end_date = datetime.fromisoformat(end_date)
+        except (TypeError, ValueError):
             return Response(
                 {"error": "end_date must be in YYYY-MM-DD format"},
                 HTTP_400_BAD_REQUEST
@@ -187,217 +510,338 @@ class BudgetView(views.APIView):
                 HTTP_400_BAD_REQUEST
             )
 
-        # get categories
-        all_categories = Category.objects.all()
-        fixed_categories = Category.objects.filter(group="Fixed")
-        variable_categories = Category.objects.filter(group="Variable")
-        discretionary_categories = Category.objects.filter(
-            group="Discretionary")
-        income_categories = Category.objects.filter(group="Income")
-        savings_categories = Category.objects.filter(group="Savings")
-
-        category_dict = {
-            "all": all_categories,
-            "Fixed": fixed_categories,
-            "Variable": variable_categories,
-            "Discretionary": discretionary_categories,
-            "Income": income_categories,
-            "Savings": savings_categories,
-        }
-
-        # get all occurrences for each category between start_date and end_date
-        all_occurrences = pd.Series([])
-        individual_occurrences = {}
-
-        # categories that have a rule
-        for category in all_categories:
-            if Rule.objects.filter(category=category).exists():
-
-                rule_occurrences = Rule.objects.get(
-                    category=category).get_occurrences(start_date, end_date)
-
-                category_occurrences = pd.Series(
-                    [occurrence.date() for occurrence in rule_occurrences])
-
-                non_rule_occurrences = BudgetEdit.objects.filter(
-                    category=category, date__gte=start_date, date__lte=end_date).values_list("date", flat=True)
-
-                category_occurrences = pd.concat(
-                    [category_occurrences, pd.Series(
-                        [occurrence for occurrence in non_rule_occurrences]
-                    )])
-
-                all_occurrences = pd.concat(
-                    [all_occurrences, category_occurrences])
-
-                individual_occurrences[category.name] = rule_occurrences
-
-        # categories that have a rule but a budget edit exists for a date that is not in the rule occurrences
-        for budget_edit in BudgetEdit.objects.filter(date__gte=start_date, date__lte=end_date, category__rule__isnull=True):
-            # add date to all_occurrences if it does not exist
-            if budget_edit.date not in all_occurrences.values:
-                all_occurrences = pd.concat(
-                    [all_occurrences, pd.Series([budget_edit.date])])
-
-                individual_occurrences[budget_edit.category.name] = [
-                    datetime(budget_edit.date.year,
-                             budget_edit.date.month, budget_edit.date.day),
-                ]
+        groups = dict(Category.objects.values_list("id", "group"))
+        parsed = []
+        errors = []
 
-        # categories that do not have a rule but have a budget edit
-        for budget_edit in BudgetEdit.objects.filter(date__gte=start_date, date__lte=end_date, category__rule__isnull=True):
-            # add date to all_occurrences if it does not exist
-            if budget_edit.date not in all_occurrences.values:
-                all_occurrences = pd.concat(
-                    [all_occurrences, pd.Series([budget_edit.date])])
+        for index, scenario in enumerate(scenarios):
+            try:
+                parsed.append(self.parse_scenario(index, scenario, groups))
+            except ValidationError as e:
+                errors.append({"index": index, "error": e.messages})
+
+        if errors:
+            return Response({"errors": errors}, HTTP_400_BAD_REQUEST)
+
+        matrix = ScenarioMatrix.build(start_date, end_date, parsed)
+
+        # Decimals are rendered as floats, dividing the matrices of cents at once saves a call per
+        # cell, the float of cents / 100 is the float of the Decimal
+        row_totals = (matrix.row_totals / 100).T
+        balance = (matrix.balance() / 100).T
+        closing_balance = (matrix.closing_balance / 100).tolist()
+
+        return Response({
+            "date": np.datetime_as_string(matrix.dates, unit="D").tolist(),
+            "scenarios": [
+                {
+                    "name": name,
+                    "row_total": row_totals[i].tolist(),
+                    "balance": balance[i].tolist(),
+                    "closing_balance": closing_balance[i],
+                }
+                for i, name in enumerate(matrix.names)
+            ],
+        }, HTTP_200_OK)
+
+    def parse_scenario(self, index, data, groups):
+        """
+        Returns the Scenario of a request's scenario, raises ValidationError when it is invalid.
+        Amounts are adjusted by the category group, as Category and BudgetEdit do when saved.
+        """
+        if not isinstance(data, dict):
+            raise ValidationError("a scenario must be an object")
 
-                individual_occurrences[budget_edit.category.name] = [
-                    datetime(budget_edit.date.year,
-                             budget_edit.date.month, budget_edit.date.day),
-                ]
+        categories = data.get("categories", [])
+        budget_edits = data.get("budget_edits", [])
 
-        # categories with no rule and no budget edit
-        for category in all_categories:
-            if category.name not in individual_occurrences.keys():
-                individual_occurrences[category.name] = []
-
-        # remove duplicates and sort
-        all_occurrences = all_occurrences.drop_duplicates().sort_values()
-
-        # create dataframe with columns for date, categories, group_totals, row_total, and balance
-        categories_data = all_occurrences.map(
-            lambda date: [
-                category.name
-                for category in all_categories
-                if date in [
-                    date.date()
-                    for date in individual_occurrences[category.name]
-                ]
-            ]
-        )
+        if not isinstance(categories, list) or not isinstance(budget_edits, list):
+            raise ValidationError("categories and budget_edits must be arrays")
 
-        group_totals_data = all_occurrences.map(
-            lambda date: {
-                category.group: sum(
-                    [
-                        # if date is in occurrences for category and no budget edit exists, use category adjusted_amount
-                        # if date is in occurrences for category and budget edit exists, use budget edit adjusted_amount
-                        # if date is NOT in occurrences for category, use 0
-
-                        category.adjusted_amount
-
-                        if (date in [
-                            date.date()
-                            for date in individual_occurrences[category.name]
-                        ]) and not (
-                            BudgetEdit.objects.filter(
-                                category=category, date=date).exists()
-                        ) else BudgetEdit.objects.get(category=category, date=date).adjusted_amount if (
-                            BudgetEdit.objects.filter(
-                                category=category, date=date).exists()
-                        ) else 0
-
-                        for category in category_dict[category.group]
-                    ]
+        amount_field = Category._meta.get_field("amount")
+        date_field = BudgetEdit._meta.get_field("date")
+        scenario = Scenario(str(data.get("name", f"scenario {index + 1}")))
+
+        for category in categories:
+            category_id = category.get("id") if isinstance(category, dict) else None
+            if not self.is_category(category_id, groups):
+                raise ValidationError("category does not exist")
+
+            if category.get("amount") is not None:
+                amount = clean_amount(amount_field, category["amount"])
+                start_date = category.get("start_date")
+                scenario.amounts[category_id] = (
+                    amount if groups[category_id] == "Income" else amount * -1,
+                    None if start_date is None else self.clean_date(date_field, start_date),
                 )
-                for category in all_categories
-            }
-        )
 
-        row_total_data = all_occurrences.map(
-            lambda date: sum(
-                [
-                    # if date is in occurrences for category and no budget edit exists, use category adjusted_amount
-                    # if date is in occurrences for category and budget edit exists, use budget edit adjusted_amount
-                    # if date is NOT in occurrences for category, use 0
+            if "rule" in category:
+                if category["rule"] is None:
+                    scenario.rules[category_id] = None
+                elif isinstance(category["rule"], dict):
+                    rule = Rule(**{
+                        field: category["rule"].get(field) for field in self.rule_fields
+                    })
+                    for field in ["start_date", "end_date"]:
+                        if getattr(rule, field) is not None:
+                            self.clean_date(date_field, getattr(rule, field))
+                    rule.full_clean()
+                    scenario.rules[category_id] = rule.get_recurrence()
+                else:
+                    raise ValidationError("rule must be an object or null")
 
-                    category.adjusted_amount
+        for budget_edit in budget_edits:
+            if not isinstance(budget_edit, dict) or any(
+                    budget_edit.get(key) is None for key in ["category", "date"]) or "amount" not in budget_edit:
+                raise ValidationError("category, date, and amount are required")
 
-                    if (date in [
-                        date.date()
-                        for date in individual_occurrences[category.name]
-                    ]) and not (
-                        BudgetEdit.objects.filter(
-                            category=category, date=date).exists()
+            category_id = budget_edit["category"]
+            if not self.is_category(category_id, groups):
+                raise ValidationError("category does not exist")
 
-                    ) else BudgetEdit.objects.get(category=category, date=date).adjusted_amount if (
-                        BudgetEdit.objects.filter(
-                            category=category, date=date).exists()
-                    ) else 0
+            date = self.clean_date(date_field, budget_edit["date"])
+            amount = budget_edit["amount"]
+            if amount is not None:
+                amount = clean_amount(amount_field, amount)
+                amount = amount if groups[category_id] == "Income" else amount * -1
 
-                    for category in all_categories
-                ]
-            )
-        )
+            scenario.budget_edits[category_id, date] = amount
 
-        # note: data keys are column names, data values are column values for each row
-        data = {
-            "date": all_occurrences,
-            "categories": categories_data,
-            "budget_edits": all_occurrences.map(
-                lambda date: [
-                    budget_edit.id
-                    for budget_edit in BudgetEdit.objects.filter(date=date)
-                ]),
-            "group_totals": group_totals_data,
-            "row_total": row_total_data,
-            "balance": row_total_data.cumsum(),
-        }
-
-        df = pd.DataFrame(data)
-        df.index = range(0, len(df))
-
-        serializer = BudgetSerializer(df)
+        return scenario
 
-        return Response(serializer.data, HTTP_200_OK)
+    @staticmethod
+    def is_category(category_id, groups) -> bool:
+        """
+        Returns whether a request's category id is the id of a category, ids are integers.
+        """
+        return isinstance(category_id, int) and not isinstance(category_id, bool) and category_id in groups
 
+    @staticmethod
+    def clean_date(date_field, value):
+        """
+        Returns the date of a request's YYYY-MM-DD string, raises ValidationError for other values,
+        which the date field would raise TypeError for.
+        """
+        if not isinstance(value, str):
+            raise ValidationError("date must be in YYYY-MM-DD format")
 
-class CategoryBatchView(views.APIView):
-    def delete(self, request, *args, **kwargs):
-        categories = request.data
+        return date_field.clean(value, None)
+
+
+class BudgetThresholdView(views.APIView):
+    @cache_response
+    def get(self, request, *args, **kwargs):
+        """
+        Returns when the balance goes below thresholds, given as ?threshold=0&threshold=500, and the
+        minimum balance, between the optional start_date and the required end_date:
+
+        minimum: the first date with the lowest balance, and that balance
+        crossings: for each threshold, the first date on or after start_date with a balance below it,
+                   and that balance, or a null date when the balance stays above it
+
+        The balance on a date is the balance after its last row, as in BudgetView, and the rows
+        before start_date are not built. Both are answered from a BalanceIndex of the ledger,
+        cached per data version, so other thresholds over the same dates do not rebuild it.
+        """
+        end_date = request.query_params.get("end_date", None)
 
-        if categories is None:
+        if end_date is None:
             return Response(
-                {"error": "categories is required"},
+                {"error": "end_date is required"},
                 HTTP_400_BAD_REQUEST
             )
 
         try:
-            categories = [Category.objects.get(id=category["id"])
-                          for category in categories]
-        except Category.DoesNotExist:
+            start_date = BudgetView.get_start_date()
+            end_date = datetime.fromisoformat(end_date)
+        except ValueError:
             return Response(
-                {"error": "one or more categories do not exist"},
+                {"error": "end_date must be in YYYY-MM-DD format"},
                 HTTP_400_BAD_REQUEST
             )
 
-        for category in categories:
-            category.delete()
+        window_start = request.query_params.get("start_date", None)
+
+        try:
+            window_start = start_date if window_start is None else max(
+                start_date, datetime.fromisoformat(window_start))
+        except ValueError:
+            return Response(
+                {"error": "start_date must be in YYYY-MM-DD format"},
+                HTTP_400_BAD_REQUEST
+            )
+
+        if window_start > end_date:
+            return Response(
+                {"error": "start_date must be before end_date"},
+                HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            thresholds = [Decimal(threshold) for threshold in request.query_params.getlist("threshold")]
+            # the thresholds are rendered as floats, so they must be finite as floats too
+            if not all(math.isfinite(threshold) for threshold in thresholds):
+                raise InvalidOperation
+        except (InvalidOperation, ValueError):
+            return Response(
+                {"error": "threshold must be a number"},
+                HTTP_400_BAD_REQUEST
+            )
+
+        opening_balance = Ledger.balance_before(start_date, window_start)
+        index = BalanceIndex.get(window_start, end_date, opening_balance)
+        minimum_date, minimum = index.minimum(window_start, end_date)
+
+        # a balance in cents is below a threshold when it is below the threshold's cents rounded up
+        crossings = index.first_below(
+            [int((threshold * 100).to_integral_value(ROUND_CEILING)) for threshold in thresholds],
+            window_start
+        )
+
+        return Response({
+            "start_date": window_start.date(),
+            "end_date": end_date.date(),
+            "minimum": {"date": minimum_date, "balance": to_decimal(minimum)},
+            "crossings": [
+                {
+                    "threshold": threshold,
+                    "date": None if crossing is None else crossing[0],
+                    "balance": None if crossing is None else to_decimal(crossing[1]),
+                }
+                for threshold, crossing in zip(thresholds, crossings)
+            ],
+        }, HTTP_200_OK)
 
-        return Response({"success": "categories deleted"}, HTTP_200_OK)
+
+def batch_ids(data, allow_null=False) -> set:
+    """
+    Returns the ids of a batch request's array of {id} objects, or an empty set when the array is
+    empty or an entry is not an object with an integer id. Null entries are skipped with allow_null.
+    """
+    if not isinstance(data, list):
+        return set()
+
+    ids = set()
+    for entry in data:
+        if entry is None and allow_null:
+            continue
+
+        entry_id = entry.get("id") if isinstance(entry, dict) else None
+        if not isinstance(entry_id, int) or isinstance(entry_id, bool):
+            return set()
+
+        ids.add(entry_id)
+
+    return ids
+
+
+class CategoryBatchView(views.APIView):
+    def delete(self, request, *args, **kwargs):
+        """
+        Deletes the categories with the given ids, their budget edits and their rules.
+
+        The ids are validated with one query and the rows are deleted with one query per table in a
+        single transaction. The per-instance signals are bypassed, so the work they do is done here
+        set-based: the snapshots from the earliest deleted date are invalidated, the rules left
+        without a category are deleted and their cached occurrences dropped.
+        """
+        ids = batch_ids(request.data)
+
+        if not ids:
+            return Response(
+                {"error": "categories is required, as an array of {id}"},
+                HTTP_400_BAD_REQUEST
+            )
+
+        with transaction.atomic():
+            queryset = Category.objects.filter(id__in=ids)
+            category_rules = dict(queryset.values_list("id", "rule_id"))
+
+            if len(category_rules) != len(ids):
+                return Response(
+                    {"error": "one or more categories do not exist"},
+                    HTTP_400_BAD_REQUEST
+                )
+
+            # the rules are one to one with the categories, so they are all orphaned by the delete
+            rule_ids = [rule_id for rule_id in category_rules.values() if rule_id is not None]
+            budget_edits = BudgetEdit.objects.filter(category_id__in=ids)
+            rules = Rule.objects.filter(id__in=rule_ids)
+
+            earliest_date = min([
+                date for date in [
+                    budget_edits.aggregate(date=Min("date"))["date"],
+                    rules.aggregate(date=Min("start_date"))["date"],
+                ] if date is not None
+            ], default=None)
+
+            DataVersion.bump()
+            if earliest_date is not None:
+                BalanceSnapshot.invalidate(earliest_date)
+
+            budget_edit_count = delete_rows(BudgetEdit, "category", ids)
+            category_count = delete_rows(Category, "id", ids)
+            rule_count = delete_rows(Rule, "id", rule_ids)
+
+        occurrence_cache.invalidate(*rule_ids)
+
+        return Response({
+            "success": "categories deleted",
+            "categories": category_count,
+            "budget_edits": budget_edit_count,
+            "rules": rule_count,
+        }, HTTP_200_OK)
 
 
 class BudgetEditBatch(views.APIView):
     def delete(self, request, *args, **kwargs):
+        """
+        Deletes the budget edits with the given ids, validated with one query and deleted with
+        one query in a single transaction. The snapshots from the earliest deleted date are
+        invalidated here, since the per-instance signals are bypassed.
+        """
         budget_edits = request.data
 
-        if budget_edits is None or budget_edits[0] is None:
-            # Okay to have budget_edits[0] is None
-            # budget_edits[0] happens when the user sends delete request for category with rule
-            # and the category has no budget_edits, the budget row is then reverted to the
-            # original category amount
+        # null entries are okay, they are sent for the selected categories with a rule that have no
+        # budget_edit on the date, the budget row is then reverted to the original category amount
+        if isinstance(budget_edits, list) and budget_edits and all(
+                budget_edit is None for budget_edit in budget_edits):
             return Response({"success": "no budget_edits to delete"}, HTTP_200_OK)
 
-        try:
-            budget_edits = [BudgetEdit.objects.get(id=budget_edit["id"])
-                            for budget_edit in budget_edits]
-        except BudgetEdit.DoesNotExist:
+        ids = batch_ids(budget_edits, allow_null=True)
+
+        if not ids:
             return Response(
-                {"error": "one or more budget_edits do not exist"},
+                {"error": "budget_edits is required, as an array of {id}"},
                 HTTP_400_BAD_REQUEST
             )
 
-        for budget_edit in budget_edits:
-            budget_edit.delete()
+        with transaction.atomic():
+            queryset = BudgetEdit.objects.filter(id__in=ids)
+            found = queryset.aggregate(count=Count("id"), date=Min("date"))
+
+            if found["count"] != len(ids):
+                return Response(
+                    {"error": "one or more budget_edits do not exist"},
+                    HTTP_400_BAD_REQUEST
+                )
+
+            DataVersion.bump()
+            BalanceSnapshot.invalidate(found["date"])
+            budget_edit_count = delete_rows(BudgetEdit, "id", ids)
+
+        return Response({
+            "success": "budget_edits deleted",
+            "budget_edits": budget_edit_count,
+        }, HTTP_200_OK)
+
+
+class ProfilingStatsView(views.APIView):
+    def get(self, request, *args, **kwargs):
+        """
+        Returns the request timings aggregated per view by the profiling middleware.
+        """
+        if not settings.API_PROFILING:
+            return Response({"error": "profiling is disabled"}, HTTP_404_NOT_FOUND)
 
-        return Response({"success": "budget_edits deleted"}, HTTP_200_OK)
+        return Response(profiling_stats.summary(), HTTP_200_OK)
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -46,6 +47,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.profiling.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -88,6 +90,57 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+# API responses are cached per data version, see api/caching.py.
+# The local memory cache evicts the least recently used entries past MAX_ENTRIES.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 256,
+        },
+    }
+}
+
+
+# Profiling
+# Adds Server-Timing headers to every response and aggregates them at /api/profiling-stats,
+# ?profile=1 dumps a cProfile of the request to API_PROFILING_DIR. See api/profiling.py.
+
+API_PROFILING = False
+
+API_PROFILING_DIR = BASE_DIR / 'profiles'
+
+
+# Async views
+# The async variants of the budget and batch views, under /api/async/, run the views in a pool of
+# API_POOL_WORKERS threads, see api/concurrency.py.
+
+API_POOL_WORKERS = 4
+
+
+# Ledger
+# Rules are expanded in a pool of LEDGER_EXPANSION_WORKERS processes when a ledger has at least
+# LEDGER_EXPANSION_THRESHOLD of them, and serially otherwise, see api/occurrences.py.
+
+LEDGER_EXPANSION_WORKERS = os.cpu_count() or 1
+
+LEDGER_EXPANSION_THRESHOLD = 5000
+
+# With LEDGER_MMAP, the ledgers of /api/budget are written once per data version under
+# LEDGER_MMAP_DIR and memory-mapped by every worker process, see api/mapped.py. At most
+# LEDGER_MMAP_WINDOWS ledgers, the most recently used, are kept per data version.
+
+LEDGER_MMAP = False
+
+LEDGER_MMAP_DIR = BASE_DIR / 'ledgers'
+
+LEDGER_MMAP_WINDOWS = 32
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.2/ref/settings/#auth-password-validators
 
@@ -130,9 +183,10 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 REST_FRAMEWORK = {
+    # the browsable API is only for development
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer',
-        'rest_framework.renderers.BrowsableAPIRenderer',
+        'api.renderers.ORJSONRenderer',
+        *(['rest_framework.renderers.BrowsableAPIRenderer'] if DEBUG else []),
     ],
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',